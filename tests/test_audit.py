@@ -0,0 +1,60 @@
+from tsdb import *
+from tsdb.row import *
+from tsdb.audit import audit, AuditReport, _audit_path
+
+from test_query import QueryTestCase, TESTDB
+
+class TestAudit(QueryTestCase):
+    def setUp(self):
+        QueryTestCase.setUp(self)
+        self.build_counter("rtr/good/in", 5, n=24)
+        bad = self.build_counter("rtr/bad/in", 5, n=24, rtype=Counter64)
+        bad.insert(Counter64(10 * 3600, ROW_VALID, 2**40))
+        bad.insert(Counter64(20 * 3600, ROW_VALID, 7))
+        bad.flush()
+        u = self.db.add_var("rtr/uptime", TimeTicks, 3600, YYYYMMDDChunkMapper)
+        for i in range(24):
+            u.insert(TimeTicks(i * 3600, ROW_VALID, (i % 20) * 360000))
+        u.flush()
+        g = self.db.add_var("rtr/gauge", Gauge32, 3600, YYYYMMDDChunkMapper)
+        g.insert(Gauge32(0, ROW_VALID, 1))
+        g.flush()
+
+    def testAudit(self):
+        for processes in (0, 2):
+            reports = audit(TESTDB, "rtr/*", max_rates={'Counter32': 10,
+                'rtr/bad/in': 200}, processes=processes)
+            # TimeTicks roll over too, going backwards is a reset
+            self.assertEqual([r.path for r in reports], ["rtr/bad/in",
+                "rtr/uptime"])
+            self.assertEqual(reports[1].resets, 1)
+            r = reports[0]
+            self.assertEqual(r.path, "rtr/bad/in")
+            self.assertEqual(r.intervals, 23)
+            self.assertEqual(r.spikes, 1)
+            self.assertEqual(r.first_spike, 10 * 3600)
+            self.assertEqual(r.resets, 2)
+            self.assertEqual(r.rollovers, 0)
+            self.assertEqual(r.uptime_resets, 0)
+
+    def testUptime(self):
+        reports = audit(TESTDB, "rtr/*/in", processes=0, everything=True,
+                uptime_paths={'rtr/bad/in': 'rtr/uptime'})
+        self.assertEqual([r.path for r in reports], ["rtr/bad/in",
+            "rtr/good/in"])
+        self.assertEqual(reports[0].resets, 1)
+        self.assertEqual(reports[0].rollovers, 1)
+        self.assertEqual(reports[0].uptime_resets, 1)
+        self.assertEqual(reports[1], AuditReport("rtr/good/in", 23, 0, 5.0,
+            None, 0, 0, 0))
+
+    def testClosesVars(self):
+        db = TSDB(TESTDB, mode="r")
+        var = db.get_var("rtr/bad/in")
+        uptime = db.get_var("rtr/uptime")
+        report = _audit_path(db, "rtr/bad/in", None, None, None,
+                {'rtr/bad/in': 'rtr/uptime'})
+        self.assertEqual(report.uptime_resets, 1)
+        self.assertEqual(var.chunks, {})
+        self.assertEqual(uptime.chunks, {})
+        self.assertEqual(db.vars, {})
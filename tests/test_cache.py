@@ -0,0 +1,114 @@
+import unittest
+
+import numpy
+
+from tsdb import *
+from tsdb.row import *
+from tsdb.cache import QueryCache, LRUCache, MemcacheCache
+from tsdb.chunk_mapper import YYYYMMDDChunkMapper
+
+from test_query import QueryTestCase, TESTDB
+
+class FakeMemcache(object):
+    """A stand in for memcache.Client."""
+
+    def __init__(self):
+        self.data = {}
+        self.gets = 0
+
+    def get(self, key):
+        self.gets += 1
+        return self.data.get(key)
+
+    def set(self, key, value, time=0):
+        self.data[key] = value
+        return True
+
+    def add(self, key, value, time=0):
+        if self.data.has_key(key):
+            return False
+        self.data[key] = value
+        return True
+
+    def incr(self, key, delta=1):
+        if not self.data.has_key(key):
+            return None
+        self.data[key] += delta
+        return self.data[key]
+
+class TestLRUCache(unittest.TestCase):
+    def testEviction(self):
+        lru = LRUCache(3 * 80)
+        for i in range(3):
+            lru.set(i, numpy.zeros(10))
+        lru.get(0)
+        lru.set(3, numpy.zeros(10))
+        self.assertEqual(lru.get(1), None)
+        for i in (0, 2, 3):
+            self.assertTrue(lru.get(i) is not None)
+        self.assertEqual(lru.bytes, 3 * 80)
+
+        lru.set(4, numpy.zeros(1000))
+        self.assertEqual(lru.get(4), None)
+
+class TestQueryCache(QueryTestCase):
+    def setUp(self):
+        QueryTestCase.setUp(self)
+        self.build_counter("foo", 1)
+        self.memcache = FakeMemcache()
+        self.cache = QueryCache([LRUCache(1024 * 1024),
+            MemcacheCache(self.memcache)])
+        self.db = TSDB(TESTDB, cache=self.cache)
+        self.v = self.db.get_var("foo")
+
+    def testHit(self):
+        a = self.v.select_array(0, 10 * 3600)
+        self.assertEqual(self.cache.misses, 1)
+        b = self.v.select_array(0, 10 * 3600)
+        self.assertEqual(self.cache.hits, 1)
+        self.assertTrue(numpy.array_equal(a, b))
+
+        # the shared tier is used by another TSDB and fills its own LRU
+        db = TSDB(TESTDB, cache=QueryCache([LRUCache(1024 * 1024),
+            MemcacheCache(self.memcache)]))
+        self.assertTrue(numpy.array_equal(db.get_var("foo").select_array(0,
+            10 * 3600), a))
+        self.assertEqual(db.cache.hits, 1)
+        self.assertEqual(len(db.cache.tiers[0].entries), 1)
+
+    def testInvalidate(self):
+        self.v.select_array(0, 10 * 3600)
+        self.v.insert(Counter32(5 * 3600, ROW_VALID, 42))
+
+        # unflushed inserts bypass the cache
+        self.assertEqual(self.v.select_array(0, 10 * 3600)['value'][5], 42)
+        self.assertEqual(self.cache.hits + self.cache.misses, 1)
+
+        self.v.flush()
+        self.assertEqual(self.v.select_array(0, 10 * 3600)['value'][5], 42)
+        self.assertEqual(self.cache.hits, 0)
+
+    def testOtherWriter(self):
+        """A reader sees rows backfilled by another process."""
+        self.assertEqual(self.v.select_array(0, 10 * 3600)['value'][5],
+                5 * 3600)
+        writer = TSDB(TESTDB).get_var("foo")
+        writer.insert(Counter32(5 * 3600, ROW_VALID, 42))
+        writer.flush()
+
+        self.assertEqual(self.v.select_array(0, 10 * 3600)['value'][5], 42)
+        self.assertEqual(self.cache.hits, 0)
+        self.v.select_array(0, 10 * 3600)
+        self.assertEqual(self.cache.hits, 1)
+
+    def testAggregate(self):
+        self.v.add_aggregate("1h", YYYYMMDDChunkMapper, ['average', 'delta'])
+        self.v.update_all_aggregates()
+        agg = self.v.get_aggregate("1h")
+        n = len(agg.select_array(0, 72 * 3600))
+
+        for i in range(48, 72):
+            self.v.insert(Counter32(i * 3600, ROW_VALID, i * 3600))
+        self.v.flush()
+        self.v.update_all_aggregates()
+        self.assertEqual(len(agg.select_array(0, 72 * 3600)), n + 24)
@@ -0,0 +1,172 @@
+import StringIO
+import time
+
+from tsdb import *
+from tsdb.row import *
+from tsdb.cache import QueryCache, LRUCache
+from tsdb.explain import SlowQueryLog, QueryStats, QueryLimits, CancelToken
+
+from test_query import QueryTestCase
+
+class TestExplain(QueryTestCase):
+    def setUp(self):
+        QueryTestCase.setUp(self)
+        self.var = self.build_counter("foo", 1, n=48, skip=range(24, 48))
+        self.var.add_aggregate("1h", YYYYMMDDChunkMapper, ['average',
+            'delta'])
+        self.var.add_aggregate("1d", YYYYMMDDChunkMapper, ['average',
+            'delta'])
+
+    def testExplain(self):
+        stats = self.var.explain(0, 3 * 86400 - 1)
+        self.assertEqual(stats.vars, [("/foo", 3600, 0, 23 * 3600)])
+        # the raw data is used and the clipped range is in the first chunk
+        self.assertEqual([(x.chunk, x.layer, x.rows) for x in stats.chunks],
+                [("19700101", 0, 24)])
+        self.assertEqual(stats.bytes_read(), 24 * self.var.rowsize())
+        self.assertEqual(stats.estimated_bytes(), stats.bytes_read())
+        self.assertEqual(stats.rows, 24)
+        self.assertTrue(stats.wall_time() >= 0)
+        self.assertTrue("1 vars, 1 chunks" in str(stats))
+
+        self.var.insert(Counter32(47 * 3600, ROW_VALID, 47 * 3600))
+        self.var.flush()
+        stats = self.var.explain(0, 47 * 3600, flags=ROW_VALID)
+        self.assertEqual(stats.layers(), {0: 2})
+        self.assertEqual(stats.rows_decoded(), 48)
+        self.assertEqual(stats.rows, 25)
+
+        self.var.update_all_aggregates()
+        stats = self.var.explain(0, 47 * 3600, step="1d")
+        self.assertEqual(stats.vars[0][:2], ("/foo/TSDBAggregates/86400",
+            86400))
+
+    def testMissingChunk(self):
+        self.var.insert(Counter32(48 * 3600, ROW_VALID, 0))
+        stats = self.var.explain(0, 48 * 3600)
+        self.assertEqual([(x.chunk, x.layer, x.bytes) for x in stats.chunks],
+                [("19700101", 0, 24 * self.var.rowsize()),
+                    ("19700102", None, 0),
+                    ("19700103", 0, self.var.rowsize())])
+
+    def testSelect(self):
+        self.var.insert(Counter32(48 * 3600, ROW_VALID, 0))
+        stats = self.var.explain_select(0, 48 * 3600, flags=ROW_VALID)
+        self.assertEqual(stats.vars, [("/foo", 3600, 0, 48 * 3600)])
+        self.assertEqual([(x.chunk, x.layer, x.rows) for x in stats.chunks],
+                [("19700101", 0, 24), ("19700102", None, 0),
+                    ("19700103", 0, 1)])
+        self.assertEqual(stats.estimated_bytes(), 49 * self.var.rowsize())
+        self.assertEqual(stats.rows, 25)
+
+        out = StringIO.StringIO()
+        self.db.slow_query_log = SlowQueryLog(0, out)
+        self.assertEqual(len(list(self.var.select(0, 3600))), 2)
+        self.assertTrue(" select /foo 0 3600 " in out.getvalue())
+
+    def testMatrixAndCache(self):
+        self.build_counter("bar", 2, n=24)
+        self.db.cache = QueryCache([LRUCache(1024 * 1024)])
+        stats = self.db.explain_matrix("*", 0, 23 * 3600, threads=2)
+        self.assertEqual(len(stats.vars), 2)
+        self.assertEqual(len(stats.chunks), 2)
+        self.assertEqual((stats.cache_hits, stats.cache_misses), (0, 2))
+
+        stats = self.db.explain_matrix(["foo", "bar"], 0, 23 * 3600)
+        self.assertEqual((stats.cache_hits, stats.cache_misses), (2, 0))
+        self.assertEqual(stats.chunks, [])
+        self.assertEqual(stats.rows, 48)
+
+    def testSlowQueryLog(self):
+        out = StringIO.StringIO()
+        self.db.slow_query_log = SlowQueryLog(0, out)
+        self.var.select_array(0, 3600)
+        self.db.select_matrix(["foo"], 0, 3600)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(" select_array /foo 0 3600 " in lines[0])
+        self.assertTrue("chunks=1 " in lines[0])
+        self.assertTrue(" select_matrix / 1 vars 0 3600 " in lines[1])
+
+        out.truncate(0)
+        self.db.slow_query_log.threshold = 60
+        self.var.select_array(0, 3600)
+        self.assertEqual(out.getvalue(), "")
+
+class TestLimits(QueryTestCase):
+    def setUp(self):
+        QueryTestCase.setUp(self)
+        self.var = self.build_counter("foo", 1, n=72)
+        self.build_counter("bar", 1, n=72)
+
+    def testLimits(self):
+        rows = self.var.select_array(0, 47 * 3600,
+                limits=QueryLimits(max_rows=48, max_chunks=2,
+                    max_bytes=48 * self.var.rowsize()))
+        self.assertEqual(len(rows), 48)
+
+        for limits in [QueryLimits(max_rows=47), QueryLimits(max_chunks=1),
+                QueryLimits(max_bytes=47 * self.var.rowsize())]:
+            self.assertRaises(TSDBQueryLimitError, self.var.select_array,
+                    0, 47 * 3600, limits=limits)
+
+        # the limits are for the whole query
+        limits = QueryLimits(max_chunks=4)
+        self.db.select_matrix(["foo", "bar"], 0, 47 * 3600, limits=limits)
+        self.assertRaises(TSDBQueryLimitError, self.db.select_matrix,
+                ["foo", "bar"], 0, 48 * 3600, limits=limits)
+
+        stats = self.var.explain(0, 3600, limits=QueryLimits(max_rows=2))
+        self.assertEqual(stats.rows, 2)
+
+    def testDeadlineAndCancel(self):
+        self.assertRaises(TSDBQueryDeadlineError, self.var.select_array,
+                limits=QueryLimits(deadline=time.time() - 1))
+        self.assertRaises(TSDBTimeoutError, self.var.query_array, 0, 3600,
+                limits=QueryLimits(deadline=time.time() - 1))
+
+        cancel = CancelToken()
+        limits = QueryLimits(cancel=cancel)
+        self.var.select_array(limits=limits)
+        cancel.cancel()
+        self.assertRaises(TSDBQueryCancelledError, self.db.select_matrix,
+                ["foo", "bar"], 0, 3600, threads=2, limits=limits)
+
+    def testFleetQueries(self):
+        end = 71 * 3600
+        queries = [
+            lambda limits: self.db.top_n("*", 0, end, 2, limits=limits),
+            lambda limits: self.db.heatmap("", 0, end, 3600, 4, range=(0, 2),
+                limits=limits),
+            lambda limits: self.db.evaluate('var("foo") + rate("bar")', 0,
+                end, 3600, limits=limits),
+            lambda limits: self.var.summarize(3600, end - 3600,
+                limits=limits),
+            lambda limits: self.var.rate(0, end, limits=limits),
+            lambda limits: self.var.percentile(50, 0, end, limits=limits),
+            lambda limits: self.var.moments(0, end, limits=limits),
+            lambda limits: list(self.var.select(0, end, limits=limits)),
+        ]
+
+        cancel = CancelToken()
+        cancel.cancel()
+        for query in queries:
+            query(None)
+            self.assertRaises(TSDBQueryLimitError, query,
+                    QueryLimits(max_chunks=1))
+            self.assertRaises(TSDBQueryCancelledError, query,
+                    QueryLimits(cancel=cancel))
+
+    def testSummaryReads(self):
+        # a whole chunk is read the first time it is summarized
+        self.assertRaises(TSDBQueryLimitError, self.var.summarize, 0,
+                86399, limits=QueryLimits(max_bytes=100, max_chunks=1))
+        stats = QueryStats()
+        self.var.summarize(0, 86399, stats=stats)
+        self.assertEqual(len(stats.chunks), 1)
+        self.assertEqual(stats.chunks[0].rows, 24)
+        self.assertEqual(stats.bytes_read(), 24 * self.var.rowsize())
+
+        stats = QueryStats(QueryLimits(max_bytes=100, max_chunks=1))
+        self.var.summarize(0, 86399, stats=stats)
+        self.assertEqual(stats.chunks, [])
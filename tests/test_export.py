@@ -0,0 +1,83 @@
+import csv
+import os
+import os.path
+
+import numpy
+
+from tsdb import *
+from tsdb.row import *
+from tsdb.export import export, iter_chunks
+
+from test_query import QueryTestCase, TESTDB
+
+OUTPUT = "tmp/export"
+
+class TestExport(QueryTestCase):
+    def setUp(self):
+        QueryTestCase.setUp(self)
+        os.system("rm -rf %s" % OUTPUT)
+        os.makedirs(OUTPUT)
+        self.in_ = self.build_counter("rtr/a/in", 1, n=72, skip=(30, ))
+        for step in ("1h", "6h"):
+            self.in_.add_aggregate(step, YYYYMMDDChunkMapper, ['average',
+                'delta', 'sketch'])
+        self.in_.update_all_aggregates()
+        self.build_counter("rtr/a/out", 2, n=30)
+        self.build_counter("other", 3, n=5)
+
+    def tearDown(self):
+        os.system("rm -rf %s" % OUTPUT)
+        QueryTestCase.tearDown(self)
+
+    def testIterChunks(self):
+        parts = list(iter_chunks(self.in_, 3600, 50 * 3600))
+        self.assertEqual([len(x) for x in parts], [23, 24, 3])
+        self.assertTrue(numpy.all(numpy.concatenate(parts) ==
+            self.in_.select_array(3600, 50 * 3600)))
+        self.assertEqual(list(iter_chunks(self.db.add_var("empty",
+            Counter32, 60, YYYYMMDDChunkMapper))), [])
+
+    def testNpz(self):
+        for processes in (1, 2):
+            output = os.path.join(OUTPUT, "rtr.npz")
+            counts = export(TESTDB, "rtr/*", output, 0, 47 * 3600,
+                    processes=processes)
+            self.assertEqual(counts, {'rtr/a/in': 48, 'rtr/a/out': 30})
+
+            data = numpy.load(output)
+            self.assertEqual(sorted(data.keys()), ['rtr/a/in/flags',
+                'rtr/a/in/timestamp', 'rtr/a/in/value', 'rtr/a/out/flags',
+                'rtr/a/out/timestamp', 'rtr/a/out/value'])
+            rows = self.in_.select_array(0, 47 * 3600)
+            for field in rows.dtype.names:
+                self.assertTrue(numpy.all(data['rtr/a/in/' + field] ==
+                    rows[field]))
+
+        # sub-array fields become 2d arrays
+        export(TESTDB, "rtr/a/in", output, aggregate="6h", flags=ROW_VALID,
+                processes=1)
+        data = numpy.load(output)
+        agg = self.in_.get_aggregate("6h").select_array(flags=ROW_VALID)
+        for field in ('sketch_buckets', 'sketch_counts'):
+            self.assertEqual(data['rtr/a/in/' + field].shape, (len(agg), 6))
+            self.assertTrue(numpy.all(data['rtr/a/in/' + field] ==
+                agg[field]))
+
+    def testNpy(self):
+        counts = export(TESTDB, "rtr/*", OUTPUT, format='npy', flags=ROW_VALID)
+        self.assertEqual(counts, {'rtr/a/in': 71, 'rtr/a/out': 30})
+        rows = numpy.load(os.path.join(OUTPUT, "rtr/a/in.npy"))
+        self.assertTrue(numpy.all(rows ==
+            self.in_.select_array(flags=ROW_VALID)))
+
+    def testCsv(self):
+        export(TESTDB, "other", OUTPUT, format='csv', processes=1)
+        lines = list(csv.reader(open(os.path.join(OUTPUT, "other.csv"))))
+        self.assertEqual(lines[0], ['timestamp', 'flags', 'value'])
+        self.assertEqual(lines[1:3], [['0', '1', '0'],
+            ['3600', '1', '10800']])
+        self.assertEqual(len(lines), 6)
+
+    def testBadFormat(self):
+        self.assertRaises(TSDBError, export, TESTDB, "*", OUTPUT,
+                format='xls')
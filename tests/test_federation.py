@@ -0,0 +1,83 @@
+import os.path
+
+import numpy
+
+from tsdb import *
+from tsdb.row import *
+from tsdb.federation import FederatedTSDB
+
+from test_query import QueryTestCase, TESTDB
+
+class TestFederation(QueryTestCase):
+    def setUp(self):
+        QueryTestCase.setUp(self)
+        self.build_counter("rtr/a/in", 1)
+        self.build_counter("rtr/b/in", 2)
+        self.roots = {'east': TESTDB}
+
+        self.db = TSDB.create(os.path.join(TESTDB, "west"))
+        self.build_counter("rtr/c/in", 3)
+        self.build_counter("rtr/c/out", 4, skip=(5,))
+        self.roots['west'] = os.path.join(TESTDB, "west")
+
+    def testFindVars(self):
+        fed = FederatedTSDB(self.roots)
+        self.assertEqual(fed.find_vars("*/in"), ["east/rtr/a/in",
+            "east/rtr/b/in", "west/rtr/c/in"])
+        self.assertEqual(fed.find_vars("west/*"), ["west/rtr/c/in",
+            "west/rtr/c/out"])
+        self.assertEqual(fed.get_var("west/rtr/c/in").metadata['STEP'], 3600)
+        self.assertRaises(TSDBVarDoesNotExistError, fed.get_var, "north/x")
+        fed.close()
+
+    def testQueries(self):
+        for processes in (None, 2):
+            fed = FederatedTSDB(self.roots, processes=processes)
+
+            (paths, timestamps, matrix, mask) = fed.select_matrix(
+                    ["west/rtr/c/in", "east/rtr/a/in"], 0, 47 * 3600)
+            self.assertEqual(paths, ["west/rtr/c/in", "east/rtr/a/in"])
+            self.assertEqual(matrix.shape, (2, 48))
+            self.assertEqual(list(matrix[:, 1]), [3 * 3600, 3600])
+
+            self.assertEqual([x[1] for x in fed.top_n("*/in", 0, 47 * 3600,
+                2, metric='max', field='value')],
+                ["west/rtr/c/in", "east/rtr/b/in"])
+
+            (summaries, total) = fed.summarize("*/c/*", 0, 47 * 3600)
+            self.assertEqual(summaries["west/rtr/c/out"]['count'], 47)
+            self.assertEqual(total['count'], 95)
+            self.assertEqual(total['max'], 4 * 47 * 3600)
+
+            (grid, values) = fed.evaluate(
+                    'var("west/rtr/c/in") - var("east/rtr/a/in")',
+                    0, 3 * 3600, 3600)
+            self.assertEqual(list(values), [0, 2 * 3600, 4 * 3600, 6 * 3600])
+
+            # every query used the same pool
+            pool = fed.pool
+            fed.find_vars("*")
+            self.assertTrue(fed.pool is pool)
+            fed.close()
+            self.assertTrue(fed.pool is None)
+
+    def testNewData(self):
+        # one worker process so that it has the TSDBVar loaded already
+        for processes in (None, 1):
+            fed = FederatedTSDB(self.roots, processes=processes)
+            count = fed.summarize("west/rtr/c/in")[1]['count']
+
+            # written by another process while fed is open
+            var = TSDB(self.roots['west']).get_var("rtr/c/in")
+            step = var.metadata['STEP']
+            t = var.max_timestamp()
+            for i in range(1, 11):
+                var.insert(Counter32(t + i * step, ROW_VALID, 0))
+            var.flush()
+            var.close()
+
+            self.assertEqual(fed.summarize("west/rtr/c/in")[1]['count'],
+                    count + 10)
+            self.assertEqual(fed.get_var("west/rtr/c/in").max_timestamp(),
+                    t + 10 * step)
+            fed.close()
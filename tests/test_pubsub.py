@@ -0,0 +1,57 @@
+from tsdb import *
+from tsdb.row import *
+
+from test_query import QueryTestCase, TESTDB
+
+class TestPubSub(QueryTestCase):
+    def testInsert(self):
+        v = self.build_counter("rtr/a/in", 1, n=2)
+        self.build_counter("rtr/a/out", 1, n=2)
+        sub = self.db.subscribe("rtr/*/in")
+        v.insert(Counter32(2 * 3600, ROW_VALID, 7200))
+        self.db.get_var("rtr/a/out").insert(Counter32(2 * 3600, ROW_VALID, 1))
+
+        (path, row) = sub.get(1)
+        self.assertEqual(path, "rtr/a/in")
+        self.assertEqual((row.timestamp, row.value), (7200, 7200))
+        self.assertEqual(sub.get(0.01), None)
+
+        sub.close()
+        v.insert(Counter32(3 * 3600, ROW_VALID, 10800))
+        self.assertEqual(sub.get(0.01), None)
+
+    def testOverflow(self):
+        v = self.build_counter("foo", 1, n=1)
+        sub = self.db.subscribe("foo", maxsize=2)
+        for i in range(1, 5):
+            v.insert(Counter32(i * 3600, ROW_VALID, i))
+        self.assertEqual(sub.dropped, 2)
+        self.assertEqual([sub.get(0)[1].value for i in range(2)], [3, 4])
+
+        blocking = self.db.subscribe("foo", maxsize=1, overflow='block',
+                timeout=0.01)
+        v.insert(Counter32(5 * 3600, ROW_VALID, 5))
+        v.insert(Counter32(6 * 3600, ROW_VALID, 6))
+        self.assertEqual(blocking.dropped, 1)
+        self.assertEqual(blocking.get(0)[1].value, 5)
+
+    def testAggregate(self):
+        v = self.build_counter("foo", 1, n=10)
+        v.add_aggregate("1h", YYYYMMDDChunkMapper, ['average', 'delta'])
+        sub = self.db.subscribe("foo/TSDBAggregates/*")
+        v.update_all_aggregates()
+
+        # the slot holding LAST_UPDATE isn't final
+        rows = []
+        while True:
+            message = sub.get(0)
+            if message is None:
+                break
+            self.assertEqual(message[0], "foo/TSDBAggregates/3600")
+            rows.append(message[1].timestamp)
+        self.assertEqual(rows, [i * 3600 for i in range(9)])
+
+        v.insert(Counter32(10 * 3600, ROW_VALID, 10 * 3600))
+        v.update_all_aggregates()
+        self.assertEqual(sub.get(0)[1].timestamp, 9 * 3600)
+        self.assertEqual(sub.get(0), None)
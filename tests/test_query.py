@@ -0,0 +1,459 @@
+import unittest
+import os
+import os.path
+
+import numpy
+
+import tsdb.query
+import tsdb.expr
+import tsdb.sketch
+
+from tsdb import *
+from tsdb.row import *
+from tsdb.chunk_mapper import YYYYMMDDChunkMapper
+
+TESTDB = os.path.join(os.environ.get('TMPDIR', 'tmp'), 'querydb')
+
+class QueryTestCase(unittest.TestCase):
+    def setUp(self):
+        os.system("rm -rf " + TESTDB)
+        self.db = TSDB.create(TESTDB)
+
+    def tearDown(self):
+        os.system("rm -rf " + TESTDB)
+
+    def build_counter(self, name, rate, n=48, step=3600, rtype=Counter32,
+            skip=()):
+        """Build a counter which increases by rate per second."""
+        var = self.db.add_var(name, rtype, step, YYYYMMDDChunkMapper)
+        for i in range(n):
+            if i in skip:
+                continue
+            var.insert(rtype(i * step, ROW_VALID, i * rate * step))
+        var.flush()
+        return var
+
+class TestSelectArray(QueryTestCase):
+    def setUp(self):
+        QueryTestCase.setUp(self)
+        self.v = self.db.add_var("foo", Counter32, 60, YYYYMMDDChunkMapper)
+        for i in range(0, 86400 + 600, 60):
+            if i / 60 % 3 == 0:
+                continue
+            self.v.insert(Counter32(i + 7, ROW_VALID, i))
+
+    def testSameAsSelect(self):
+        """select_array returns the same rows as select across chunks."""
+        for (begin, end, flags) in ((None, None, None), (0, 600, None),
+                (86000, 86700, ROW_VALID), (30, 90, ROW_VALID)):
+            rows = list(self.v.select(begin, end, flags=flags))
+            a = self.v.select_array(begin, end, flags=flags)
+            self.assertEqual(len(rows), len(a))
+            for (row, x) in zip(rows, a):
+                self.assertEqual(row.timestamp, x['timestamp'])
+                self.assertEqual(row.flags, x['flags'])
+                self.assertEqual(row.value, x['value'])
+
+class TestSelectMatrix(QueryTestCase):
+    def setUp(self):
+        QueryTestCase.setUp(self)
+        self.build_counter("rtr/a/in", 1)
+        self.build_counter("rtr/a/out", 2, skip=(5,))
+        self.build_counter("rtr/b/in", 3, step=1800, n=96)
+
+    def testFindVars(self):
+        self.assertEqual(self.db.find_vars("rtr/*/in"),
+                ["rtr/a/in", "rtr/b/in"])
+        self.assertEqual(len(self.db.get_set("rtr").find_vars()), 3)
+
+    def testMatrix(self):
+        for threads in (None, 2):
+            (paths, ts, m, mask) = self.db.select_matrix("rtr/*", 0, 10*3600,
+                    threads=threads)
+            self.assertEqual(paths, ["rtr/a/in", "rtr/a/out", "rtr/b/in"])
+            self.assertEqual(list(ts), range(0, 10*3600 + 1, 3600))
+            self.assertEqual(m.shape, (3, 11))
+            self.assertEqual(list(m[0]), [x * 3600 for x in range(11)])
+            self.assertFalse(mask[1][5])
+            self.assertTrue(numpy.isnan(m[1][5]))
+            self.assertEqual(mask.sum(), 32)
+            # two 30 minute rows are averaged into each slot
+            self.assertEqual(m[2][1], 3 * (3600 + 5400) / 2.0)
+
+class TestChooseResolution(QueryTestCase):
+    def setUp(self):
+        QueryTestCase.setUp(self)
+        self.v = self.build_counter("foo", 5, n=24*14, step=300)
+        for agg in ("5m", "1h", "1d"):
+            self.v.add_aggregate(agg, YYYYMMDDChunkMapper, ['average', 'delta'])
+        self.v.update_all_aggregates()
+
+    def testChoose(self):
+        day = 24 * 3600
+        for (begin, end, max_points, step, expected) in (
+                (0, 3600, 100, None, self.v),
+                (0, day, 100, None, self.v.get_aggregate("1h")),
+                (0, day, 300, None, self.v),
+                (0, 14 * day, 200, None, self.v.get_aggregate("1d")),
+                (0, 14 * day, 400, None, self.v.get_aggregate("1h")),
+                (0, 365 * day, 200, None, self.v.get_aggregate("1d")),
+                (0, day, None, "2h", self.v.get_aggregate("1h")),
+                (0, day, None, None, self.v)):
+            self.assertTrue(expected is self.v.choose_resolution(begin, end,
+                max_points=max_points, step=step))
+
+    def testMaxPoints(self):
+        for (end, max_points) in ((3600, 13), (24 * 3600, 100),
+                (24 * 3600, 288), (14 * 24 * 3600, 200),
+                (14 * 24 * 3600, 400), (14 * 24 * 3600, 15)):
+            (var, a) = self.v.query_array(0, end, max_points=max_points)
+            self.assertTrue(len(a) <= max_points)
+
+    def testQuery(self):
+        (var, rows) = self.v.query(0, 12 * 3600, max_points=13)
+        self.assertTrue(var is self.v.get_aggregate("1h"))
+        rows = list(rows)
+        self.assertEqual(len(rows), 13)
+        self.assertEqual(rows[3].average, 5.0)
+
+        (var, a) = self.v.query_array(0, 12 * 3600, max_points=13)
+        self.assertEqual(list(a['average']), [r.average for r in rows])
+
+class TestDownsample(unittest.TestCase):
+    def setUp(self):
+        n = 10000
+        self.ts = numpy.arange(n) * 30
+        self.values = numpy.sin(numpy.arange(n) / 500.0)
+        self.values[4321] = 100.0
+        self.values[1234] = -100.0
+
+    def testLTTB(self):
+        (ts, values) = tsdb.query.lttb(self.ts, self.values, 500)
+        self.assertEqual(len(ts), 500)
+        self.assertEqual(ts[0], self.ts[0])
+        self.assertEqual(ts[-1], self.ts[-1])
+        self.assertTrue((numpy.diff(ts) > 0).all())
+        self.assertTrue(100.0 in values)
+        self.assertTrue(-100.0 in values)
+
+    def testMinMax(self):
+        (ts, values) = tsdb.query.minmax_envelope(self.ts, self.values, 500)
+        self.assertTrue(len(ts) <= 500)
+        self.assertTrue((numpy.diff(ts) > 0).all())
+        self.assertEqual(values.max(), 100.0)
+        self.assertEqual(values.min(), -100.0)
+
+    def testUnknownMethod(self):
+        rows = numpy.zeros(10, dtype=[('timestamp', 'u4'), ('flags', 'u4'),
+            ('value', 'f8')])
+        self.assertRaises(ValueError, tsdb.query.downsample, rows, 'value',
+                5, method='nearest')
+
+    def testShort(self):
+        for f in (tsdb.query.lttb, tsdb.query.minmax_envelope):
+            (ts, values) = f(self.ts[:10], self.values[:10], 20)
+            self.assertEqual(len(ts), 10)
+
+    def testInvalid(self):
+        dtype = Aggregate.dtype({'AGGREGATES': ['average']})
+        rows = numpy.zeros(4, dtype=dtype)
+        rows['timestamp'] = [0, 30, 60, 90]
+        rows['flags'] = [ROW_VALID, 0, ROW_VALID, ROW_VALID]
+        rows['average'] = [1.0, 2.0, numpy.nan, 4.0]
+        (ts, values) = tsdb.query.downsample(rows, 'average', 10)
+        self.assertEqual(list(ts), [0, 90])
+        self.assertEqual(list(values), [1.0, 4.0])
+
+class TestSelectDownsampled(QueryTestCase):
+    def testSelect(self):
+        v = self.build_counter("foo", 5, n=24*7*12, step=300)
+        v.add_aggregate("5m", YYYYMMDDChunkMapper, ['average', 'delta'])
+        v.update_all_aggregates()
+        for method in ('lttb', 'minmax'):
+            (var, ts, values) = v.select_downsampled(0, 6*24*3600, 100,
+                    method=method)
+            self.assertTrue(var is v.get_aggregate("5m"))
+            self.assertTrue(0 < len(ts) <= 100)
+            self.assertTrue((values == 5.0).all())
+
+class TestRate(QueryTestCase):
+    def testRate(self):
+        v = self.build_counter("foo", 5, n=48, step=60, skip=(10,))
+        (ts, rates) = v.rate(0, 30*60)
+        self.assertEqual(list(ts), [x * 60 for x in range(1, 31) if x != 10])
+        self.assertTrue((rates == 5.0).all())
+
+        (ts, rates) = v.rate(0, 30*60, heartbeat=60)
+        self.assertEqual(len(ts), 28)
+
+        (ts, rates) = v.rate(60, 120)
+        self.assertEqual(list(ts), [60, 120])
+
+    def testRolloverAndReset(self):
+        for rtype, maxval in (
+                (Counter32, 4294963596),
+                (Counter64, 18446744073709547916)):
+            t = self.db.add_var(rtype.__name__, rtype, 60, YYYYMMDDChunkMapper)
+            u = self.db.add_var(rtype.__name__ + "_uptime", TimeTicks, 60,
+                    YYYYMMDDChunkMapper)
+            for (ts, value, uptime) in ((0, maxval, 100), (60, 37, 6100),
+                    (120, 3637, 12100), (180, 600, 10)):
+                t.insert(rtype(ts, ROW_VALID, value))
+                u.insert(TimeTicks(ts, ROW_VALID, uptime))
+
+            (ts, rates) = t.rate(uptime_var=u)
+            self.assertEqual(list(rates), [3737 / 60.0, 60.0, 10.0])
+
+            (ts, rates) = t.rate(uptime_var=u, max_rate=61)
+            self.assertEqual(list(ts), [120, 180])
+
+            # without an uptime var a decrease is treated as a reset
+            (ts, rates) = t.rate()
+            self.assertEqual(list(rates), [37 / 60.0, 60.0, 10.0])
+
+    def testNotCounter(self):
+        v = self.db.add_var("gauge", Gauge32, 60, YYYYMMDDChunkMapper)
+        v.insert(Gauge32(0, ROW_VALID, 1))
+        self.assertRaises(TSDBVarIsNotCounter, v.rate)
+
+class TestExpression(QueryTestCase):
+    def setUp(self):
+        QueryTestCase.setUp(self)
+        self.build_counter("rtr/in", 1, n=24*8)
+        self.build_counter("rtr/out", 2, n=24*8, skip=(30,))
+        self.speed = self.db.add_var("rtr/speed", Gauge32, 3600,
+                YYYYMMDDChunkMapper)
+        for i in range(24*8):
+            self.speed.insert(Gauge32(i * 3600, ROW_VALID, 10))
+
+    def evaluate(self, s, begin=24*3600, end=48*3600):
+        return self.db.evaluate(s, begin, end, 3600)
+
+    def testArithmetic(self):
+        (ts, values) = self.evaluate(
+                '(rate("rtr/in") + rate("rtr/out")) * 8 / var("rtr/speed")')
+        self.assertEqual(list(ts), range(24*3600, 48*3600 + 1, 3600))
+        self.assertEqual(values[0], 2.4)
+        self.assertTrue(numpy.isnan(values[6]))
+        (ts, values) = self.evaluate('-var("rtr/speed") / 0 + 1')
+        self.assertTrue(numpy.isnan(values).all())
+
+    def testShift(self):
+        (ts, values) = self.evaluate('var("rtr/in") - shift(var("rtr/in"), "1d")')
+        self.assertTrue((values == 24*3600).all())
+
+    def testWindows(self):
+        (ts, values) = self.evaluate('mavg(rate("rtr/out"), 3)')
+        self.assertTrue((values == 2.0).all())
+        (ts, values) = self.evaluate('msum(fill(rate("rtr/out"), 0), 3)')
+        self.assertEqual(list(values[5:10]), [6.0, 4.0, 4.0, 4.0, 6.0])
+        (ts, values) = self.evaluate('ewma(rate("rtr/out"), 0.5)')
+        self.assertTrue((values == 2.0).all())
+        (ts, values) = self.evaluate('abs(-1)')
+        self.assertTrue((values == 1.0).all())
+
+    def testErrors(self):
+        for s in ('foo("rtr/in")', 'var(1)', 'var("rtr/in") ** 2',
+                'mavg(var("rtr/in"), 0)', 'var(', 'shift(var("x"))'):
+            self.assertRaises(ExpressionError, tsdb.expr.Expression, s)
+
+class TestTopN(QueryTestCase):
+    def setUp(self):
+        QueryTestCase.setUp(self)
+        for i in range(20):
+            v = self.build_counter("bb/rtr%d/in" % i, (i * 7) % 20, n=48)
+            if i % 2:
+                v.add_aggregate("1h", YYYYMMDDChunkMapper, ['average', 'delta'])
+                v.update_all_aggregates()
+        self.build_counter("bb/rtr0/out", 100, n=48)
+
+    def testTopN(self):
+        s = self.db.get_set("bb")
+        for threads in (None, 4):
+            top = s.top_n("*/in", 3600, 12*3600, 3, points=6, threads=threads)
+            self.assertEqual(top, [(19.0, "rtr17/in"), (18.0, "rtr14/in"),
+                (17.0, "rtr11/in")])
+
+        top = self.db.top_n("bb/*", 3600, 12*3600, 1, metric='max')
+        self.assertEqual(top, [(100.0, "bb/rtr0/out")])
+        self.assertEqual(self.db.top_n("nothing*", 0, 3600, 5), [])
+
+    def testOpenFiles(self):
+        if not os.path.isdir("/proc/self/fd"):
+            self.skipTest("needs /proc/self/fd")
+        # the chunks of every TSDBVar read aren't kept open
+        db = TSDB(TESTDB, mode="r")
+        fds = len(os.listdir("/proc/self/fd"))
+        db.top_n("bb/*", 0, 47*3600, 3, threads=4)
+        db.heatmap("bb/", 0, 47*3600, 3600, 5, range=(0, 20))
+        db.select_matrix("bb/*", 0, 47*3600)
+        self.assertEqual(len(os.listdir("/proc/self/fd")), fds)
+        self.assertEqual(db.vars, {})
+
+class TestHeatmap(QueryTestCase):
+    def testHeatmap(self):
+        for i in range(10):
+            v = self.build_counter("rtr/if%d/in" % i, i, n=24)
+            v.add_aggregate("1h", YYYYMMDDChunkMapper, ['average', 'delta'])
+            v.update_all_aggregates()
+        self.build_counter("rtr/if10/in", 100, n=24, skip=(4,))
+        self.build_counter("other/in", 5, n=24)
+
+        (ts, edges, h) = self.db.heatmap("rtr/", 3600, 10*3600, 3600, 5,
+                range=(0, 10))
+        self.assertEqual(list(ts), range(3600, 10*3600 + 1, 3600))
+        self.assertEqual(list(edges), [0, 2, 4, 6, 8, 10])
+        self.assertEqual(list(h[0]), [2, 2, 2, 2, 3])
+        self.assertEqual(list(h[3]), [2, 2, 2, 2, 2])
+
+        (ts, edges, h) = self.db.heatmap("rtr/", 3600, 10*3600, 3600,
+                [0, 50, 200], transform=lambda var, x: x * 2)
+        self.assertEqual(list(h[0]), [10, 1])
+
+class TestSummarize(QueryTestCase):
+    def setUp(self):
+        QueryTestCase.setUp(self)
+        self.v = self.db.add_var("foo", Gauge32, 3600, YYYYMMDDChunkMapper)
+        for i in range(24 * 5):
+            if i % 24 != 5:
+                self.v.insert(Gauge32(i * 3600, ROW_VALID, i))
+        self.v.flush()
+
+    def check(self, begin, end):
+        expected = [r.value for r in self.v.select(begin, end,
+            flags=ROW_VALID)]
+        s = self.v.summarize(begin, end)['value']
+        self.assertEqual(s['count'], len(expected))
+        self.assertEqual(s['sum'], sum(expected))
+        self.assertEqual(s['min'], min(expected))
+        self.assertEqual(s['max'], max(expected))
+
+    def testSummarize(self):
+        sidecar = os.path.join(TESTDB, "foo", "TSDBSummaries", "19700102")
+        self.check(None, None)
+        self.check(10 * 3600, 80 * 3600 + 1)
+        self.assertTrue(os.path.exists(sidecar))
+        # the newest chunk isn't sealed
+        self.assertFalse(os.path.exists(os.path.join(TESTDB, "foo",
+            "TSDBSummaries", "19700105")))
+
+        # a fresh TSDBVar uses the sidecar
+        del self.db.vars['foo']
+        self.v = self.db.get_var('foo')
+        os.utime(sidecar, None)
+        self.check(0, 3 * 24 * 3600)
+
+        self.v.insert(Gauge32(30 * 3600, ROW_VALID, 1000))
+        self.check(0, 3 * 24 * 3600)
+        self.v.flush()
+        self.assertFalse(os.path.exists(sidecar))
+        self.check(0, 3 * 24 * 3600)
+
+    def testUnflushed(self):
+        self.check(0, 3 * 24 * 3600)
+        self.v.insert(Gauge32(30 * 3600, ROW_VALID, 100))
+        self.check(0, 3 * 24 * 3600)
+        self.v.insert(Gauge32(31 * 3600, ROW_VALID, 1000))
+        self.check(0, 3 * 24 * 3600)
+        self.assertEqual(self.v.summarize(0, 3 * 24 * 3600)['value']['max'],
+                1000)
+
+    def testAggregate(self):
+        v = self.build_counter("bar", 5, n=24 * 4)
+        v.add_aggregate("1h", YYYYMMDDChunkMapper, ['average', 'delta'])
+        v.update_all_aggregates()
+        s = v.get_aggregate("1h").summarize(24 * 3600, 48 * 3600 - 1)
+        self.assertEqual(s['delta'], dict(count=24, sum=24 * 5 * 3600.0,
+            min=5 * 3600.0, max=5 * 3600.0))
+
+class TestMergedAggregates(QueryTestCase):
+    def setUp(self):
+        QueryTestCase.setUp(self)
+        # a counter with a different rate every hour for 20 days
+        self.v = self.db.add_var("foo", Counter32, 3600, YYYYMMDDChunkMapper)
+        value = 0
+        for i in range(24 * 20):
+            self.v.insert(Counter32(i * 3600, ROW_VALID, value))
+            value += ((i * 37) % 101 + 1) * 3600
+        self.v.flush()
+        for step in ("1h", "6h", "1d"):
+            self.v.add_aggregate(step, YYYYMMDDChunkMapper, ['average',
+                'delta', 'sketch', 'count', 'sumsq'])
+        self.v.update_all_aggregates()
+
+    def testSketch(self):
+        values = numpy.arange(1, 1001, dtype=float)
+        s = tsdb.sketch.sketch(values[:500]) + tsdb.sketch.sketch(values[500:])
+        for q in (1, 50, 95, 100):
+            exact = tsdb.sketch.exact_percentile(values, q)
+            self.assertAlmostEqual(tsdb.sketch.sketch_quantile(s, q) / exact,
+                    1, delta=tsdb.sketch.SKETCH_ACCURACY)
+        self.assertEqual(tsdb.sketch.exact_percentile(values, 95), 950)
+        self.assertTrue(numpy.isnan(tsdb.sketch.sketch_quantile(
+            tsdb.sketch.empty_sketch(), 50)))
+
+    def testSketchStorage(self):
+        """Only the coarser aggregates store sketches, as pairs."""
+        hour = self.v.get_aggregate("1h")
+        self.assertFalse('sketch' in hour.metadata['AGGREGATES'])
+        self.assertEqual(hour.rowsize(), 40)
+        self.assertEqual(self.v.get_aggregate("6h").metadata['SKETCH_SIZE'],
+                6)
+        day = self.v.get_aggregate("1d")
+        self.assertEqual(day.metadata['SKETCH_SIZE'], 24)
+        self.assertEqual(day.rowsize(), 40 + 24 * 6)
+
+    def testAggregateSketch(self):
+        """Coarser sketches are the merge of the finer ones."""
+        # the 1d row at t holds the 6h rows after t, which hold the 1h rows
+        # after them
+        day = self.v.get_aggregate("1d").get(86400)
+        hours = self.v.get_aggregate("1h").select_array(86400 + 7 * 3600,
+                2 * 86400 + 7 * 3600 - 1)
+        self.assertEqual(day.sketch.sum(), 24)
+        self.assertTrue(numpy.array_equal(day.sketch,
+            tsdb.sketch.sketch(hours['average'])))
+
+    def testPercentile(self):
+        for (begin, end) in ((None, None), (5 * 3600, 17 * 86400 + 7 * 3600),
+                (86400, 3 * 86400 - 1), (3600, 7200)):
+            for q in (5, 50, 95):
+                exact = self.v.percentile(q, begin, end, exact=True)
+                estimate = self.v.percentile(q, begin, end)
+                self.assertAlmostEqual(estimate / exact, 1,
+                        delta=tsdb.sketch.SKETCH_ACCURACY)
+
+        self.assertEqual(self.v.percentile(100, 3600, 7200, exact=True), 75)
+        self.assertTrue(numpy.isnan(self.v.percentile(50, 1e9, 2e9)))
+
+    def testPercentileBelowOne(self):
+        """Sketches don't hold values below 1, those are read exactly."""
+        v = self.db.add_var("slow", Counter32, 3600, YYYYMMDDChunkMapper)
+        value = 0
+        for i in range(24 * 4):
+            v.insert(Counter32(i * 3600, ROW_VALID, value))
+            value += ((i * 37) % 101) * 35
+        v.flush()
+        for step in ("1h", "6h", "1d"):
+            v.add_aggregate(step, YYYYMMDDChunkMapper, ['average',
+                'delta', 'sketch', 'count', 'sumsq'])
+        v.update_all_aggregates()
+
+        for q in (5, 50, 95):
+            self.assertEqual(v.percentile(q), v.percentile(q, exact=True))
+        self.assertTrue(0 < v.percentile(50) < 1)
+
+    def testMoments(self):
+        for (begin, end) in ((None, None), (5 * 3600, 17 * 86400 + 7 * 3600),
+                (86400, 3 * 86400 - 1), (3600, 7200)):
+            values = [r.average for r in self.v.get_aggregate("1h").select(
+                begin, end, flags=ROW_VALID)]
+            m = self.v.moments(begin, end)
+            self.assertEqual(m['count'], len(values))
+            self.assertAlmostEqual(m['mean'], numpy.mean(values))
+            self.assertAlmostEqual(m['variance'], numpy.var(values), places=6)
+            self.assertAlmostEqual(m['stddev'], numpy.std(values))
+
+        day = self.v.get_aggregate("1d").get(86400)
+        self.assertEqual(day.count, 24)
+        self.assertTrue(numpy.isnan(self.v.moments(1e9, 2e9)['mean']))
@@ -0,0 +1,112 @@
+import threading
+
+import numpy
+
+from tsdb import *
+from tsdb.row import *
+from tsdb.explain import QueryLimits, QueryStats, CancelToken
+from tsdb.reader import AsyncReader, Future, gather
+
+from test_query import QueryTestCase, TESTDB
+
+class TestFuture(QueryTestCase):
+    def testFuture(self):
+        f = Future()
+        seen = []
+        f.add_done_callback(seen.append)
+        self.assertFalse(f.done())
+        self.assertRaises(TSDBTimeoutError, f.result, 0.01)
+        f.set_result(42)
+        self.assertEqual(seen, [f])
+        self.assertEqual(f.result(), 42)
+
+        g = Future()
+        combined = gather([f, g])
+        g.set_exception(TSDBVarEmpty("empty"))
+        self.assertRaises(TSDBVarEmpty, combined.result, 1)
+
+    def testGatherRace(self):
+        """Only the first failure finishes the combined Future."""
+        futures = [Future() for i in range(50)]
+        combined = gather(futures)
+        seen = []
+        combined.add_done_callback(seen.append)
+        start = threading.Event()
+        def fail(f, i):
+            start.wait()
+            f.set_exception(TSDBVarEmpty(i))
+        threads = [threading.Thread(target=fail, args=(f, i)) for (i, f) in
+                enumerate(futures)]
+        for t in threads:
+            t.start()
+        start.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(seen, [combined])
+        self.assertTrue(isinstance(combined.exception(), TSDBVarEmpty))
+
+class TestAsyncReader(QueryTestCase):
+    def setUp(self):
+        QueryTestCase.setUp(self)
+        self.v = self.build_counter("foo", 1, n=24 * 3, skip=(70, 71))
+        self.reader = AsyncReader(self.db, threads=2)
+
+    def tearDown(self):
+        self.reader.close()
+        QueryTestCase.tearDown(self)
+
+    def testSelectArray(self):
+        for (begin, end, flags) in ((None, None, None), (3600, 30 * 3600,
+                ROW_VALID), (86400, 86400 + 7200, None)):
+            expected = self.v.select_array(begin, end, flags=flags)
+            rows = self.reader.select_array("foo", begin, end,
+                    flags=flags).result(5)
+            self.assertTrue(numpy.array_equal(rows, expected))
+
+        # the last two rows are after the newest data
+        futures = self.reader.iter_select_array("foo")
+        self.assertEqual([len(f.result(5)) for f in futures], [24, 24, 22])
+
+    def testStream(self):
+        self.assertEqual([len(x) for x in self.reader.stream_select_array(
+            "foo", window=2, timeout=5)], [24, 24, 22])
+
+        # nothing is read past the window, or after the stream is closed
+        reads = self.reader.reads
+        chunks = self.reader.stream_select_array("foo", window=1, timeout=5)
+        self.assertEqual(len(chunks.next()), 24)
+        self.assertEqual(self.reader.reads, reads + 1)
+        chunks.close()
+        self.assertEqual(self.reader.reads, reads + 1)
+
+    def testCancel(self):
+        # chunks not yet being read when the query is cancelled aren't read
+        busy = threading.Event()
+        blockers = [self.reader.submit(busy.wait, 5) for i in range(2)]
+        reads = self.reader.reads
+        cancel = CancelToken()
+        futures = self.reader.iter_select_array("foo",
+                stats=QueryStats(QueryLimits(cancel=cancel)))
+        cancel.cancel()
+        busy.set()
+        for f in futures:
+            self.assertRaises(TSDBQueryCancelledError, f.result, 5)
+        self.assertEqual(self.reader.reads, reads)
+        self.assertEqual(self.reader.pending, {})
+
+    def testCoalesce(self):
+        futures = [self.reader.select_array("foo") for i in range(10)]
+        results = [f.result(5) for f in futures]
+        self.assertTrue(self.reader.reads < 30)
+        self.assertEqual(len(self.reader.get_many(["foo"], 0, 3600).result(
+            5)["foo"]), 2)
+
+    def testLatest(self):
+        row = self.reader.latest("foo").result(5)
+        self.assertEqual(row['timestamp'][0], 69 * 3600)
+
+        v = self.db.add_var("bar", Counter32, 3600, YYYYMMDDChunkMapper)
+        v.insert(Counter32(86400 * 2, 0, 1))
+        v.flush()
+        self.assertRaises(TSDBVarNoValidData,
+                self.reader.latest("bar").result, 5)
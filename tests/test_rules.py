@@ -0,0 +1,61 @@
+import Queue
+
+from tsdb import *
+from tsdb.row import *
+from tsdb.rules import Rule, RuleEvent, RULE_FIRING, RULE_RESOLVED
+
+from test_query import QueryTestCase
+
+class TestRules(QueryTestCase):
+    def testValue(self):
+        v = self.build_counter("rtr/a/in", 1, n=1, rtype=Gauge32)
+        events = []
+        rule = Rule("high", "rtr/*/in", "value", ">", 10, duration=120)
+        self.db.add_rules([rule], events.append)
+
+        for (t, value) in [(60, 20), (120, 5), (180, 11), (240, 12),
+                (300, 13), (360, 14), (420, 0)]:
+            v.insert(Gauge32(t, ROW_VALID, value))
+        v.insert(Gauge32(480, 0, 100))
+
+        self.assertEqual(events, [
+            RuleEvent("high", "rtr/a/in", RULE_FIRING, 300, 13),
+            RuleEvent("high", "rtr/a/in", RULE_RESOLVED, 420, 0)])
+        self.assertEqual(rule.firing(), [])
+
+    def testRate(self):
+        a = self.build_counter("rtr/a/in", 1, n=2, step=60)
+        b = self.build_counter("rtr/b/in", 1, n=2, step=60)
+        rule = Rule("busy", "rtr/*/in", "rate", ">=", 10)
+        events = Queue.Queue()
+        rules = self.db.add_rules([rule], events)
+
+        a.insert(Counter32(120, ROW_VALID, 60 + 600))
+        b.insert(Counter32(120, ROW_VALID, 120))
+        a.insert(Counter32(180, ROW_VALID, 660 + 600))
+        self.assertEqual(events.get_nowait(),
+                RuleEvent("busy", "rtr/a/in", RULE_FIRING, 180, 10.0))
+        self.assertTrue(events.empty())
+        self.assertEqual(rule.firing(), ["rtr/a/in"])
+
+        # a counter reset counts from zero
+        a.insert(Counter32(240, ROW_VALID, 30))
+        self.assertEqual(events.get_nowait().state, RULE_RESOLVED)
+        self.assertEqual(rules.events, 2)
+
+        rules.close()
+        a.insert(Counter32(300, ROW_VALID, 30000))
+        self.assertTrue(events.empty())
+
+    def testAggregate(self):
+        v = self.build_counter("foo", 1, n=4)
+        v.add_aggregate("1h", YYYYMMDDChunkMapper, ['average', 'delta'])
+        events = []
+        self.db.add_rules([Rule("avg", "foo/TSDBAggregates/3600", "average",
+            "==", 1)], events.append)
+        v.update_all_aggregates()
+        self.assertEqual([(x.state, x.timestamp) for x in events],
+                [(RULE_FIRING, 0)])
+
+    def testBadOperator(self):
+        self.assertRaises(ValueError, Rule, "x", "*", "value", "=~", 1)
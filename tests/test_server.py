@@ -0,0 +1,127 @@
+import json
+import socket
+import threading
+import urllib2
+
+from tsdb import *
+from tsdb.row import *
+from tsdb.cache import QueryCache, LRUCache
+from tsdb.explain import QueryLimits
+from tsdb.server import TSDBServer
+
+from test_query import QueryTestCase, TESTDB
+
+class TestServer(QueryTestCase):
+    def setUp(self):
+        QueryTestCase.setUp(self)
+        v = self.build_counter("rtr/a/in", 1, n=72)
+        v.add_aggregate("1h", YYYYMMDDChunkMapper, ['average', 'delta'])
+        v.add_aggregate("1d", YYYYMMDDChunkMapper, ['average', 'delta'])
+        v.update_all_aggregates()
+        self.build_counter("rtr/a/out", 2, skip=(47, ))
+
+        db = TSDB(TESTDB, mode="r",
+                cache=QueryCache([LRUCache(1024 * 1024)]))
+        self.server = TSDBServer(("127.0.0.1", 0), db, threads=2,
+                watch_interval=0.05, limits=QueryLimits(max_rows=50))
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        QueryTestCase.tearDown(self)
+
+    def get(self, path):
+        url = "http://127.0.0.1:%d%s" % (self.server.server_address[1], path)
+        try:
+            return (200, json.load(urllib2.urlopen(url)))
+        except urllib2.HTTPError, e:
+            return (e.code, json.load(e))
+
+    def testList(self):
+        self.assertEqual(self.get("/list?pattern=rtr/*")[1]['vars'],
+                ["rtr/a/in", "rtr/a/out"])
+
+    def testSelect(self):
+        (status, r) = self.get("/select?var=rtr/a/in&begin=0&end=7200")
+        self.assertEqual(status, 200)
+        self.assertEqual(r['fields'], ['timestamp', 'flags', 'value'])
+        self.assertEqual(r['rows'], [[0, 1, 0], [3600, 1, 3600],
+            [7200, 1, 7200]])
+
+        # served again from the cache
+        self.assertEqual(self.get("/select?var=rtr/a/in&begin=0&end=7200")[1],
+                r)
+        self.assertEqual(self.server.db.cache.hits, 1)
+
+        (status, r) = self.get("/select?var=rtr/a/in&begin=0&end=172800"
+                "&points=2")
+        self.assertEqual(r['var'], "rtr/a/in/TSDBAggregates/86400")
+        self.assertEqual(r['rows'][1][:3], [86400, 1, 1.0])
+
+        self.assertEqual(self.get("/resolution?var=rtr/a/in&begin=0"
+            "&end=172800&step=1h")[1]['step'], 3600)
+
+    def testLatestAndSummary(self):
+        r = self.get("/latest?var=rtr/a/out")[1]
+        self.assertEqual(r['row'], {'timestamp': 46 * 3600, 'flags': 1,
+            'value': 2 * 46 * 3600})
+
+        r = self.get("/summary?var=rtr/a/out&begin=0&end=7200")[1]
+        self.assertEqual(r['summary'], {'value': {'count': 3, 'sum': 21600,
+            'min': 0, 'max': 14400}})
+
+    def testErrorWhileStreaming(self):
+        select_parts = self.server.select_parts
+        def cancelling(var, begin, end, flags, limits=None):
+            parts = select_parts(var, begin, end, flags, limits)
+            yield parts.next()
+            limits.cancel.cancel()
+            for rows in parts:
+                yield rows
+        self.server.select_parts = cancelling
+
+        # the status has gone out, the error ends the rows
+        (status, r) = self.get("/select?var=rtr/a/in&begin=0&end=93600")
+        self.assertEqual(status, 200)
+        self.assertEqual(len(r['rows']), 24)
+        self.assertEqual(r['error'], "query cancelled")
+
+    def testErrors(self):
+        self.assertEqual(self.get("/select?var=nope")[0], 404)
+        self.assertEqual(self.get("/select")[0], 400)
+        self.assertEqual(self.get("/select?var=rtr/a/in&begin=x&end=1")[0],
+                400)
+        self.assertEqual(self.get("/frob")[0], 404)
+
+        (status, r) = self.get("/select?var=rtr/a/in&begin=0&end=259200")
+        self.assertEqual(status, 400)
+        self.assertEqual(r['error'], "query would read more than 50 rows")
+
+    def testTail(self):
+        # urllib2 buffers the body, so read the stream from the socket
+        sock = socket.create_connection(self.server.server_address, 5)
+        sock.sendall("GET /tail?pattern=rtr/*/out HTTP/1.0\r\n\r\n")
+        stream = sock.makefile("rb", 0)
+        self.assertTrue(stream.readline().startswith("HTTP/1.0 200"))
+        while stream.readline() != "\r\n":
+            pass
+        self.assertEqual(stream.readline(), "\n")
+
+        # written by another process
+        db = TSDB(TESTDB)
+        v = db.get_var("rtr/a/out")
+        v.insert(Counter32(48 * 3600, ROW_VALID, 1))
+        v.insert(Counter32(49 * 3600, 0, 2))
+        v.flush()
+        db.get_var("rtr/a/in").insert(Counter32(72 * 3600, ROW_VALID, 1))
+        db.get_var("rtr/a/in").flush()
+
+        line = stream.readline()
+        while line == "\n":
+            line = stream.readline()
+        self.assertEqual(json.loads(line), {'var': "rtr/a/out", 'row':
+            {'timestamp': 48 * 3600, 'flags': 1, 'value': 1}, 'dropped': 0})
+        sock.close()
@@ -0,0 +1,59 @@
+import os
+import os.path
+
+import numpy
+
+from tsdb import *
+from tsdb.row import *
+from tsdb.trend import fit_trends, fit_var_trends, save_trends, load_trends
+
+from test_query import QueryTestCase
+
+DAY = 24 * 3600
+
+def test_fit_trends():
+    timestamps = numpy.arange(28) * DAY
+    t = numpy.arange(28)
+    weekly = numpy.array([0, 0, 0, 0, 0, -10, -10])[t % 7]
+    matrix = numpy.vstack([10 + 2.0 * t, 100 - t + weekly, 5 + 0 * t])
+    mask = numpy.ones(matrix.shape, dtype=bool)
+    mask[0, 3] = False
+    matrix[0, 3] = numpy.nan
+
+    fits = fit_trends(timestamps, matrix, mask, threshold=[100, 100, 100])
+    assert abs(fits['slope'][0] * DAY - 2.0) < 1e-9
+    assert abs(fits['intercept'][0] - 10.0) < 1e-9
+    assert abs(fits['r2'][0] - 1.0) < 1e-9
+    assert fits['points'][0] == 27
+    assert abs(fits['projected'][0] - 45 * DAY) < 1e-3
+    assert numpy.isnan(fits['projected'][1])
+    assert numpy.isnan(fits['projected'][2])
+
+    fits = fit_trends(timestamps, matrix, mask, season=7)
+    assert abs(fits['slope'][1] * DAY + 1.0) < 1e-6
+    assert abs(fits['r2'][1] - 1.0) < 1e-6
+
+class TestFitVarTrends(QueryTestCase):
+    def testFit(self):
+        for i in range(5):
+            v = self.build_counter("rtr/if%d/in" % i, i + 1, n=24*30)
+            v.add_aggregate("1h", YYYYMMDDChunkMapper, ['average', 'delta'])
+            v.add_aggregate("1d", YYYYMMDDChunkMapper, ['average', 'delta'])
+            v.update_all_aggregates()
+        self.build_counter("rtr/noagg/in", 1)
+
+        (paths, fits) = fit_var_trends(self.db, "rtr/*", DAY, 20 * DAY,
+                batch=2, threshold={"rtr/if4/in": 10})
+        self.assertEqual(paths, ["rtr/if%d/in" % i for i in range(5)])
+        self.assertEqual(list(fits['intercept']), [1.0, 2.0, 3.0, 4.0, 5.0])
+        self.assertEqual(list(fits['slope']), [0.0] * 5)
+        self.assertEqual(list(fits['points']), [20] * 5)
+        self.assertTrue(numpy.isnan(fits['projected']).all())
+
+        filename = os.path.join(os.environ.get('TMPDIR', 'tmp'), 'trends.npz')
+        save_trends(filename, paths, fits)
+        (paths2, fits2) = load_trends(filename)
+        os.unlink(filename)
+        self.assertEqual(paths, paths2)
+        for name in fits.dtype.names:
+            numpy.testing.assert_equal(fits[name], fits2[name])
@@ -5,6 +5,8 @@ import stat
 import time
 import random
 
+import numpy
+
 import nose.tools
 
 from tsdb import *
@@ -12,6 +14,7 @@ from tsdb.row import *
 from tsdb.error import *
 from tsdb.chunk_mapper import YYYYMMDDChunkMapper, YYYYMMChunkMapper, CHUNK_MAPPER_MAP
 from tsdb.util import calculate_interval, calculate_slot
+from tsdb.sketch import sketch, SKETCH_BUCKETS
 
 TESTDB = os.path.join(os.environ.get('TMPDIR', 'tmp'), 'testdb')
 
@@ -140,6 +143,116 @@ class TestMetadata(TSDBVarTestCase):
     def testStep(self):
         self.assertEqual(self.v.metadata['STEP'], 60)
 
+class TestSnapshot(TSDBVarTestCase):
+    def testAtomicMetadata(self):
+        self.v.flush()
+        generation = self.v.metadata['GENERATION']
+        self.v.flush()
+        self.assertEqual(self.v.metadata['GENERATION'], generation + 1)
+        self.assertEqual([x for x in os.listdir(os.path.join(TESTDB, "blort"))
+            if ".tmp." in x], [])
+
+    def testSnapshot(self):
+        for i in range(10):
+            self.v.insert(Counter32(i * 60, ROW_VALID, i))
+        self.v.flush()
+
+        # another process reading while this one writes
+        reader = TSDB(TESTDB, mode="r").get_var("blort")
+        snapshot = reader.snapshot()
+        self.assertEqual(snapshot.end, 9 * 60)
+
+        self.v.insert(Counter32(10 * 60, ROW_VALID, 10))
+        self.assertEqual(len(snapshot.select_array()), 10)
+        self.assertEqual(reader.snapshot().generation, snapshot.generation)
+        self.v.flush()
+        newer = reader.snapshot()
+        self.assertEqual(newer.generation, snapshot.generation + 1)
+        self.assertEqual(len(newer.select_array(0, 3600)), 11)
+        self.assertEqual([x.value for x in snapshot.select(0, 3600)],
+                range(10))
+
+    def testUnflushedSnapshot(self):
+        for i in range(10):
+            self.v.insert(Counter32(i * 60, ROW_VALID, i))
+        self.v.flush()
+        for i in range(10, 20):
+            self.v.insert(Counter32(i * 60, ROW_VALID, i))
+
+        # the saved metadata doesn't describe the unflushed rows
+        self.assertEqual(self.v.snapshot().end, 19 * 60)
+        self.assertEqual(self.v.metadata['MAX_TIMESTAMP'], 19 * 60)
+        self.v.flush()
+        reader = TSDB(TESTDB, mode="r").get_var("blort")
+        self.assertEqual(len(reader.select_array(0, 3600,
+            flags=ROW_VALID)), 20)
+
+    def testAggregateSnapshot(self):
+        for i in range(10):
+            self.v.insert(Counter32(i * 60, ROW_VALID, i * 60))
+        self.v.add_aggregate("60", YYYYMMDDChunkMapper, ['average', 'delta'])
+        self.v.update_all_aggregates()
+
+        # the slot holding LAST_UPDATE may still change
+        agg = TSDB(TESTDB, mode="r").get_var("blort").get_aggregate("60")
+        rows = agg.snapshot().select_array()
+        self.assertEqual(rows['timestamp'][-1], 8 * 60)
+
+class TestReadOnly(TSDBVarTestCase):
+    def setUp(self):
+        TSDBVarTestCase.setUp(self)
+        for i in range(10):
+            self.v.insert(Counter32(i * 60, ROW_VALID, i))
+        self.v.flush()
+        self.db = TSDB(TESTDB, mode="r")
+        self.reader = self.db.get_var("blort")
+
+    def listdir(self):
+        return sorted(os.listdir(os.path.join(TESTDB, "blort")))
+
+    def testNoWrites(self):
+        files = self.listdir()
+        metadata = open(os.path.join(TESTDB, "blort", "TSDBVar")).read()
+
+        del self.reader.metadata['MIN_TIMESTAMP']
+        del self.reader.metadata['MAX_TIMESTAMP']
+        self.assertEqual(self.reader.min_timestamp(), 0)
+        self.assertEqual(self.reader.get(60).value, 1)
+        self.assertEqual(self.reader.chunks["19700101"].file.mode, "rb")
+        self.reader.summarize()
+        self.reader.close()
+
+        self.assertEqual(self.listdir(), files)
+        self.assertEqual(open(os.path.join(TESTDB, "blort",
+            "TSDBVar")).read(), metadata)
+
+    def testWritesFail(self):
+        self.assertRaises(TSDBReadOnlyError, self.reader.insert,
+                Counter32(60, ROW_VALID, 37))
+        self.assertRaises(TSDBReadOnlyError, self.reader.insert,
+                Counter32(48 * 3600, ROW_VALID, 37))
+        self.assertRaises(TSDBReadOnlyError, self.reader.flush)
+        self.assertRaises(TSDBReadOnlyError, self.db.add_var, "foo",
+                Counter32, 60, YYYYMMDDChunkMapper)
+        self.assertRaises(TSDBReadOnlyError, self.reader.add_aggregate,
+                "60", YYYYMMDDChunkMapper, ['average'])
+        self.assertEqual(self.listdir(), ["19700101", "TSDBVar"])
+        self.assertEqual(self.reader.get(60).value, 1)
+
+    def testRefresh(self):
+        self.assertEqual(self.reader.all_chunks(), ["19700101"])
+        self.assertEqual(self.reader.get(60).value, 1)
+
+        self.v.insert(Counter32(60, ROW_VALID, 37))
+        self.v.insert(Counter32(24 * 3600, ROW_VALID, 38))
+        self.v.flush()
+
+        self.reader.refresh()
+        self.assertEqual(self.reader.all_chunks(), ["19700101", "19700102"])
+        self.assertEqual(self.reader.max_timestamp(), 24 * 3600)
+        self.assertEqual(self.reader.get(60).value, 37)
+        self.assertEqual(self.reader.get(24 * 3600).value, 38)
+
 class TestCaching(TSDBVarTestCase):
     def testNoCaching(self):
         v = self.db.get_var("blort")
@@ -268,6 +381,48 @@ class TestSelect(TSDBVarTestCase):
             self.assertEqual(self.vars[i*2], x)
             i += 1
 
+class TestMmap(TSDBVarTestCase):
+    def setUp(self):
+        TSDBVarTestCase.setUp(self)
+        for i in range(100):
+            self.v.insert(Counter32(i * 60, ROW_VALID, i))
+        self.v.add_aggregate("60", YYYYMMDDChunkMapper, ['average', 'sketch'])
+        self.v.update_all_aggregates()
+        self.v.flush()
+        self.reader = TSDB(TESTDB, mode="r").get_var("blort", use_mmap=True)
+
+    def testReadRow(self):
+        self.assertEqual(self.reader.get(600), self.v.get(600))
+        self.assertEqual([x.value for x in self.reader.select(0, 599)],
+                range(10))
+
+        agg = self.reader.get_aggregate("60")
+        agg.use_mmap = True
+        self.assertEqual(str(agg.get(600)),
+                str(self.v.get_aggregate("60").get(600)))
+
+    def testReadArray(self):
+        rows = self.reader.select_array(0, 99 * 60)
+        self.assertEqual(list(rows['value']), range(100))
+
+        chunk = self.reader._chunk(0)
+        self.assertFalse(chunk.writable)
+        rows = chunk.read_array(0, 99 * 60)
+        self.assertFalse(rows.flags.writeable)
+        self.assertEqual(list(rows['value']), range(100))
+
+        # the rows outlive the chunk
+        chunk.close()
+        self.assertEqual(list(rows['value']), range(100))
+
+    def testReadOnly(self):
+        self.reader.prefetch()
+        chunk = self.reader._chunk(0)
+        chunk.flush()
+        self.assertRaises(TypeError, chunk.write_row,
+                Counter32(0, ROW_VALID, 1))
+        self.assertEqual(self.v.get(0).value, 0)
+
 class TestData(TSDBTestCase):
     ts = 1184863723
     step = 60
@@ -517,6 +672,30 @@ class TestTSDBRows(unittest.TestCase):
         agg1 = Aggregate.unpack(agg0.pack(m), m)
         print agg1
         assert agg0 == agg1
+        # the sketch isn't allocated unless it is used
+        assert agg1._sketch is None
+        assert not agg0 == Aggregate(1, 1, average=1, delta=2, min=3, max=4,
+                sketch=sketch([1]))
+
+        m = {'AGGREGATES': ['average','delta','min','max','sketch']}
+        agg0 = Aggregate(1, 1, average=1, delta=2, min=3, max=4,
+                sketch=sketch([1, 2, 2, 50]))
+        agg1 = Aggregate.unpack(agg0.pack(m), m)
+        assert agg0 == agg1
+        assert Aggregate.size(m) == 40 + 4 * SKETCH_BUCKETS
+
+        m['SKETCH_SIZE'] = 4
+        agg1 = Aggregate.unpack(agg0.pack(m), m)
+        assert agg0 == agg1
+        assert Aggregate.size(m) == 40 + 6 * 4
+        assert Aggregate.dtype(m).itemsize == Aggregate.size(m)
+
+        # too many buckets for the pairs are merged
+        m['SKETCH_SIZE'] = 2
+        agg1 = Aggregate.unpack(agg0.pack(m), m)
+        assert agg1.sketch.sum() == 4
+        assert list(numpy.flatnonzero(agg1.sketch)) == \
+                list(numpy.flatnonzero(sketch([2, 50])))
 
 class TestNonDecreasing(TSDBTestCase):
     def testReset(self):
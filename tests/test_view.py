@@ -0,0 +1,65 @@
+import numpy
+
+from tsdb import *
+from tsdb.row import *
+
+from test_query import QueryTestCase
+
+class TestVarView(QueryTestCase):
+    def setUp(self):
+        QueryTestCase.setUp(self)
+        # days 0, 1 and 3, day 2 has no chunk
+        self.var = self.build_counter("foo", 1, n=96, skip=range(48, 72) + [5])
+        self.view = self.var.view()
+
+    def tearDown(self):
+        self.view.close()
+        QueryTestCase.tearDown(self)
+
+    def testIndex(self):
+        self.assertEqual(len(self.view), 96)
+        self.assertEqual(self.view.begin, 0)
+        self.assertEqual(self.view.index(3 * 3600 + 59), 3)
+        self.assertEqual(self.view.timestamp(3), 3 * 3600)
+
+        self.assertEqual(self.view[4]['value'], 4 * 3600)
+        self.assertEqual(self.view[-1]['timestamp'], 95 * 3600)
+        self.assertEqual(self.view[5]['flags'], 0)
+        self.assertRaises(IndexError, self.view.__getitem__, 96)
+
+    def testSlice(self):
+        rows = self.view[:]
+        self.assertEqual(len(rows), 96)
+        valid = rows['flags'] & ROW_VALID != 0
+        self.assertEqual(valid.sum(), 96 - 25)
+        self.assertTrue(numpy.all(rows['value'][valid] ==
+            rows['timestamp'][valid]))
+        self.assertTrue(numpy.all(rows[48:72] == numpy.zeros(24,
+            dtype=self.var.dtype)))
+
+        # within a chunk the rows are a view of the mapped file
+        rows = self.view[26:30]
+        self.assertTrue(isinstance(rows, numpy.memmap))
+        self.assertEqual(list(rows['timestamp']), [26 * 3600, 27 * 3600,
+            28 * 3600, 29 * 3600])
+
+        # slot 50 is in the missing chunk
+        self.assertEqual(list(self.view[90:2:-40]['timestamp']),
+                [90 * 3600, 0, 10 * 3600])
+        self.assertEqual(list(self.view[0:10:4]['value']), [0, 4 * 3600,
+            8 * 3600])
+        self.assertEqual(len(self.view[10:5]), 0)
+
+    def testSelect(self):
+        selected = self.var.select_array(20 * 3600, 80 * 3600)
+        rows = self.view.select(20 * 3600, 80 * 3600)
+        valid = rows['flags'] & ROW_VALID != 0
+        self.assertTrue(numpy.all(rows[valid] ==
+            selected[selected['flags'] & ROW_VALID != 0]))
+        self.assertEqual(len(self.view.select(-3600, 10 ** 9)), 96)
+
+    def testFlushedWrites(self):
+        self.view[0]
+        self.var.insert(Counter32(0, ROW_VALID, 7))
+        self.var.flush()
+        self.assertEqual(self.view[0]['value'], 7)
@@ -5,6 +5,7 @@ import time
 
 from tsdb.error import *
 from tsdb.row import Aggregate, ROW_VALID, ROW_TYPE_MAP
+from tsdb.sketch import sketch
 
 class Aggregator(object):
     """Calculate Aggregates.
@@ -218,11 +219,16 @@ class Aggregator(object):
             prev = curr
 
 
+        keep_sketch = 'sketch' in self.agg.metadata['AGGREGATES']
         for row in self.agg.select(begin=last_update, flags=ROW_VALID):
             if row.delta != 0:
                 row.average = float(row.delta) / step
             else:
                 row.average = 0.0
+            if keep_sketch:
+                row.sketch = sketch([row.average])
+            row.count = 1
+            row.sumsq = row.average ** 2
             self.agg.insert(row)
 
         self.agg.metadata['LAST_UPDATE'] = prev.timestamp
@@ -251,6 +257,14 @@ class Aggregator(object):
         # fill as many bins as possible
         work = list(itertools.islice(data, 0, steps_needed))
 
+        # sketches are merged from the ancestor if it has them, otherwise
+        # they are built from the ancestor's averages
+        keep_sketch = 'sketch' in self.agg.metadata['AGGREGATES']
+        merge_sketch = 'sketch' in self.ancestor.metadata['AGGREGATES']
+        # likewise count and sumsq
+        merge_moments = 'count' in self.ancestor.metadata['AGGREGATES'] and \
+                'sumsq' in self.ancestor.metadata['AGGREGATES']
+
         slot = None
         while len(work) == steps_needed:
             slot = ((work[0].timestamp / step) * step) #+ step
@@ -259,12 +273,26 @@ class Aggregator(object):
 
             valid = 0
             row = Aggregate(slot, ROW_VALID, delta=0, average=None,
-                    min=None, max=None)
+                    min=None, max=None, count=0, sumsq=0)
+            averages = []
 
             for datum in work:
                 if datum.flags & ROW_VALID:
                     valid += 1
                     row.delta += datum.delta
+
+                    if keep_sketch:
+                        if merge_sketch:
+                            row.sketch += datum.sketch
+                        else:
+                            averages.append(datum.average)
+
+                    if merge_moments:
+                        row.count += datum.count
+                        row.sumsq += datum.sumsq
+                    else:
+                        row.count += 1
+                        row.sumsq += datum.average ** 2
     
                     if isNaN(row.min) or datum.delta < row.min:
                         row.min = datum.delta
@@ -272,6 +300,8 @@ class Aggregator(object):
                     if isNaN(row.max) or datum.delta > row.max:
                         row.max = datum.delta
             row.average = row.delta / float(step)
+            if averages:
+                row.sketch = sketch(averages)
             valid_ratio = float(valid)/float(len(work))
 
             if valid_ratio < self.agg.metadata['VALID_RATIO']:
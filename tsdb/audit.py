@@ -0,0 +1,142 @@
+"""
+Audit raw counter data for impossible rates, resets and restarts.
+
+Aggregator.update_from_raw_data() reports rates above max_rate one row at a
+time while it aggregates.  The functions here scan the raw data of many
+counters with numpy instead, in a pool of worker processes, without writing
+anything.
+
+>>> for report in audit("/data/tsdb", "*/ifHCInOctets", begin, end,
+...         max_rates={'Counter64': 1.25e9}):
+...     print report
+"""
+
+import collections
+import multiprocessing
+
+import numpy
+
+from tsdb.base import TSDB
+from tsdb.error import TSDBVarEmpty, TSDBVarIsNotCounter
+from tsdb.query import counter_deltas, DELTA_ROLLOVER, DELTA_RESET
+from tsdb.row import ROW_VALID
+
+AuditReport = collections.namedtuple('AuditReport', [
+    'path',             # path of the TSDBVar
+    'intervals',        # number of intervals between valid rows
+    'spikes',           # number of intervals with a rate above max_rate
+    'worst_rate',       # largest rate seen or None
+    'first_spike',      # timestamp of the first spike or None
+    'resets',           # negative deltas which are not rollovers
+    'rollovers',        # negative deltas which are rollovers
+    'uptime_resets',    # number of times uptime went backwards
+])
+
+def has_problems(report):
+    """Does the AuditReport show any potential bad data?"""
+    return bool(report.spikes or report.resets or report.uptime_resets)
+
+def lookup_max_rate(var, path, max_rates):
+    """Find the max_rate for a TSDBVar.
+
+    ``max_rates`` is a dictionary keyed by TSDBVar path or by row type name
+    such as 'Counter32', paths take precedence."""
+    if not max_rates:
+        return None
+    if max_rates.has_key(path):
+        return max_rates[path]
+    return max_rates.get(var.type.__name__)
+
+def audit_var(var, path, begin=None, end=None, max_rate=None,
+        uptime_var=None):
+    """Audit a single counter TSDBVar.  Returns an AuditReport."""
+    if begin is not None:
+        begin = int(begin) - var.metadata['STEP']
+    rows = var.select_array(begin, end, flags=ROW_VALID)
+    (timestamps, deltas, delta_t, kinds) = counter_deltas(var.type, rows,
+            uptime_var=uptime_var)
+
+    rates = deltas.astype(float) / delta_t
+    if max_rate:
+        spikes = numpy.flatnonzero(rates > max_rate)
+    else:
+        spikes = numpy.zeros(0, dtype=int)
+
+    uptime_resets = 0
+    if uptime_var is not None:
+        try:
+            uptime = uptime_var.select_array(begin, end, flags=ROW_VALID)
+            uptime_resets = int((numpy.diff(
+                uptime['value'].astype(numpy.int64)) < 0).sum())
+        except TSDBVarEmpty:
+            pass
+
+    return AuditReport(path=path,
+            intervals=len(rates),
+            spikes=len(spikes),
+            worst_rate=float(rates.max()) if len(rates) else None,
+            first_spike=int(timestamps[spikes[0]]) if len(spikes) else None,
+            resets=int((kinds == DELTA_RESET).sum()),
+            rollovers=int((kinds == DELTA_ROLLOVER).sum()),
+            uptime_resets=uptime_resets)
+
+def _audit_path(db, path, begin, end, max_rates, uptime_paths):
+    """Audit the TSDBVar at path, returns None if it isn't a counter or has
+    no data."""
+    var = db.get_var(path)
+    uptime_var = None
+    if uptime_paths and uptime_paths.get(path):
+        uptime_var = db.get_var(uptime_paths[path])
+
+    try:
+        try:
+            report = audit_var(var, path, begin, end,
+                    max_rate=lookup_max_rate(var, path, max_rates),
+                    uptime_var=uptime_var)
+        except (TSDBVarEmpty, TSDBVarIsNotCounter):
+            report = None
+    finally:
+        # don't keep every TSDBVar open in long running workers
+        db.release_var(path)
+        if uptime_var is not None:
+            db.release_var(uptime_paths[path])
+    return report
+
+_worker_db = None
+
+def _init_worker(root):
+    global _worker_db
+    _worker_db = TSDB(root, mode="r")
+
+def _worker(args):
+    return _audit_path(_worker_db, *args)
+
+def audit(root, pattern, begin=None, end=None, max_rates=None,
+        uptime_paths=None, processes=None, everything=False):
+    """Audit all counters matching pattern in the TSDB at root.
+
+    ``max_rates`` gives the largest believable rate by TSDBVar path or by row
+    type name, see lookup_max_rate().  ``uptime_paths`` maps the path of a
+    TSDBVar to the path of its uptime TSDBVar, which is used to tell resets
+    from rollovers and to count restarts.  The TSDBVars are audited by a pool
+    of ``processes`` worker processes, or in this process if ``processes``
+    is 0.
+
+    Returns a list of AuditReports sorted by path, only those for which
+    has_problems() is True unless ``everything`` is True."""
+    paths = TSDB(root, mode="r").find_vars(pattern)
+    work = [(path, begin, end, max_rates, uptime_paths) for path in paths]
+
+    if processes == 0:
+        _init_worker(root)
+        results = map(_worker, work)
+    else:
+        pool = multiprocessing.Pool(processes, _init_worker, (root, ))
+        try:
+            results = pool.map(_worker, work, chunksize=16)
+        finally:
+            pool.close()
+            pool.join()
+
+    return [r for r in results if r is not None and
+            (everything or has_problems(r))]
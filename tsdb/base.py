@@ -3,13 +3,44 @@ import os.path
 import time
 import mmap
 import errno
+import fnmatch
+import itertools
+
+import numpy
 
 from tsdb.error import *
 from tsdb.row import Aggregate, ROW_VALID, ROW_TYPE_MAP
 from tsdb.chunk_mapper import CHUNK_MAPPER_MAP
-from tsdb.util import write_dict, calculate_interval, calculate_slot
+from tsdb.util import write_dict, read_dict, calculate_interval, \
+        calculate_slot
 from tsdb.aggregator import Aggregator
 from tsdb.filesystem import get_fs
+from tsdb.expr import Expression
+from tsdb.query import select_matrix, downsample, default_field, \
+        counter_rates, top_n, heatmap, data_fields, empty_summary, \
+        summarize_rows, merge_summaries, valid_points
+from tsdb.cache import QueryCache, LRUCache, MemcacheCache
+from tsdb.explain import QueryStats, SlowQueryLog, ChunkRead
+from tsdb.pubsub import Broker
+from tsdb.rules import RuleSet
+from tsdb.view import VarView
+from tsdb.sketch import sketch, sketch_quantile, sketch_rank_bucket, \
+        exact_percentile, merge_sketch_rows, SKETCH_MAX_PAIRS
+
+def _query_stats(db, stats, limits):
+    """The QueryStats for a read and the SlowQueryLog to log it in.
+
+    A QueryStats is created if there is none and either there are limits or
+    db has a slow query log.  The log is only returned if the QueryStats was
+    created here, so only the outermost read is logged."""
+    log = db.slow_query_log
+    if stats is None and (limits is not None or log is not None):
+        stats = QueryStats(limits)
+    else:
+        log = None
+        if limits is not None:
+            stats.limits = limits
+    return (stats, log)
 
 class TSDBBase(object):
     """TSDBBase is a base class for other TSDB containers.
@@ -81,8 +112,14 @@ class TSDBBase(object):
 
         f.close()
 
+    def _check_writable(self):
+        """Raise TSDBReadOnlyError if the TSDB was opened read only."""
+        if self._find_db().read_only:
+            raise TSDBReadOnlyError("%s is read only" % (self.path, ))
+
     def save_metadata(self):
         """Save metadata for this container."""
+        self._check_writable()
         write_dict(self.fs, os.path.join(self.path, self.tag), self.metadata)
 
     def list_sets(self):
@@ -100,6 +137,7 @@ class TSDBBase(object):
 
     def add_set(self, name):
         """Create a new TSDBSet in this container."""
+        self._check_writable()
         prefix = self.path
         tsdb_set = self
         steps = name.split('/')
@@ -130,9 +168,32 @@ class TSDBBase(object):
                     TSDBVar(self, os.path.join(self.path, name), **kwargs) 
         return self.vars[name]
 
+    def release_var(self, name):
+        """Close the chunks of the named TSDBVar, see
+        TSDBVar.close_chunks(), and forget it so that get_var() loads it
+        again.  A TSDBVar with inserts which haven't been flushed is kept.
+
+        Queries over many TSDBVars release each one they loaded once they
+        are done with it, so that the files of all of them aren't kept
+        open."""
+        var = self.vars.get(name)
+        if var is None:
+            return
+        var.close_chunks()
+        if not var.dirty_summaries:
+            del self.vars[name]
+
+    def _release_loaded(self, names, cached):
+        """Release the TSDBVars in names which were loaded by a query, that
+        is which aren't in ``cached``, the names loaded before it."""
+        for name in names:
+            if name not in cached:
+                self.release_var(name)
+
     def add_var(self, name, type, step, chunk_mapper, metadata=None):
         prefix = os.path.dirname(name)
         """Create a new TSDBVar in this container."""
+        self._check_writable()
         if prefix != '':
             try:
                 self.get_set(prefix)
@@ -142,6 +203,142 @@ class TSDBBase(object):
         TSDBVar.create(self.fs, self.path, name, type, step, chunk_mapper, metadata)
         return self.get_var(name)
 
+    def find_vars(self, pattern="*"):
+        """Find TSDBVars below this container.
+
+        Returns a sorted list of the paths, relative to this container, of all
+        TSDBVars found by descending through the TSDBSets that match the
+        shell style ``pattern``.  Note that ``*`` matches ``/``."""
+        found = []
+        for name in self.list_vars():
+            if fnmatch.fnmatchcase(name, pattern):
+                found.append(name)
+
+        for name in self.list_sets():
+            if name == "TSDBAggregates":
+                continue
+            tsdb_set = self.get_set(name)
+            found.extend([os.path.join(name, x) for x in
+                tsdb_set.find_vars("*") if
+                fnmatch.fnmatchcase(os.path.join(name, x), pattern)])
+
+        found.sort()
+        return found
+
+    def select_matrix(self, vars, begin, end, step=None, field=None,
+            threads=None, stats=None, limits=None):
+        """Select the same time range from several TSDBVars at once.
+
+        ``vars`` is either a list of paths relative to this container or a
+        pattern to pass to find_vars().  The data is resampled onto a common
+        grid of ``step`` seconds, see tsdb.query.select_matrix for details.
+        ``stats`` is a tsdb.explain.QueryStats to record the reads in and
+        ``limits`` the tsdb.explain.QueryLimits of all of the reads.
+
+        Returns a tuple of (paths, timestamps, matrix, mask)."""
+        if isinstance(vars, basestring):
+            vars = self.find_vars(vars)
+
+        (stats, log) = _query_stats(getattr(self, 'db', self), stats, limits)
+
+        cached = set(self.vars)
+        try:
+            (timestamps, matrix, mask) = select_matrix(
+                    [self.get_var(x) for x in vars], begin, end, step=step,
+                    field=field, threads=threads, stats=stats)
+        finally:
+            self._release_loaded(vars, cached)
+
+        if log is not None:
+            log.record("select_matrix %s %d vars %s %s" % (self.path,
+                len(vars), begin, end), stats.finish())
+
+        return (list(vars), timestamps, matrix, mask)
+
+    def explain_matrix(self, vars, begin, end, step=None, field=None,
+            threads=None, limits=None):
+        """Run select_matrix() and return a tsdb.explain.QueryStats of what
+        it read."""
+        stats = QueryStats(limits)
+        self.select_matrix(vars, begin, end, step=step, field=field,
+                threads=threads, stats=stats)
+        return stats.finish()
+
+    def top_n(self, var_pattern, begin, end, n, metric='average', points=12,
+            field=None, threads=None, stats=None, limits=None):
+        """Find the n TSDBVars matching var_pattern with the largest metric.
+
+        ``var_pattern`` is passed to find_vars().  Each TSDBVar is summarized
+        from the coarsest aggregate that still gives about ``points`` points
+        between begin and end, see tsdb.query.window_metric.  ``metric`` is
+        one of 'average', 'max', 'min' or 'sum'.  ``stats`` and ``limits``
+        are as for select_matrix().
+
+        Returns a list of (value, path) tuples, largest first, with paths
+        relative to this container."""
+        paths = self.find_vars(var_pattern)
+        vars = itertools.imap(self.get_var, paths)
+        prefix = len(self.path.rstrip('/')) + 1
+        (stats, log) = _query_stats(getattr(self, 'db', self), stats, limits)
+
+        cached = set(self.vars)
+        try:
+            best = top_n(vars, begin, end, n, metric=metric, points=points,
+                    field=field, threads=threads, stats=stats)
+        finally:
+            self._release_loaded(paths, cached)
+
+        if log is not None:
+            log.record("top_n %s %s %s %s" % (self.path, var_pattern, begin,
+                end), stats.finish())
+
+        return [(value, path[prefix:]) for (value, path) in best]
+
+    def heatmap(self, prefix, begin, end, step, bins, range=None,
+            field=None, transform=None, stats=None, limits=None):
+        """Build a histogram of the TSDBVars below prefix for each time slot.
+
+        All TSDBVars whose path relative to this container starts with
+        ``prefix`` are used.  ``stats`` and ``limits`` are as for
+        select_matrix(), see tsdb.query.heatmap for the other arguments.
+
+        Returns a tuple of (timestamps, edges, histogram)."""
+        paths = self.find_vars(prefix + "*")
+        vars = itertools.imap(self.get_var, paths)
+        (stats, log) = _query_stats(getattr(self, 'db', self), stats, limits)
+
+        cached = set(self.vars)
+        try:
+            result = heatmap(vars, begin, end, step, bins, range=range,
+                    field=field, transform=transform, stats=stats)
+        finally:
+            self._release_loaded(paths, cached)
+
+        if log is not None:
+            log.record("heatmap %s %s %s %s" % (self.path, prefix, begin,
+                end), stats.finish())
+
+        return result
+
+    def evaluate(self, expression, begin, end, step, stats=None,
+            limits=None):
+        """Evaluate an expression over TSDBVars in this container.
+
+        ``expression`` is a string or a tsdb.expr.Expression, see tsdb.expr
+        for the syntax.  ``stats`` and ``limits`` are as for
+        select_matrix().  Returns a tuple of (timestamps, values)."""
+        if isinstance(expression, basestring):
+            expression = Expression(expression)
+        (stats, log) = _query_stats(getattr(self, 'db', self), stats, limits)
+
+        result = expression.evaluate(self, begin, end, step, stats)
+
+        if log is not None:
+            log.record("evaluate %s %s %s %s" % (self.path, expression.source,
+                begin, end), stats.finish())
+
+        return result
+
     def list_aggregates(self):
         """Sorted list of existing aggregates."""
 
@@ -183,13 +380,27 @@ class TSDBBase(object):
         
         aggregates is a list of strings containing the names of the aggregates
         to compute.
+
+        The first aggregate of a TSDBVar never stores a sketch, percentile()
+        reads its averages instead.  The sketches of the others are stored
+        in SKETCH_SIZE pairs, see tsdb.row.Aggregate.
         """
         # XXX should add error checking to aggregates?
+        self._check_writable()
         if metadata is None:
             metadata = {}
 
         secs = calculate_interval(step)
 
+        if 'sketch' in aggregates:
+            existing = self.list_aggregates()
+            if not existing:
+                aggregates = [x for x in aggregates if x != 'sketch']
+            elif not metadata.has_key('SKETCH_SIZE'):
+                metadata['SKETCH_SIZE'] = max(min(
+                    secs // calculate_interval(existing[0]),
+                    SKETCH_MAX_PAIRS), 1)
+
         metadata['AGGREGATES'] = aggregates
 
         if not metadata.has_key('LAST_UPDATE'):
@@ -237,15 +448,28 @@ class TSDB(TSDBBase):
     tag = "TSDB"
     metadata_map = {'CHUNK_PREFIXES': list}
 
-    def __init__(self, root, mode="r+" ):
+    def __init__(self, root, mode="r+", cache=None, slow_query_log=None):
         """Load the TSDB located at ``path``.
 
-            ``mode`` control the mode used by open() 
+            ``mode`` control the mode used by open().  A TSDB opened with
+                mode "r" is read only: nothing is ever written, chunks are
+                opened read only and anything that would write raises
+                TSDBReadOnlyError.  Many such readers may share a TSDB with
+                one writer process, see TSDBVar.refresh().
+            ``cache``
+                a tsdb.cache.QueryCache for the results of select_array().
+                If not given one is built from the CACHE_SIZE (bytes held
+                in this process) and MEMCACHED_URI metadata, if present.
+            ``slow_query_log``
+                a tsdb.explain.SlowQueryLog.  If not given one is built
+                from the SLOW_QUERY_SECONDS and SLOW_QUERY_LOG metadata, if
+                present.
         """
 
         TSDBBase.__init__(self)
         self.path = "/"
         self.mode = mode
+        self.read_only = mode.startswith("r") and "+" not in mode
         self.fs = get_fs(root, [])
         self.load_metadata()
         self.chunk_prefixes = self.metadata.get('CHUNK_PREFIXES', [])
@@ -266,6 +490,46 @@ class TSDB(TSDBBase):
             if self.memcache:
                 self.memcache = memcache.Client([self.metadata['MEMCACHED_URI']])
 
+        if cache is None:
+            tiers = []
+            if self.metadata.get('CACHE_SIZE'):
+                tiers.append(LRUCache(int(self.metadata['CACHE_SIZE'])))
+            if self.metadata.has_key('MEMCACHED_URI') and self.memcache:
+                tiers.append(MemcacheCache(self.memcache))
+            if tiers:
+                cache = QueryCache(tiers)
+        self.cache = cache
+
+        if slow_query_log is None and \
+                self.metadata.has_key('SLOW_QUERY_SECONDS'):
+            out = None
+            if self.metadata.get('SLOW_QUERY_LOG'):
+                out = open(self.metadata['SLOW_QUERY_LOG'], "a")
+            slow_query_log = SlowQueryLog(
+                    float(self.metadata['SLOW_QUERY_SECONDS']), out)
+        self.slow_query_log = slow_query_log
+
+        self.broker = None
+
+    def subscribe(self, patterns, maxsize=1000, overflow='drop',
+            timeout=None):
+        """Receive the rows written to TSDBVars with paths matching patterns.
+
+        See tsdb.pubsub.  Returns a tsdb.pubsub.Subscription."""
+        if self.broker is None:
+            self.broker = Broker()
+        return self.broker.subscribe(patterns, maxsize=maxsize,
+                overflow=overflow, timeout=timeout)
+
+    def add_rules(self, rules, target):
+        """Evaluate rules for the rows written to this TSDB.
+
+        See tsdb.rules.  RuleEvents are given to target, a callable or
+        something with a put() method.  Returns a tsdb.rules.RuleSet."""
+        if self.broker is None:
+            self.broker = Broker()
+        return self.broker.attach(RuleSet(self.broker, rules, target))
+
     @classmethod
     def is_tsdb(klass, fs, path):
         """Does path contain a TSDB?"""
@@ -360,7 +624,7 @@ class TSDBVar(TSDBBase):
     metadata_map = {'STEP': int, 'TYPE_ID': int, 'MIN_TIMESTAMP': int,
             'MAX_TIMESTAMP': int, 'VERSION': int, 'CHUNK_MAPPER_ID': int,
             'AGGREGATES': list, 'LAST_UPDATE': int, 'VALID_RATIO': float,
-            'HEARTBEAT': int}
+            'HEARTBEAT': int, 'GENERATION': int, 'SKETCH_SIZE': int}
 
     def __init__(self, parent, path, use_mmap=False, cache_chunks=False,
             metadata=None):
@@ -389,6 +653,9 @@ class TSDBVar(TSDBBase):
 
         self.chunks = {} # memory resident chunks
         self.size = self.type.size(self.metadata)
+        self.dtype = self.type.dtype(self.metadata)
+        self.summaries = {} # chunk summaries, see chunk_summary()
+        self.dirty_summaries = set()
 
     @classmethod
     def is_tsdb_var(klass, fs, path):
@@ -431,26 +698,236 @@ class TSDBVar(TSDBBase):
 
     def update_aggregate(self, name, uptime_var=None, min_last_update=0,
             max_rate=None, max_rate_callback=None):
-        """Update the named aggreagate."""
-        return Aggregator(self.get_aggregate(name),
+        """Update the named aggreagate.
+
+        If the TSDB has subscribers the rows of the aggregate which become
+        final are published."""
+        self._check_writable()
+        agg = self.get_aggregate(name)
+        final = agg.final_timestamp()
+        result = Aggregator(agg,
                           self._get_aggregate_ancestor(name)
                          ).update(uptime_var=uptime_var,
                                   min_last_update=int(min_last_update),
                                   max_rate=max_rate,
                                   max_rate_callback=max_rate_callback)
 
+        broker = self.db.broker
+        if broker is not None and broker.subscriptions and \
+                agg.final_timestamp() > final:
+            for row in agg.select(final + agg.metadata['STEP'],
+                    agg.final_timestamp(),
+                    flags=ROW_VALID):
+                broker.publish(agg.path.lstrip('/'), row)
+
+        return result
+
     def update_all_aggregates(self, **kwargs):
         """Update all aggregates for this TSDBVar."""
         for agg in self.list_aggregates():
             self.update_aggregate(agg, **kwargs)
 
+    def save_metadata(self):
+        """Save metadata for this TSDBVar.
+
+        GENERATION is incremented each time.  Since the metadata is saved by
+        flush() after the chunks are flushed and replaces the old metadata
+        atomically, readers loading it see the data it describes."""
+        self._check_writable()
+        self.metadata['GENERATION'] = self.metadata.get('GENERATION', 0) + 1
+        TSDBBase.save_metadata(self)
+
+    def reload_metadata(self):
+        """Reload the metadata if another process has saved it since it was
+        loaded, that is if its GENERATION has changed, and reopen the
+        chunks.  Returns True if it was reloaded."""
+        try:
+            generation = int(read_dict(self.fs, os.path.join(self.path,
+                self.tag)).get('GENERATION', 0))
+        except (IOError, OSError, ValueError):
+            return False
+        if generation == self.metadata.get('GENERATION', 0):
+            return False
+        self.load_metadata()
+        # the open chunks may have buffered what the other process rewrote
+        for chunk in self.chunks.values():
+            chunk.close()
+        self.chunks = {}
+        return True
+
+    def snapshot(self):
+        """Reload the metadata saved by the writer and return a
+        TSDBVarSnapshot of the data it describes.
+
+        Reads made through the snapshot end at final_timestamp(), so rows
+        still being written by insert() or the Aggregator are not seen.  In
+        the writer itself, while it has inserts which haven't been flushed,
+        the metadata isn't reloaded, see refresh(), and the snapshot
+        includes them."""
+        self.refresh()
+        return TSDBVarSnapshot(self, self.metadata.get('GENERATION', 0),
+                self.final_timestamp())
+
+    def refresh(self):
+        """Reload the metadata and forget the list of chunks and aggregates.
+
+        A reader of a TSDBVar being updated by another process calls this to
+        see the data written since it was loaded.  Open chunks are kept,
+        chunks of a read only TSDB are unbuffered or mapped so rows written
+        to them are read from the files.
+
+        The metadata is only reloaded if the TSDB is read only or there are
+        no inserts which haven't been flushed, the saved metadata doesn't
+        describe those and flush() would save it over them."""
+        if self.db.read_only or not self.dirty_summaries:
+            self.load_metadata()
+        self.chunk_list = []
+        self.agg_list = []
+        self.summaries = {}
+
+    def final_timestamp(self):
+        """The timestamp of the newest row that is not expected to change.
+
+        For raw data this is the newest row.  For aggregates it is the slot
+        before the one holding LAST_UPDATE, since the Aggregator may still
+        add to that slot."""
+        if self.type == Aggregate:
+            step = self.metadata['STEP']
+            return calculate_slot(self.metadata.get('LAST_UPDATE', 0),
+                    step) - step
+        return self.metadata.get('MAX_TIMESTAMP') or 0
+
+    def choose_resolution(self, begin, end, max_points=None, step=None):
+        """Choose the coarsest data that still meets a resolution.
+
+        The resolution is either given directly as ``step``, in seconds or as
+        an interval string such as "5m", or as ``max_points``, the maximum
+        number of points wanted between ``begin`` and ``end``.
+
+        For ``step`` returns the aggregate with the largest step that is no
+        larger than the requested step.  If there is no such aggregate, for
+        example because the window is short, this TSDBVar is returned.
+
+        For ``max_points`` returns this TSDBVar or the aggregate with the
+        smallest step giving no more than ``max_points`` rows from ``begin``
+        to ``end``, or the coarsest aggregate if none does.
+
+        If neither ``step`` nor ``max_points`` is given this TSDBVar is
+        returned."""
+        if step is None:
+            if not max_points:
+                return self
+            candidates = [self] + [self.get_aggregate(x) for x in
+                    self.list_aggregates()]
+            for var in candidates:
+                n = var.metadata['STEP']
+                if (calculate_slot(int(end), n) -
+                        calculate_slot(int(begin), n)) / n + 1 <= max_points:
+                    return var
+            return candidates[-1]
+        elif isinstance(step, basestring):
+            step = calculate_interval(step)
+
+        best = self
+        for name in self.list_aggregates():
+            agg = self.get_aggregate(name)
+            if agg.metadata['STEP'] <= step:
+                best = agg
+
+        return best
+
+    def query(self, begin, end, max_points=None, step=None, flags=None):
+        """Select data at the resolution chosen by choose_resolution().
+
+        Returns a tuple of the TSDBVar that was chosen and a generator of the
+        selected rows as returned by select()."""
+        var = self.choose_resolution(begin, end, max_points=max_points,
+                step=step)
+        return (var, var.select(begin, end, flags=flags))
+
+    def query_array(self, begin, end, max_points=None, step=None,
+            flags=None, stats=None, limits=None):
+        """Like query() but the rows are returned by select_array()."""
+        var = self.choose_resolution(begin, end, max_points=max_points,
+                step=step)
+        return (var, var.select_array(begin, end, flags=flags, stats=stats,
+            limits=limits))
+
+    def explain(self, begin=None, end=None, max_points=None, step=None,
+            flags=None, limits=None):
+        """Run query_array() and return a tsdb.explain.QueryStats of what it
+        read, its vars list the resolution that was chosen."""
+        stats = QueryStats(limits)
+        try:
+            self.query_array(begin, end, max_points=max_points, step=step,
+                    flags=flags, stats=stats)
+        except TSDBVarEmpty:
+            pass
+        return stats.finish()
+
+    def explain_select(self, begin=None, end=None, flags=None,
+            limits=None):
+        """Run select() to the end and return a tsdb.explain.QueryStats of
+        what it read."""
+        stats = QueryStats(limits)
+        for row in self.select(begin, end, flags=flags, stats=stats):
+            pass
+        return stats.finish()
+
+    def select_downsampled(self, begin, end, points, method='lttb',
+            field=None):
+        """Select at most ``points`` points between begin and end.
+
+        The data is read at the resolution chosen by query_array() and then
+        reduced using ``method``, either 'lttb' (Largest-Triangle-Three-
+        Buckets) for line graphs or 'minmax' to keep the minimum and maximum
+        of each bucket.  Invalid rows and NaN values are skipped.  ``field``
+        defaults to value for raw data and average for Aggregates.
+
+        Returns a tuple of (var, timestamps, values) where var is the TSDBVar
+        the data was read from."""
+        (var, rows) = self.query_array(begin, end, max_points=points)
+        if field is None:
+            field = default_field(var)
+        (timestamps, values) = downsample(rows, field, points, method=method)
+        return (var, timestamps, values)
+
+    def rate(self, begin=None, end=None, uptime_var=None, max_rate=None,
+            heartbeat=None, stats=None, limits=None):
+        """Compute rates from the raw data of a counter.
+
+        Nothing is written, this is useful for TSDBVars without aggregates or
+        for data newer than the LAST_UPDATE of the aggregates.  The rate for
+        each valid row is computed from the previous valid row using the same
+        rollover and reset handling as the Aggregator.
+
+        ``uptime_var``
+            used to tell a reset from a rollover, see Aggregator.update()
+        ``max_rate``
+            rates larger than this are dropped
+        ``heartbeat``
+            rates over intervals longer than this many seconds are dropped
+        ``stats``, ``limits``
+            as for select_array()
+
+        Returns a tuple of numpy arrays (timestamps, rates) where each
+        timestamp is the timestamp of the row at the end of the interval.
+
+        Raises TSDBVarIsNotCounter if this TSDBVar doesn't hold a counter."""
+        if stats is None and limits is not None:
+            stats = QueryStats(limits)
+        return counter_rates(self, begin=begin, end=end,
+                uptime_var=uptime_var, max_rate=max_rate, heartbeat=heartbeat,
+                stats=stats)
+
     def all_chunks(self):
         """Generate a sorted list of all chunks in this TSDBVar."""
         if not self.chunk_list:
             files = self.fs.listdir(self.path)
 
+            # metadata and the temporary files it is written to
             self.chunk_list = filter(\
-                lambda x: x != self.tag and \
+                lambda x: not x.startswith(self.tag) and \
                 not self.fs.isdir(os.path.join(self.path,x)), files)
 
             if not self.chunk_list:
@@ -460,6 +937,11 @@ class TSDBVar(TSDBBase):
 
         return self.chunk_list
 
+    def view(self):
+        """A read only memory mapped view of all of the rows of this
+        TSDBVar indexed by slot, see tsdb.view.VarView."""
+        return VarView(self)
+
     def rowsize(self):
         """Returns the size of a row."""
         return self.size #self.type.size(self.metadata)
@@ -485,6 +967,7 @@ class TSDBVar(TSDBBase):
                         TSDBVarChunk(self, name, use_mmap=self.use_mmap)
             except TSDBVarChunkDoesNotExistError:
                 if create:
+                    self._check_writable()
                     self.chunks[name] = \
                             TSDBVarChunk.create(self, name,
                                                 use_mmap=self.use_mmap)
@@ -506,10 +989,11 @@ class TSDBVar(TSDBBase):
             chunks = self.all_chunks()
 
             self.metadata['MIN_TIMESTAMP'] = self.chunk_mapper.begin(chunks[0])
-            try:
-                self.save_metadata() # XXX good idea?
-            except IOError:
-                pass
+            if not self.db.read_only:
+                try:
+                    self.save_metadata() # XXX good idea?
+                except IOError:
+                    pass
 
         return self.metadata['MIN_TIMESTAMP']
 
@@ -522,10 +1006,11 @@ class TSDBVar(TSDBBase):
             chunks = self.all_chunks()
 
             self.metadata['MAX_TIMESTAMP'] = self.chunk_mapper.end(chunks[-1])
-            try:
-                self.save_metadata() # XXX good idea?
-            except IOError:
-                pass
+            if not self.db.read_only:
+                try:
+                    self.save_metadata() # XXX good idea?
+                except IOError:
+                    pass
 
         return self.metadata['MAX_TIMESTAMP']
 
@@ -600,6 +1085,8 @@ class TSDBVar(TSDBBase):
 
         try:
             chunk = self._chunk(timestamp)
+            if chunk.advice is None:
+                chunk.advise('random')
             val = chunk.read_row(timestamp)
         except TSDBVarChunkDoesNotExistError:
             val = self.type.get_invalid_row()
@@ -611,7 +1098,8 @@ class TSDBVar(TSDBBase):
 
         return val
 
-    def select(self, begin=None, end=None, flags=None):
+    def select(self, begin=None, end=None, flags=None, stats=None,
+            limits=None):
         """Select data based on timestamp or flags.
 
         None is interpreted as "don't care".  The timestamp ranges are
@@ -636,6 +1124,13 @@ class TSDBVar(TSDBBase):
 
             # all valid data
             v.select(flags=ROW_VALID)
+
+        ``stats`` and ``limits`` are as for select_array(), the size of the
+        read is checked when select() is called and the deadline and
+        cancellation before each chunk.  The chunks read and rows returned
+        are recorded in ``stats`` as the rows are generated and the read is
+        timed for the slow query log until the generator is finished or
+        closed, see explain_select().
         """
 
         if begin is None:
@@ -659,6 +1154,26 @@ class TSDBVar(TSDBBase):
         if flags is not None:
             flags = int(flags)
 
+        (stats, log) = _query_stats(self.db, stats, limits)
+        step = self.metadata['STEP']
+        if stats is not None:
+            stats.add_var(self, begin, end)
+            if end >= begin:
+                first = calculate_slot(begin, step)
+                last = calculate_slot(end, step)
+                rows = (last - first) / step + 1
+                stats.reserve(len(list(self._chunk_spans(first, last))),
+                        rows, rows * self.rowsize())
+
+        def record(chunk, slots, decoded):
+            """Record the read of a chunk in stats."""
+            if chunk is None:
+                return
+            (name, path) = chunk
+            stats.add_chunk(ChunkRead(self.path, name,
+                path and self.fs.layer(path), slots * self.rowsize(),
+                decoded * self.rowsize(), decoded))
+
         def select_generator(var, begin, end, flags):
             current = calculate_slot(begin, self.metadata['STEP'])
             max_ts = self.max_timestamp()
@@ -667,32 +1182,511 @@ class TSDBVar(TSDBBase):
             if max_ts > now:
                 max_ts = now
 
-            while current <= end:
-                try:
-                    row = var.get(current)
-                except TSDBVarRangeError:
-                    # looking for data beyond the end of recorded data so stop.
-                    if current > max_ts:
-                        raise StopIteration
+            name = None
+            chunk = None    # (name, path or None if missing) being read
+            slots = decoded = 0
+            try:
+                while current <= end:
+                    if var.chunk_mapper.name(current) != name:
+                        if stats is not None:
+                            record(chunk, slots, decoded)
+                            stats.check()
+                        name = var.chunk_mapper.name(current)
+                        chunk = (name, None)
+                        slots = decoded = 0
+                        try:
+                            c = var._chunk(current)
+                            c.advise('sequential')
+                            chunk = (name, c.path)
+                        except TSDBVarChunkDoesNotExistError:
+                            pass
+                    slots += 1
+                    try:
+                        row = var.get(current)
+                        if chunk[1] is not None:
+                            decoded += 1
+                    except TSDBVarRangeError:
+                        # looking for data beyond the end of recorded data so
+                        # stop.
+                        if current > max_ts:
+                            raise StopIteration
+
+                    if row.timestamp > end:
+                        break
+
+                    if not flags or row.flags & flags == flags:
+                        if stats is not None:
+                            stats.add_rows(1)
+                        yield row
+
+                    current += var.metadata['STEP']
+            finally:
+                if stats is not None:
+                    record(chunk, slots, decoded)
+                if log is not None:
+                    log.record("select %s %d %d" % (var.path, begin, end),
+                            stats.finish())
 
-                if row.timestamp > end:
-                    break
+            raise StopIteration
 
-                if not flags or row.flags & flags == flags:
-                    yield row
+        return select_generator(self, begin, end, flags)
 
-                current += var.metadata['STEP']
+    def prefetch(self, begin=None, end=None):
+        """Ask the kernel to start reading the rows from begin to end, for
+        memory mapped TSDBVars on platforms with madvise()."""
+        try:
+            (begin, end) = self._clip_range(begin, end)
+        except TSDBVarEmpty:
+            return
+        step = self.metadata['STEP']
+        for (span_begin, span_end) in self._chunk_spans(
+                calculate_slot(begin, step), calculate_slot(end, step)):
+            try:
+                self._chunk(span_begin).advise('willneed', span_begin,
+                        span_end)
+            except TSDBVarChunkDoesNotExistError:
+                pass
 
-            raise StopIteration
+    def _chunk_spans(self, first, last):
+        """Generate (begin, end) slot pairs for each chunk between the slots
+        first and last inclusive."""
+        step = self.metadata['STEP']
+        current = first
+        while current <= last:
+            name = self.chunk_mapper.name(current)
+            end = min(last, calculate_slot(self.chunk_mapper.end(name), step))
+            yield (current, end)
+            current = end + step
+
+    def _clip_range(self, begin, end):
+        """Limit begin and end to the range of stored data, as select()
+        does."""
+        if begin is None:
+            begin = self.min_timestamp()
+        else:
+            begin = max(int(begin), self.min_timestamp())
 
-        return select_generator(self, begin, end, flags)
+        if end is None:
+            end = self.max_timestamp()
+        else:
+            end = min(int(end), self.max_timestamp())
+
+        return (begin, min(end, int(time.time())))
+
+    def select_array(self, begin=None, end=None, flags=None, stats=None,
+            limits=None):
+        """Select data into a numpy structured array.
+
+        This is the vectorized equivalent of select(), the arguments have the
+        same meaning and the same rows are returned.  Each chunk is read with
+        a single read and the array has one field per field in the row.  As
+        with get() invalid rows have their timestamp set to the slot
+        timestamp.
+
+        If the TSDB has a cache the result is cached, keyed on the range and
+        the GENERATION, MAX_TIMESTAMP and LAST_UPDATE of this TSDBVar.  The
+        metadata is reloaded with reload_metadata() before the cache is
+        searched, so rows flushed by another process, even into slots that
+        were already cached, are seen.  The cache is bypassed while there
+        are inserts which haven't been flushed and flush() invalidates
+        everything cached for this TSDBVar.
+
+        ``stats`` is a tsdb.explain.QueryStats to record the read in, see
+        explain().  ``limits`` is a tsdb.explain.QueryLimits, the read
+        raises a TSDBQueryLimitError or TSDBQueryCancelledError if it breaks
+        them."""
+
+        (stats, log) = _query_stats(self.db, stats, limits)
+
+        if self.db.cache is not None and not self.dirty_summaries:
+            self.reload_metadata()
+        (begin, end) = self._clip_range(begin, end)
+        if stats is not None:
+            stats.add_var(self, begin, end)
+
+        rows = self._cached_select_array(begin, end, flags, stats)
+
+        if stats is not None:
+            stats.add_rows(len(rows))
+        if log is not None:
+            log.record("select_array %s %d %d" % (self.path, begin, end),
+                    stats.finish())
+        return rows
+
+    def _cached_select_array(self, begin, end, flags, stats):
+        cache = self.db.cache
+        # dirty_summaries lists the chunks written to since the last flush()
+        if cache is None or self.dirty_summaries:
+            return self._select_array(begin, end, flags, stats)
+
+        key = self._select_cache_key(begin, end, flags)
+        rows = cache.get(self.path, key)
+        if stats is not None:
+            stats.add_cache(rows is not None)
+        if rows is None:
+            rows = self._select_array(begin, end, flags, stats)
+            cache.set(self.path, key, rows)
+        return rows.copy()
+
+    def _select_cache_key(self, begin, end, flags):
+        """The cache key for select_array() of the clipped range begin to
+        end."""
+        return ('select_array', begin, end, flags, self.metadata['STEP'],
+                self.metadata.get('GENERATION'),
+                self.metadata.get('MAX_TIMESTAMP'),
+                self.metadata.get('LAST_UPDATE'))
+
+    def _select_array(self, begin, end, flags, stats=None):
+        dtype = self.dtype.newbyteorder('=')
+        step = self.metadata['STEP']
+        first = calculate_slot(begin, step)
+        last = calculate_slot(end, step)
+        if last < first:
+            return numpy.zeros(0, dtype=dtype)
+
+        spans = list(self._chunk_spans(first, last))
+        if stats is not None:
+            rows = (last - first) / step + 1
+            stats.reserve(len(spans), rows, rows * self.rowsize())
+
+        parts = []
+        for (chunk_begin, chunk_end) in spans:
+            n = (chunk_end - chunk_begin) / step + 1
+            if stats is not None:
+                stats.check()
+            try:
+                chunk = self._chunk(chunk_begin)
+                parts.append(chunk.read_array(chunk_begin, chunk_end))
+                if stats is not None:
+                    stats.add_chunk(ChunkRead(self.path, chunk.name,
+                        self.fs.layer(chunk.path), n * self.rowsize(),
+                        parts[-1].nbytes, len(parts[-1])))
+            except TSDBVarChunkDoesNotExistError:
+                parts.append(numpy.zeros(n, dtype=self.dtype))
+                if stats is not None:
+                    stats.add_chunk(ChunkRead(self.path,
+                        self.chunk_mapper.name(chunk_begin), None,
+                        n * self.rowsize(), 0, 0))
+
+        return self._filter_rows(numpy.concatenate(parts), first, end, flags)
+
+    def _filter_rows(self, rows, first, end, flags):
+        """Finish rows read from the chunks starting at the slot first as
+        select_array() does."""
+        rows = rows.astype(self.dtype.newbyteorder('='))
+
+        invalid = rows['flags'] & ROW_VALID == 0
+        slots = numpy.arange(first, first + len(rows) * self.metadata['STEP'],
+                self.metadata['STEP'])
+        rows['timestamp'][invalid] = slots[invalid]
+
+        keep = rows['timestamp'] <= end
+        if flags:
+            flags = int(flags)
+            keep &= rows['flags'] & flags == flags
+
+        return rows[keep]
+
+    def _summary_path(self, name):
+        return os.path.join(self.path, "TSDBSummaries", name)
+
+    def _chunk_sealed(self, name):
+        """Is the named chunk older than the newest data?
+
+        For aggregates the newest data is LAST_UPDATE since the slots after
+        it may still change."""
+        newest = self.max_timestamp()
+        if self.type == Aggregate:
+            newest = min(newest, self.metadata.get('LAST_UPDATE', 0))
+        return self.chunk_mapper.end(name) < newest
+
+    def chunk_summary(self, name, stats=None):
+        """Summarize all valid rows in the named chunk.
+
+        See tsdb.query.summarize_rows for the format of the summary.
+        Summaries are kept in memory until the chunk is written to.  The
+        summary of a sealed chunk, one older than the newest data, is also
+        saved to a sidecar file in the TSDBSummaries directory of this
+        TSDBVar which is used for as long as the chunk is unchanged.  Chunks
+        written to since the last flush() are always read, as neither the
+        sidecar nor the file's size and modification time reflect the
+        writes yet.
+
+        A chunk which has to be read is recorded in ``stats``, a
+        tsdb.explain.QueryStats, if given and is subject to its limits."""
+        if self.summaries.has_key(name):
+            return self.summaries[name]
+
+        fields = data_fields(self.dtype)
+        path = os.path.join(self.path, name)
+        if not self.fs.exists(path):
+            return empty_summary(fields)
+
+        mtime = self.fs.getmtime(path)
+        size = self.fs.getsize(path)
+
+        dirty = name in self.dirty_summaries
+        summary = None
+        if not dirty:
+            try:
+                d = read_dict(self.fs, self._summary_path(name))
+                if float(d['MTIME']) == mtime and int(d['SIZE']) == size:
+                    summary = {}
+                    for field in fields:
+                        summary[field] = dict(
+                                count=int(d[field + '_COUNT']),
+                                sum=float(d[field + '_SUM']),
+                                min=float(d[field + '_MIN']),
+                                max=float(d[field + '_MAX']))
+            except (IOError, OSError, KeyError, ValueError):
+                summary = None
+
+        if summary is None:
+            if stats is not None:
+                stats.reserve(1, size / self.rowsize(), size)
+                stats.check()
+            chunk = self._chunk(self.chunk_mapper.begin(name))
+            rows = chunk.read_all()
+            if stats is not None:
+                stats.add_chunk(ChunkRead(self.path, name,
+                    self.fs.layer(chunk.path), size, rows.nbytes, len(rows)))
+            summary = summarize_rows(rows, fields)
+
+            if self._chunk_sealed(name) and not dirty and \
+                    not self.db.read_only:
+                d = {'MTIME': repr(mtime), 'SIZE': size}
+                for field in fields:
+                    for (k, v) in summary[field].items():
+                        d[field + '_' + k.upper()] = repr(v)
+                try:
+                    if not self.fs.exists(os.path.dirname(
+                            self._summary_path(name))):
+                        self.fs.makedir(os.path.dirname(
+                            self._summary_path(name)))
+                    write_dict(self.fs, self._summary_path(name), d)
+                except (IOError, OSError):
+                    pass # eg. read only
+
+        if not dirty:
+            self.summaries[name] = summary
+        return summary
+
+    def summarize(self, begin=None, end=None, fields=None, stats=None,
+            limits=None):
+        """Summarize the valid rows between begin and end.
+
+        Returns a dictionary with the count, sum, min and max of each field
+        in ``fields``, by default all fields holding data, see
+        tsdb.query.summarize_rows.  Chunks that lie entirely within the range
+        are summarized by chunk_summary() without reading them once their
+        summary is known, only the chunks at the edges are scanned.
+
+        ``stats`` and ``limits`` are as for select_array().  Chunks whose
+        summary is already known count towards the limits as reading
+        nothing, the deadline and cancellation are checked before every
+        chunk."""
+        if fields is None:
+            fields = data_fields(self.dtype)
+        if stats is None and limits is not None:
+            stats = QueryStats(limits)
+
+        (begin, end) = self._clip_range(begin, end)
+        step = self.metadata['STEP']
+        summary = empty_summary(fields)
+
+        for (span_begin, span_end) in self._chunk_spans(
+                calculate_slot(begin, step), calculate_slot(end, step)):
+            name = self.chunk_mapper.name(span_begin)
+            if self.chunk_mapper.begin(name) >= begin and \
+                    self.chunk_mapper.end(name) <= end:
+                if stats is not None:
+                    stats.check()
+                s = self.chunk_summary(name, stats)
+            else:
+                s = summarize_rows(self.select_array(max(span_begin, begin),
+                    min(span_end + step - 1, end), stats=stats), fields)
+            summary = merge_summaries(summary, s)
+
+        return dict([(f, summary[f]) for f in fields])
+
+    def _merged_levels(self, names):
+        """Find the data that the mergeable aggregates in ``names`` summarize
+        and the aggregates holding them.
+
+        Returns a tuple (base, levels) where levels is a list of (aggregate,
+        offset) tuples for the aggregates storing all of ``names`` computed
+        from the averages of base, finest first.  The row of an aggregate at
+        timestamp t summarizes the rows of base from t + offset to t + offset
+        + STEP - 1."""
+        if self.type == Aggregate:
+            return (self, [])
+
+        aggs = [self.get_aggregate(x) for x in self.list_aggregates()]
+        if not aggs:
+            return (self, [])
+
+        def has_all(agg):
+            for name in names:
+                if name not in agg.metadata['AGGREGATES']:
+                    return False
+            return True
+
+        first = None
+        for (i, agg) in enumerate(aggs):
+            if has_all(agg):
+                first = i
+                break
+        if first is None:
+            return (aggs[0], [])
+
+        # the first aggregate summarizes its own averages
+        if first == 0:
+            base = aggs[0]
+            first = 1
+        else:
+            base = aggs[first-1]
+
+        # Aggregator.update_from_aggregate() fills the row at t from the
+        # rows of the ancestor after t, so each level is offset from its
+        # ancestor by the ancestor's step
+        levels = []
+        offset = 0
+        for i in range(first, len(aggs)):
+            if not has_all(aggs[i]):
+                break
+            offset += aggs[i-1].metadata['STEP']
+            levels.append((aggs[i], offset))
+
+        return (base, levels)
+
+    def _merge_cover(self, base, levels, begin, end, from_base, from_rows,
+            stats=None):
+        """Merge the aggregates covering the rows of base from begin to end.
+
+        The slots of the coarsest level that lie within the range are used
+        and the remainder at each edge, as well as any invalid slots, is
+        covered by the finer levels, down to base itself.  ``from_base`` is
+        called with the valid averages of base and ``from_rows`` with the
+        valid rows of a level, both return something that can be summed.
+        The reads are recorded in ``stats``."""
+        if not levels:
+            return from_base(valid_points(base.select_array(begin, end,
+                flags=ROW_VALID, stats=stats), default_field(base))[1])
+
+        (agg, offset) = levels[-1]
+        step = agg.metadata['STEP']
+        # slots of agg from lo up to but not including hi
+        lo = max(calculate_slot(begin - offset + step - 1, step),
+                calculate_slot(agg.min_timestamp() + step - 1, step))
+        hi = min(calculate_slot(end - offset + 1, step),
+                calculate_slot(agg.metadata['LAST_UPDATE'], step),
+                calculate_slot(agg.max_timestamp(), step) + step)
+        if hi <= lo:
+            return self._merge_cover(base, levels[:-1], begin, end,
+                    from_base, from_rows, stats)
+
+        rows = agg.select_array(lo, hi - step, stats=stats)
+        valid = rows['flags'] & ROW_VALID != 0
+        total = from_rows(rows[valid])
+        for slot in rows['timestamp'][~valid]:
+            total += self._merge_cover(base, levels[:-1], int(slot) + offset,
+                    int(slot) + offset + step - 1, from_base, from_rows,
+                    stats)
+        if lo + offset > begin:
+            total += self._merge_cover(base, levels[:-1], begin,
+                    lo + offset - 1, from_base, from_rows, stats)
+        if hi + offset <= end:
+            total += self._merge_cover(base, levels[:-1], hi + offset, end,
+                    from_base, from_rows, stats)
+        return total
+
+    def percentile(self, q, begin=None, end=None, exact=False, stats=None,
+            limits=None):
+        """The q-th percentile (0 <= q <= 100) between begin and end.
+
+        Percentiles are taken over the valid averages of the finest aggregate
+        that is sketched, or of the first aggregate if there are no sketch
+        aggregates.  TSDBVars without aggregates and aggregates themselves
+        use their own data.  If aggregates hold sketches (the 'sketch'
+        aggregate) they are merged to estimate the percentile, reading a few
+        coarse rows for long ranges, with a relative error of at most
+        tsdb.sketch.SKETCH_ACCURACY.  Sketches don't hold values below 1, so
+        if the percentile is below 1 the data is read as well.  If ``exact``
+        is True all of the data is read and the exact value is returned.  ``stats`` and ``limits`` are
+        as for select_array().
+
+        Returns NaN if there is no data."""
+        if stats is None and limits is not None:
+            stats = QueryStats(limits)
+        (base, levels) = self._merged_levels(['sketch'])
+        (begin, end) = base._clip_range(begin, end)
+        if end < begin:
+            return float('NaN')
+
+        if not exact:
+            counts = self._merge_cover(base, levels, begin, end, sketch,
+                merge_sketch_rows, stats)
+            # values below 1 all share bucket 0, read the data for those
+            if sketch_rank_bucket(counts, q) != 0:
+                return sketch_quantile(counts, q)
+
+        return exact_percentile(valid_points(base.select_array(begin, end,
+            flags=ROW_VALID, stats=stats), default_field(base))[1], q)
+
+    def moments(self, begin=None, end=None, stats=None, limits=None):
+        """The mean, variance and standard deviation between begin and end.
+
+        As with percentile() these are taken over the valid averages of the
+        finest aggregate with the count and sumsq aggregates, or of the first
+        aggregate if there are none.  Aggregates storing count, sumsq and
+        delta are merged so that long ranges are computed from a few coarse
+        rows.
+
+        ``stats`` and ``limits`` are as for select_array().
+
+        Returns a dictionary with count, mean, variance (the population
+        variance) and stddev, the last three are NaN if there is no data."""
+        if stats is None and limits is not None:
+            stats = QueryStats(limits)
+        (base, levels) = self._merged_levels(['count', 'sumsq', 'delta'])
+        (begin, end) = base._clip_range(begin, end)
+
+        def from_base(values):
+            return numpy.array([len(values), values.sum(),
+                (values ** 2).sum()])
+
+        # delta is the sum of the deltas of the valid rows of base summarized
+        base_step = float(base.metadata['STEP'])
+        def from_rows(rows):
+            return numpy.array([rows['count'].sum(),
+                rows['delta'].sum() / base_step, rows['sumsq'].sum()])
+
+        if end < begin:
+            (count, total, sumsq) = (0, 0.0, 0.0)
+        else:
+            (count, total, sumsq) = self._merge_cover(base, levels, begin,
+                    end, from_base, from_rows, stats)
+
+        if count == 0:
+            return dict(count=0, mean=numpy.nan, variance=numpy.nan,
+                    stddev=numpy.nan)
+
+        mean = total / count
+        # rounding may make a constant series slightly negative
+        variance = max(sumsq / count - mean * mean, 0.0)
+        return dict(count=int(count), mean=mean, variance=variance,
+                stddev=numpy.sqrt(variance))
 
     def insert(self, data):
         """Insert data.  
 
         Data should be a subclass of TSDBRow."""
+        self._check_writable()
         chunk = self._chunk(data.timestamp, create=True)
 
+        self.dirty_summaries.add(chunk.name)
+        self.summaries.pop(chunk.name, None)
+
         max = self.metadata.get('MAX_TIMESTAMP')
         if max is None or max < data.timestamp:
             self.metadata['MAX_TIMESTAMP'] = data.timestamp
@@ -701,20 +1695,49 @@ class TSDBVar(TSDBBase):
         if min is None or min > data.timestamp:
             self.metadata['MIN_TIMESTAMP'] = data.timestamp
 
-        return chunk.write_row(data)
+        result = chunk.write_row(data)
+
+        # aggregate rows are published by update_aggregate() once final
+        broker = self.db.broker
+        if broker is not None and broker.subscriptions and \
+                self.type != Aggregate:
+            broker.publish(self.path.lstrip('/'), data)
+
+        return result
 
     def flush(self):
         """Flush all the chunks for this TSDBVar to disk."""
+        self._check_writable()
         for chunk in self.chunks:
             self.chunks[chunk].flush()
+
+        # chunk summaries are checked against the chunk modification time,
+        # remove those for changed chunks as well to be sure
+        for name in self.dirty_summaries:
+            self.summaries.pop(name, None)
+            if self.fs.exists(self._summary_path(name)):
+                self.fs.remove(self._summary_path(name))
+        if self.dirty_summaries and self.db.cache is not None:
+            self.db.cache.invalidate(self.path)
+        self.dirty_summaries.clear()
+
         self.save_metadata()
 
     def close(self):
         """Close this TSDBVar."""
-        self.flush()
+        if not self.db.read_only:
+            self.flush()
         for chunk in self.chunks:
             self.chunks[chunk].close()
 
+    def close_chunks(self):
+        """Close the open chunk files of this TSDBVar and of its loaded
+        aggregates, they are opened again when next read."""
+        for var in [self] + self.aggs.values():
+            for chunk in var.chunks.values():
+                chunk.close()
+            var.chunks.clear()
+
     def lock(self, block=True):
         """Acquire a write lock.
         
@@ -727,9 +1750,51 @@ class TSDBVar(TSDBBase):
         Note: NOT IMPLEMENTED."""
         warnings.warn("locking not implemented yet")
 
+class TSDBVarSnapshot(object):
+    """A consistent point in the data of a TSDBVar, see TSDBVar.snapshot().
+
+    ``generation`` is the GENERATION of the metadata and ``end`` the last
+    timestamp which may be read."""
+
+    def __init__(self, var, generation, end):
+        self.var = var
+        self.generation = generation
+        self.end = end
+
+    def __repr__(self):
+        return '<TSDBVarSnapshot %s generation %d end %d>' % (self.var.path,
+                self.generation, self.end)
+
+    def _end(self, end):
+        if end is None or end > self.end:
+            return self.end
+        return end
+
+    def select(self, begin=None, end=None, flags=None, **kwargs):
+        """TSDBVar.select() ending no later than the snapshot."""
+        return self.var.select(begin, self._end(end), flags=flags, **kwargs)
+
+    def select_array(self, begin=None, end=None, flags=None, **kwargs):
+        """TSDBVar.select_array() ending no later than the snapshot."""
+        return self.var.select_array(begin, self._end(end), flags=flags,
+                **kwargs)
+
+# access hints for TSDBVarChunk.advise(), used where mmap has madvise()
+MADVISE_OPTIONS = {
+    'sequential': 'MADV_SEQUENTIAL',
+    'random': 'MADV_RANDOM',
+    'willneed': 'MADV_WILLNEED',
+}
+
 class TSDBVarChunk(object):
     """A TSDBVarChunk is a physical file containing a portion of the data for
-    a TSDBVar."""
+    a TSDBVar.
+
+    If use_mmap is True the file is memory mapped, read only if the TSDB was
+    opened read only or the file can't be written.  Rows are then read
+    straight from the mapping without copying: read_array() returns a read
+    only array viewing the mapping, which stays valid after the chunk is
+    closed."""
 
     def __init__(self, tsdb_var, name, use_mmap=False):
         """Load the specified TSDBVarChunk."""
@@ -737,7 +1802,6 @@ class TSDBVarChunk(object):
         self.tsdb_var = tsdb_var
         self.name = name
         self.use_mmap = use_mmap
-        self.mode = self.tsdb_var.db.mode
         self.fs = tsdb_var.fs
 
         self.path = os.path.join(tsdb_var.path, name)
@@ -745,19 +1809,33 @@ class TSDBVarChunk(object):
         if not self.fs.exists(self.path):
             raise TSDBVarChunkDoesNotExistError(self.path)
 
+        self.writable = not tsdb_var.db.read_only
         try:
-            self.file = self.fs.open(self.path, self.mode)
+            if self.writable:
+                self.mode = tsdb_var.db.mode
+                self.file = self.fs.open(self.path, self.mode)
+            else:
+                # unbuffered so rows written by another process are seen
+                self.mode = "rb"
+                self.file = self.fs.open(self.path, self.mode, buffering=0)
         except IOError, e:
             # XXX this should be removed, left for now for compat
-            if e.errno == errno.EACCES:
+            if e.errno == errno.EACCES and self.writable:
                 self.file = self.fs.open(self.path, "r")
+                self.writable = False
             else:
                 raise
 
         self.size = self.fs.getsize(self.path)
 
+        self.mmap = None
+        self.advice = None  # the advice given for the whole chunk
         if self.use_mmap:
-            self.mmap = mmap.mmap(self.file.fileno(), self.size)
+            if self.writable:
+                access = mmap.ACCESS_WRITE
+            else:
+                access = mmap.ACCESS_READ
+            self.mmap = mmap.mmap(self.file.fileno(), self.size, access=access)
             self.io = self.mmap
         else:
             self.io = self.file
@@ -789,11 +1867,48 @@ class TSDBVarChunk(object):
 
     def flush(self):
         """Flush this TSDBVarChunk to disk."""
+        if not self.writable:
+            return
         return self.io.flush()
 
     def close(self):
-        """Close this TSDBVarChunk."""
-        return self.io.close()
+        """Close this TSDBVarChunk.
+
+        A mapping isn't closed explicitly as arrays returned by read_array()
+        may still view it, it is unmapped once they are gone."""
+        if self.mmap is not None:
+            self.mmap = None
+            self.io = None
+        return self.file.close()
+
+    def advise(self, advice, begin=None, end=None):
+        """Tell the kernel how the rows from the slot begin to the slot end
+        will be read, by default the whole chunk.
+
+        advice is one of the keys of MADVISE_OPTIONS.  This only has an
+        effect for memory mapped chunks where mmap objects have madvise()."""
+        if self.mmap is None or not hasattr(self.mmap, 'madvise'):
+            return
+        flag = getattr(mmap, MADVISE_OPTIONS[advice], None)
+        if flag is None:
+            return
+
+        if begin is None and end is None:
+            if self.advice != advice:
+                self.mmap.madvise(flag)
+                self.advice = advice
+            return
+
+        start = 0
+        stop = self.size
+        if begin is not None:
+            start = self._offset(begin)
+        if end is not None:
+            stop = self._offset(end) + self.tsdb_var.rowsize()
+        start -= start % mmap.PAGESIZE
+        stop = min(stop, self.size)
+        if stop > start:
+            self.mmap.madvise(flag, start, stop - start)
 
     def seek(self, position, whence=0):
         """Seek to the specified position."""
@@ -820,9 +1935,42 @@ class TSDBVarChunk(object):
         assert o >= 0
         return o
 
+    def read_array(self, begin, end):
+        """Read the rows from the slot begin to the slot end inclusive into a
+        numpy array."""
+        rowsize = self.tsdb_var.rowsize()
+        o = self._offset(begin)
+        n = (self._offset(end) - o) / rowsize + 1
+        if self.mmap is not None:
+            self.advise('sequential', begin, end)
+            return self._view(o, n)
+        self.io.seek(o)
+        return numpy.frombuffer(self.io.read(n * rowsize),
+                dtype=self.tsdb_var.dtype)
+
+    def read_all(self):
+        """Read every row in this chunk into a numpy array."""
+        rowsize = self.tsdb_var.rowsize()
+        if self.mmap is not None:
+            self.advise('sequential')
+            return self._view(0, self.size / rowsize)
+        self.io.seek(0)
+        return numpy.frombuffer(self.io.read(self.size - self.size % rowsize),
+                dtype=self.tsdb_var.dtype)
+
+    def _view(self, offset, n):
+        """A read only array of up to n rows of the mapping from offset."""
+        n = max(min(n, (self.size - offset) / self.tsdb_var.rowsize()), 0)
+        if n == 0:
+            return numpy.zeros(0, dtype=self.tsdb_var.dtype)
+        rows = numpy.frombuffer(self.mmap, dtype=self.tsdb_var.dtype,
+                count=n, offset=offset)
+        rows.flags.writeable = False
+        return rows
+
     def write_row(self, data):
         """Write a TSDBRow to disk."""
-        if self.use_mmap:
+        if self.mmap is not None:
             o = self._offset(data.timestamp)
             self.mmap[o:o+self.tsdb_var.rowsize()] = \
                     data.pack(self.tsdb_var.metadata)
@@ -832,11 +1980,9 @@ class TSDBVarChunk(object):
 
     def read_row(self, timestamp):
         """Read a TSDBRow from disk."""
-        if self.use_mmap:
-            o = self._offset(timestamp)
-            return self.tsdb_var.type.unpack(
-                    self.mmap[o:o+self.tsdb_var.rowsize()],
-                    self.tsdb_var.metadata)
+        if self.mmap is not None:
+            return self.tsdb_var.type.unpack_from(self.mmap,
+                    self._offset(timestamp), self.tsdb_var.metadata)
         else:
             self.io.seek(self._offset(timestamp))
             return self.tsdb_var.type.unpack(
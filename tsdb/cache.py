@@ -0,0 +1,155 @@
+"""
+Caching of query results.
+
+A QueryCache is made up of one or more tiers, usually a size bounded
+LRUCache in this process followed by a MemcacheCache shared between
+processes.  Entries are grouped by namespace, the path of a TSDBVar, and
+every tier keeps a generation number for each namespace which is part of the
+key of every entry, so invalidating a namespace is a matter of increasing its
+generation.  Old entries are never read again and age out of the tiers.
+
+>>> cache = QueryCache([LRUCache(64 * 1024 * 1024),
+...     MemcacheCache(memcache.Client(["127.0.0.1:11211"]))])
+>>> db = TSDB("/data/tsdb", cache=cache)
+"""
+
+import collections
+import hashlib
+import threading
+import time
+
+import numpy
+
+def _nbytes(value):
+    """Approximate size of a cached value in bytes."""
+    if isinstance(value, numpy.ndarray):
+        return value.nbytes
+    return len(str(value))
+
+class LRUCache(object):
+    """An in-process cache holding at most max_bytes of values.  It may be
+    shared between threads."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.entries = collections.OrderedDict()
+        self.generations = {}
+        self.lock = threading.Lock()
+
+    def generation(self, namespace):
+        return self.generations.get(namespace, 0)
+
+    def invalidate(self, namespace):
+        self.lock.acquire()
+        try:
+            self.generations[namespace] = self.generation(namespace) + 1
+        finally:
+            self.lock.release()
+
+    def get(self, key):
+        self.lock.acquire()
+        try:
+            try:
+                value = self.entries.pop(key)
+            except KeyError:
+                return None
+            self.entries[key] = value   # now the most recently used
+            return value
+        finally:
+            self.lock.release()
+
+    def set(self, key, value):
+        size = _nbytes(value)
+        if size > self.max_bytes:
+            return
+        self.lock.acquire()
+        try:
+            if self.entries.has_key(key):
+                self.bytes -= _nbytes(self.entries.pop(key))
+            self.entries[key] = value
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                (old_key, old) = self.entries.popitem(last=False)
+                self.bytes -= _nbytes(old)
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+            self.bytes = 0
+        finally:
+            self.lock.release()
+
+class MemcacheCache(object):
+    """A cache stored in memcached.
+
+    ``client`` is a memcache.Client or anything with the same get, set, add
+    and incr methods.  Values larger than max_item_bytes are not stored."""
+
+    def __init__(self, client, expire=0, max_item_bytes=1000000,
+            prefix="tsdb"):
+        self.client = client
+        self.expire = expire
+        self.max_item_bytes = max_item_bytes
+        self.prefix = prefix
+
+    def _key(self, key):
+        # memcached keys are limited in length and can't contain spaces
+        return "%s:%s" % (self.prefix, hashlib.md5(repr(key)).hexdigest())
+
+    def generation(self, namespace):
+        key = self._key(('generation', namespace))
+        gen = self.client.get(key)
+        if gen is None:
+            # start from the time so entries from before the generation was
+            # evicted aren't seen again
+            self.client.add(key, int(time.time() * 1000))
+            gen = self.client.get(key)
+        return gen
+
+    def invalidate(self, namespace):
+        key = self._key(('generation', namespace))
+        if self.client.incr(key) is None:
+            self.generation(namespace)
+
+    def get(self, key):
+        return self.client.get(self._key(key))
+
+    def set(self, key, value):
+        if _nbytes(value) <= self.max_item_bytes:
+            self.client.set(self._key(key), value, self.expire)
+
+class QueryCache(object):
+    """A cache made up of tiers, searched in order.
+
+    A value found in a later tier is copied to the earlier tiers."""
+
+    def __init__(self, tiers):
+        self.tiers = tiers
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, namespace, key):
+        """Look up key in namespace, returns None if it isn't cached."""
+        for (i, tier) in enumerate(self.tiers):
+            value = tier.get((namespace, tier.generation(namespace), key))
+            if value is not None:
+                for earlier in self.tiers[:i]:
+                    earlier.set((namespace, earlier.generation(namespace),
+                        key), value)
+                self.hits += 1
+                return value
+        self.misses += 1
+        return None
+
+    def set(self, namespace, key, value):
+        for tier in self.tiers:
+            tier.set((namespace, tier.generation(namespace), key), value)
+
+    def invalidate(self, namespace):
+        """Forget everything cached in namespace."""
+        for tier in self.tiers:
+            tier.invalidate(namespace)
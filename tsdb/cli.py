@@ -150,6 +150,15 @@ class TSDBCLI(Cmd):
                 pprint(attr)
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        from tsdb.server import main as serve
+        serve(sys.argv[2:])
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == 'export':
+        from tsdb.export import main as export
+        export(sys.argv[2:])
+        return
+
     parser = OptionParser(usage="%prog [options] DATABASE", version="%prog "+VERSION)
 
     (options, args) = parser.parse_args()
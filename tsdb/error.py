@@ -42,6 +42,10 @@ class TSDBVarIsNotAggregate(TSDBError):
     """This isn't an aggregate."""
     pass
 
+class TSDBVarIsNotCounter(TSDBError):
+    """This TSDBVar doesn't hold a counter."""
+    pass
+
 class TSDBNameInUseError(TSDBError):
     """The name requested is already in use."""
     pass
@@ -50,10 +54,34 @@ class InvalidInterval(TSDBError):
     """The interval specification did not parse."""
     pass
 
+class ExpressionError(TSDBError):
+    """The expression is invalid."""
+    pass
+
 class TSDBVarNoValidData(TSDBError):
     """The TSDBVar has no valid data"""
     pass
 
+class TSDBTimeoutError(TSDBError):
+    """The operation did not complete in time."""
+    pass
+
+class TSDBQueryLimitError(TSDBError):
+    """The query would exceed one of its limits."""
+    pass
+
+class TSDBQueryDeadlineError(TSDBQueryLimitError, TSDBTimeoutError):
+    """The query did not finish before its deadline."""
+    pass
+
+class TSDBQueryCancelledError(TSDBError):
+    """The query was cancelled."""
+    pass
+
+class TSDBReadOnlyError(TSDBError):
+    """The TSDB was opened read only."""
+    pass
+
 class UnableToCreateVarChunk(TSDBError):
     """Can't create a chunk"""
     pass
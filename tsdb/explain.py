@@ -0,0 +1,244 @@
+"""
+Explain, account for and limit the cost of queries.
+
+A QueryStats records what a read did: the TSDBVars read and their step, each
+chunk read with the layer of the file system it came from (0 is the first
+of the CHUNK_PREFIXES, see tsdb.filesystem.UnionFS), the estimated and actual
+bytes read, the rows decoded and returned, the query cache hits and misses
+and the wall time.  They are returned by TSDBVar.explain(),
+TSDBVar.explain_select() and TSDBBase.explain_matrix().
+
+If a TSDB has a SlowQueryLog every select(), select_array() and
+select_matrix() is timed and those slower than its threshold are logged.  One is created when
+the TSDB is opened if it has SLOW_QUERY_SECONDS metadata, logging to the
+file named by SLOW_QUERY_LOG or to stderr.
+
+Reads can also be given QueryLimits on the chunks, rows and bytes read from
+disk, a deadline and a CancelToken.  The size of each read is checked before
+anything is read and the deadline and token before every chunk, so a query
+breaking its limits fails early with a TSDBQueryLimitError, or a
+TSDBQueryCancelledError.  The limits apply to the whole query, such as all
+of the TSDBVars of a select_matrix().  Rows found in the cache are free.
+
+>>> print var.explain(begin, end, max_points=500)
+>>> limits = QueryLimits(max_bytes=100 * 1024 * 1024,
+...     deadline=time.time() + 30)
+>>> db.select_matrix("*/ifHCInOctets", begin, end, limits=limits)
+"""
+
+import collections
+import sys
+import threading
+import time
+
+from tsdb.error import TSDBQueryLimitError, TSDBQueryDeadlineError, \
+        TSDBQueryCancelledError
+
+ChunkRead = collections.namedtuple('ChunkRead', [
+    'path',             # path of the TSDBVar
+    'chunk',            # name of the chunk
+    'layer',            # index of the file system layer or None if missing
+    'estimated_bytes',  # bytes of the rows wanted from the chunk
+    'bytes',            # bytes actually read
+    'rows',             # rows decoded
+])
+
+class CancelToken(object):
+    """Cancel queries from another thread."""
+
+    def __init__(self):
+        self.event = threading.Event()
+
+    def cancel(self):
+        self.event.set()
+
+    def cancelled(self):
+        return self.event.is_set()
+
+class QueryLimits(object):
+    """Limits on the chunks, rows and bytes a query reads from disk.
+
+    ``deadline`` is the time, in seconds since the epoch, by which the query
+    must finish and ``cancel`` a CancelToken.  Any of them may be None."""
+
+    def __init__(self, max_rows=None, max_bytes=None, max_chunks=None,
+            deadline=None, cancel=None):
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_chunks = max_chunks
+        self.deadline = deadline
+        self.cancel = cancel
+
+    def __repr__(self):
+        return '<QueryLimits rows=%s bytes=%s chunks=%s deadline=%s>' % (
+                self.max_rows, self.max_bytes, self.max_chunks,
+                self.deadline)
+
+class QueryStats(object):
+    """The cost of a query, it may be shared by the threads reading for one
+    query.  ``limits`` are the QueryLimits of the query, if any."""
+
+    def __init__(self, limits=None):
+        self.limits = limits
+        # totals of the reads that have been allowed by reserve()
+        self.reserved_chunks = 0
+        self.reserved_rows = 0
+        self.reserved_bytes = 0
+        self.lock = threading.Lock()
+        self.vars = []          # (path, step, begin, end) of each read
+        self.chunks = []        # ChunkRead for each chunk read
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.rows = 0           # rows returned
+        self.started = time.time()
+        self.finished = None
+
+    def check(self):
+        """Raise an exception if the query has been cancelled or has passed
+        its deadline."""
+        limits = self.limits
+        if limits is None:
+            return
+        if limits.cancel is not None and limits.cancel.cancelled():
+            raise TSDBQueryCancelledError("query cancelled")
+        if limits.deadline is not None and time.time() > limits.deadline:
+            raise TSDBQueryDeadlineError(
+                    "query did not finish in %.3f seconds" %
+                    (limits.deadline - self.started, ))
+
+    def reserve(self, chunks, rows, nbytes):
+        """Account for a read about to be made, raises a
+        TSDBQueryLimitError if it would break the limits."""
+        self.check()
+        if self.limits is None:
+            return
+        self.lock.acquire()
+        try:
+            for (name, total, n, limit) in [
+                    ('chunks', self.reserved_chunks, chunks,
+                        self.limits.max_chunks),
+                    ('rows', self.reserved_rows, rows, self.limits.max_rows),
+                    ('bytes', self.reserved_bytes, nbytes,
+                        self.limits.max_bytes)]:
+                if limit is not None and total + n > limit:
+                    raise TSDBQueryLimitError(
+                            "query would read more than %d %s" %
+                            (limit, name))
+            self.reserved_chunks += chunks
+            self.reserved_rows += rows
+            self.reserved_bytes += nbytes
+        finally:
+            self.lock.release()
+
+    def add_var(self, var, begin, end):
+        self.lock.acquire()
+        try:
+            self.vars.append((var.path, var.metadata['STEP'], begin, end))
+        finally:
+            self.lock.release()
+
+    def add_chunk(self, chunk_read):
+        self.lock.acquire()
+        try:
+            self.chunks.append(chunk_read)
+        finally:
+            self.lock.release()
+
+    def add_cache(self, hit):
+        self.lock.acquire()
+        try:
+            if hit:
+                self.cache_hits += 1
+            else:
+                self.cache_misses += 1
+        finally:
+            self.lock.release()
+
+    def add_rows(self, n):
+        self.lock.acquire()
+        try:
+            self.rows += n
+        finally:
+            self.lock.release()
+
+    def finish(self):
+        """Stop the clock, returns self."""
+        if self.finished is None:
+            self.finished = time.time()
+        return self
+
+    def wall_time(self):
+        """Seconds from creation to finish() or until now."""
+        return (self.finished or time.time()) - self.started
+
+    def estimated_bytes(self):
+        return sum([x.estimated_bytes for x in self.chunks])
+
+    def bytes_read(self):
+        return sum([x.bytes for x in self.chunks])
+
+    def rows_decoded(self):
+        return sum([x.rows for x in self.chunks])
+
+    def layers(self):
+        """Dictionary mapping file system layer to the number of chunks read
+        from it, missing chunks are counted under None."""
+        counts = {}
+        for x in self.chunks:
+            counts[x.layer] = counts.get(x.layer, 0) + 1
+        return counts
+
+    def summary(self):
+        """The totals as a dictionary."""
+        return {
+            'vars': len(self.vars),
+            'chunks': len(self.chunks),
+            'layers': self.layers(),
+            'estimated_bytes': self.estimated_bytes(),
+            'bytes': self.bytes_read(),
+            'rows_decoded': self.rows_decoded(),
+            'rows': self.rows,
+            'cache_hits': self.cache_hits,
+            'cache_misses': self.cache_misses,
+            'wall_time': self.wall_time(),
+        }
+
+    def __str__(self):
+        lines = []
+        for (path, step, begin, end) in self.vars:
+            lines.append("%s step %d from %d to %d" % (path, step, begin, end))
+        for x in self.chunks:
+            lines.append("  %s/%s layer %s: %d/%d bytes, %d rows" % (x.path,
+                x.chunk, x.layer, x.bytes, x.estimated_bytes, x.rows))
+        lines.append(("%(vars)d vars, %(chunks)d chunks, %(bytes)d bytes "
+            "read of %(estimated_bytes)d estimated, %(rows_decoded)d rows "
+            "decoded, %(rows)d returned, %(cache_hits)d cache hits, "
+            "%(cache_misses)d misses, %(wall_time).3fs") % self.summary())
+        return "\n".join(lines)
+
+class SlowQueryLog(object):
+    """Write a line for each query taking at least ``threshold`` seconds to
+    ``out``, a file like object."""
+
+    def __init__(self, threshold, out=None):
+        self.threshold = threshold
+        self.out = out or sys.stderr
+        self.lock = threading.Lock()
+
+    def record(self, description, stats):
+        """Log the query if it was slow, returns True if it was."""
+        if stats.wall_time() < self.threshold:
+            return False
+        summary = stats.summary()
+        summary['layers'] = ",".join(["%s:%d" % x for x in
+            sorted(summary['layers'].items())])
+        line = "%s %s %s\n" % (time.strftime("%Y-%m-%dT%H:%M:%SZ",
+            time.gmtime(stats.started)), description, " ".join(["%s=%s" % x
+                for x in sorted(summary.items())]))
+        self.lock.acquire()
+        try:
+            self.out.write(line)
+            self.out.flush()
+        finally:
+            self.lock.release()
+        return True
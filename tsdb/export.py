@@ -0,0 +1,247 @@
+"""
+Bulk export of TSDBVars to NumPy and CSV files for offline analysis.
+
+The TSDBVars matching a pattern, or one of their aggregates, are read one
+chunk at a time and written as they are read, so memory use is bounded by a
+chunk per worker however long the time range.  The TSDBVars are exported in
+parallel by a pool of worker processes.  It is run with::
+
+    tsdb export [--begin T] [--end T] [--format npz|npy|csv]
+        [--aggregate STEP] [--flags F] [--processes N] DATABASE PATTERN OUTPUT
+
+The formats are:
+
+    npz     OUTPUT is a single .npz archive with one array per field of each
+            TSDBVar, named PATH/FIELD
+    npy     OUTPUT is a directory with a .npy file for each TSDBVar at
+            OUTPUT/PATH.npy holding a structured array of its rows
+    csv     OUTPUT is a directory with a .csv file for each TSDBVar at
+            OUTPUT/PATH.csv, with a header line naming the fields
+
+Rows are exported as select_array() returns them, including the invalid
+rows unless ``flags`` is given.  Sub-array fields such as sketch are only
+included in the npz and npy formats.
+
+>>> export("/data/tsdb", "rtr1/*", "rtr1.npz", begin, end)
+>>> data = numpy.load("rtr1.npz")
+>>> data['rtr1/ifHCInOctets/value']
+"""
+
+import csv
+import math
+import multiprocessing
+import os
+import os.path
+import shutil
+import struct
+import sys
+import tempfile
+import zipfile
+from optparse import OptionParser
+
+import numpy
+from numpy.lib import format as npy_format
+
+from tsdb.base import TSDB
+from tsdb.error import TSDBError, TSDBVarEmpty
+from tsdb.query import data_fields
+from tsdb.util import calculate_slot
+
+EXPORT_FORMATS = ('npz', 'npy', 'csv')
+
+def iter_chunks(var, begin=None, end=None, flags=None):
+    """Generate the rows of var.select_array(begin, end, flags) one chunk at
+    a time."""
+    try:
+        (begin, end) = var._clip_range(begin, end)
+    except TSDBVarEmpty:
+        return
+
+    step = var.metadata['STEP']
+    for (span_begin, span_end) in var._chunk_spans(calculate_slot(begin, step),
+            calculate_slot(end, step)):
+        rows = var._select_array(max(begin, span_begin),
+                min(end, span_end + step - 1), flags)
+        if len(rows):
+            yield rows
+
+def _npy_header(dtype, n):
+    """A version 1.0 .npy header for n rows of dtype.  The shape is padded to
+    a fixed width so the header can be rewritten once n is known."""
+    shape = "%20d," % (n, ) + "".join([" %d," % x for x in dtype.shape])
+    header = "{'descr': %r, 'fortran_order': False, 'shape': (%s), }" % (
+            npy_format.dtype_to_descr(dtype.base), shape)
+    # the magic string, version and length take 10 bytes
+    header += " " * (15 - (len(header) + 10) % 16) + "\n"
+    return npy_format.magic(1, 0) + struct.pack('<H', len(header)) + header
+
+def write_npy(f, rows_iter, dtype):
+    """Write the arrays generated by rows_iter to f, a seekable file, as one
+    .npy array.  Returns the number of rows written."""
+    dtype = numpy.dtype(dtype)
+    start = f.tell()
+    f.write(_npy_header(dtype, 0))
+    n = 0
+    for rows in rows_iter:
+        f.write(rows.astype(dtype).tostring())
+        n += len(rows)
+    end = f.tell()
+    f.seek(start)
+    f.write(_npy_header(dtype, n))
+    f.seek(end)
+    return n
+
+def _csv_value(x):
+    if isinstance(x, float) and math.isnan(x):
+        return ""
+    return x
+
+def write_csv(f, rows_iter, fields):
+    """Write fields of the arrays generated by rows_iter to f as CSV with a
+    header line.  Returns the number of rows written."""
+    writer = csv.writer(f)
+    writer.writerow(fields)
+    n = 0
+    for rows in rows_iter:
+        columns = [rows[x].tolist() for x in fields]
+        writer.writerows([[_csv_value(x) for x in row] for row in
+            zip(*columns)])
+        n += len(rows)
+    return n
+
+def _export_var(db, path, output, format, begin, end, flags, aggregate):
+    """Export one TSDBVar, returns the number of rows written.
+
+    For the npz format output is a directory to write a .npy file per field
+    in."""
+    var = db.get_var(path)
+    if aggregate is not None:
+        var = var.get_aggregate(aggregate)
+    dtype = var.dtype.newbyteorder('=')
+    rows = iter_chunks(var, begin, end, flags)
+
+    if format == 'csv':
+        f = open(output, "wb")
+        try:
+            return write_csv(f, rows, ['timestamp', 'flags'] +
+                    data_fields(dtype))
+        finally:
+            f.close()
+
+    if format == 'npy':
+        f = open(output, "wb")
+        try:
+            return write_npy(f, rows, dtype)
+        finally:
+            f.close()
+
+    # npz: one file per field, all written in a single pass over the data
+    files = [(x, open(os.path.join(output, x + ".npy"), "wb")) for x in
+            dtype.names]
+    try:
+        for (name, f) in files:
+            f.write(_npy_header(dtype[name], 0))
+        n = 0
+        for part in rows:
+            for (name, f) in files:
+                f.write(part[name].tostring())
+            n += len(part)
+        for (name, f) in files:
+            f.seek(0)
+            f.write(_npy_header(dtype[name], n))
+        return n
+    finally:
+        for (name, f) in files:
+            f.close()
+
+_worker_dbs = {}
+
+def _worker(args):
+    """Export a TSDBVar in a worker process, TSDBs are opened once per
+    worker."""
+    (root, path) = args[:2]
+    if not _worker_dbs.has_key(root):
+        _worker_dbs[root] = TSDB(root, mode="r")
+    return (path, _export_var(_worker_dbs[root], path, *args[2:]))
+
+def export(root, pattern, output, begin=None, end=None, format='npz',
+        aggregate=None, flags=None, processes=None):
+    """Export the TSDBVars of the TSDB at root matching pattern to output.
+
+    See the module documentation for the formats.  If ``aggregate`` is given
+    that aggregate of each TSDBVar is exported instead.  ``processes`` is the
+    number of worker processes, by default one per CPU.  Returns a
+    dictionary mapping path to the number of rows exported."""
+    if format not in EXPORT_FORMATS:
+        raise TSDBError("unknown export format: %s" % (format, ))
+
+    db = TSDB(root, mode="r")
+    paths = [x.lstrip('/') for x in db.find_vars(pattern)]
+
+    # the fields of each TSDBVar are written to files in work_dir and then
+    # added to the archive
+    if format == 'npz':
+        work_dir = tempfile.mkdtemp(prefix="tsdb-export-")
+    targets = {}
+    for (i, path) in enumerate(paths):
+        if format == 'npz':
+            target = os.path.join(work_dir, str(i))
+            os.makedirs(target)
+        else:
+            target = os.path.join(output, "%s.%s" % (path, format))
+            if not os.path.isdir(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+        targets[path] = target
+
+    work = [(root, path, targets[path], format, begin, end, flags, aggregate)
+            for path in paths]
+    try:
+        if processes == 1:
+            counts = dict([(x[1], _export_var(db, *x[1:])) for x in work])
+        else:
+            pool = multiprocessing.Pool(processes)
+            try:
+                counts = dict(pool.imap_unordered(_worker, work))
+            finally:
+                pool.close()
+                pool.join()
+
+        if format == 'npz':
+            archive = zipfile.ZipFile(output, "w", allowZip64=True)
+            try:
+                for path in paths:
+                    for name in sorted(os.listdir(targets[path])):
+                        archive.write(os.path.join(targets[path], name),
+                                "%s/%s" % (path, name))
+            finally:
+                archive.close()
+    finally:
+        if format == 'npz':
+            shutil.rmtree(work_dir)
+
+    return counts
+
+def main(argv=None):
+    parser = OptionParser(
+            usage="%prog export [options] DATABASE PATTERN OUTPUT")
+    parser.add_option("--begin", type="int", help="first timestamp")
+    parser.add_option("--end", type="int", help="last timestamp")
+    parser.add_option("--format", choices=EXPORT_FORMATS, default="npz",
+            help="one of %s [%%default]" % (", ".join(EXPORT_FORMATS), ))
+    parser.add_option("--aggregate",
+            help="export this aggregate, for example 1d, of each var")
+    parser.add_option("--flags", type="int",
+            help="only export rows with these flags set")
+    parser.add_option("--processes", type="int",
+            help="number of worker processes [one per CPU]")
+
+    (options, args) = parser.parse_args(argv)
+    if len(args) != 3:
+        parser.error("must specify database, pattern and output")
+
+    counts = export(args[0], args[1], args[2], begin=options.begin,
+            end=options.end, format=options.format,
+            aggregate=options.aggregate, flags=options.flags,
+            processes=options.processes)
+    print >>sys.stderr, "exported %d rows from %d vars to %s" % (
+            sum(counts.values()), len(counts), args[2])
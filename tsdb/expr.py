@@ -0,0 +1,278 @@
+"""
+Expressions over TSDBVars.
+
+An expression is written using Python syntax and refers to TSDBVars by path.
+It is compiled into a tree of nodes which are evaluated with numpy over
+arrays aligned to a common grid of timestamps.  Slots without valid data are
+NaN and NaN propagates through arithmetic.
+
+The following are available:
+
+    var(path[, aggregate[, field]])
+                        the data of a TSDBVar or one of its aggregates, by
+                        default value for raw data and average for aggregates
+    rate(path)          the rate of a counter computed from raw data
+    shift(x, interval)  x as it was interval earlier, eg. shift(x, "1w")
+    mavg(x, n)          moving average over the last n slots
+    msum(x, n)          moving sum over the last n slots
+    ewma(x, alpha)      exponentially weighted moving average
+    fill(x, value)      replace missing data with value
+    abs(x)              absolute value
+
+as well as numbers, +, -, *, / and parentheses.  Division by zero gives NaN.
+
+>>> e = Expression('(var("rtr/in") + var("rtr/out")) * 8 / var("rtr/speed")')
+
+Evaluation is lazy: only the TSDBVars used by the expression are read and
+only for the time range needed, which for shift() and the windowed functions
+extends beyond the range requested.
+"""
+
+import ast
+
+import numpy
+
+from tsdb.error import TSDBVarEmpty, ExpressionError
+from tsdb.query import grid, load_resampled, resample_points
+from tsdb.util import calculate_interval
+
+class Node(object):
+    """A node in a compiled expression."""
+
+    def evaluate(self, container, begin, end, step, stats=None):
+        """Return an array of values for grid(begin, end, step), recording
+        the reads in ``stats``, a tsdb.explain.QueryStats, if given."""
+        raise NotImplementedError("evaluate")
+
+class Constant(Node):
+    def __init__(self, value):
+        self.value = float(value)
+
+    def evaluate(self, container, begin, end, step, stats=None):
+        values = numpy.empty(len(grid(begin, end, step)))
+        values.fill(self.value)
+        return values
+
+class Var(Node):
+    def __init__(self, path, aggregate=None, field=None):
+        self.path = path
+        self.aggregate = aggregate
+        self.field = field
+
+    def evaluate(self, container, begin, end, step, stats=None):
+        var = container.get_var(self.path)
+        if self.aggregate is not None:
+            var = var.get_aggregate(self.aggregate)
+        return load_resampled(var, begin, end, step, self.field, stats)[0]
+
+class Rate(Node):
+    def __init__(self, path):
+        self.path = path
+
+    def evaluate(self, container, begin, end, step, stats=None):
+        var = container.get_var(self.path)
+        try:
+            (timestamps, rates) = var.rate(begin, end, stats=stats)
+        except TSDBVarEmpty:
+            (timestamps, rates) = (numpy.zeros(0), numpy.zeros(0))
+        return resample_points(timestamps, rates, begin, end, step)[0]
+
+class BinOp(Node):
+    def __init__(self, op, left, right):
+        self.op = op
+        self.left = left
+        self.right = right
+
+    def evaluate(self, container, begin, end, step, stats=None):
+        left = self.left.evaluate(container, begin, end, step, stats)
+        right = self.right.evaluate(container, begin, end, step, stats)
+        old = numpy.seterr(divide='ignore', invalid='ignore')
+        try:
+            values = self.op(left, right)
+        finally:
+            numpy.seterr(**old)
+        values[numpy.isinf(values)] = numpy.nan
+        return values
+
+class Negate(Node):
+    def __init__(self, operand):
+        self.operand = operand
+
+    def evaluate(self, container, begin, end, step, stats=None):
+        return -self.operand.evaluate(container, begin, end, step, stats)
+
+class Abs(Negate):
+    def evaluate(self, container, begin, end, step, stats=None):
+        return numpy.abs(self.operand.evaluate(container, begin, end, step,
+            stats))
+
+class Shift(Node):
+    def __init__(self, operand, interval):
+        self.operand = operand
+        self.interval = interval
+
+    def evaluate(self, container, begin, end, step, stats=None):
+        offset = (self.interval // step) * step
+        return self.operand.evaluate(container, int(begin) - offset,
+                int(end) - offset, step, stats)
+
+class Fill(Node):
+    def __init__(self, operand, value):
+        self.operand = operand
+        self.value = value
+
+    def evaluate(self, container, begin, end, step, stats=None):
+        values = self.operand.evaluate(container, begin, end, step, stats)
+        values[numpy.isnan(values)] = self.value
+        return values
+
+class Window(Node):
+    """Moving sum or average over the last n slots ignoring missing data."""
+
+    def __init__(self, operand, n, average=True):
+        self.operand = operand
+        self.n = int(n)
+        self.average = average
+        if self.n < 1:
+            raise ExpressionError("window must be at least 1 slot")
+
+    def evaluate(self, container, begin, end, step, stats=None):
+        n = self.n
+        values = self.operand.evaluate(container, int(begin) - (n - 1) * step,
+                end, step, stats)
+        missing = numpy.isnan(values)
+
+        sums = numpy.concatenate(([0], numpy.where(missing, 0,
+            values).cumsum()))
+        counts = numpy.concatenate(([0], (~missing).cumsum()))
+        sums = sums[n:] - sums[:-n]
+        counts = counts[n:] - counts[:-n]
+
+        if self.average:
+            old = numpy.seterr(divide='ignore', invalid='ignore')
+            try:
+                sums = sums / counts
+            finally:
+                numpy.seterr(**old)
+        sums[counts == 0] = numpy.nan
+        return sums
+
+class EWMA(Node):
+    def __init__(self, operand, alpha):
+        self.operand = operand
+        self.alpha = float(alpha)
+        if not 0 < self.alpha <= 1:
+            raise ExpressionError("alpha must be in (0, 1]")
+
+    def evaluate(self, container, begin, end, step, stats=None):
+        values = self.operand.evaluate(container, begin, end, step, stats)
+        out = numpy.empty(len(values))
+        current = numpy.nan
+        # missing data carries the current average forward
+        for i in range(len(values)):
+            if values[i] == values[i]:
+                if current == current:
+                    current = self.alpha * values[i] + \
+                            (1 - self.alpha) * current
+                else:
+                    current = values[i]
+            out[i] = current
+        return out
+
+BINARY_OPS = {
+    ast.Add: numpy.add,
+    ast.Sub: numpy.subtract,
+    ast.Mult: numpy.multiply,
+    ast.Div: numpy.true_divide,
+}
+
+class Expression(object):
+    """A compiled expression."""
+
+    def __init__(self, source):
+        self.source = source
+        try:
+            tree = ast.parse(source.strip(), mode='eval')
+        except SyntaxError, e:
+            raise ExpressionError("unable to parse %r: %s" % (source, e))
+        self.root = self._compile(tree.body)
+
+    def __str__(self):
+        return self.source
+
+    def __repr__(self):
+        return '<Expression %s>' % (self.source, )
+
+    def _compile(self, node):
+        if isinstance(node, ast.Num):
+            return Constant(node.n)
+        elif isinstance(node, ast.BinOp) and type(node.op) in BINARY_OPS:
+            return BinOp(BINARY_OPS[type(node.op)], self._compile(node.left),
+                    self._compile(node.right))
+        elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+            return Negate(self._compile(node.operand))
+        elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.UAdd):
+            return self._compile(node.operand)
+        elif isinstance(node, ast.Call) and isinstance(node.func, ast.Name) \
+                and not node.keywords:
+            return self._compile_call(node.func.id, node.args)
+
+        raise ExpressionError("unsupported expression: %s" % (
+            ast.dump(node), ))
+
+    def _literal(self, node, kind):
+        if kind == str and isinstance(node, ast.Str):
+            return node.s
+        if kind == float and isinstance(node, ast.Num):
+            return node.n
+        if kind == float and isinstance(node, ast.UnaryOp) and \
+                isinstance(node.op, ast.USub) and \
+                isinstance(node.operand, ast.Num):
+            return -node.operand.n
+        raise ExpressionError("expected a %s literal" % (
+            {str: 'string', float: 'number'}[kind], ))
+
+    def _compile_call(self, name, args):
+        def check_args(lo, hi):
+            if not lo <= len(args) <= hi:
+                raise ExpressionError("wrong number of arguments to %s()" %
+                        (name, ))
+
+        if name == 'var':
+            check_args(1, 3)
+            return Var(*[self._literal(x, str) for x in args])
+        elif name == 'rate':
+            check_args(1, 1)
+            return Rate(self._literal(args[0], str))
+        elif name == 'shift':
+            check_args(2, 2)
+            return Shift(self._compile(args[0]),
+                    calculate_interval(self._literal(args[1], str)))
+        elif name in ('mavg', 'msum'):
+            check_args(2, 2)
+            return Window(self._compile(args[0]), self._literal(args[1], float),
+                    average=(name == 'mavg'))
+        elif name == 'ewma':
+            check_args(2, 2)
+            return EWMA(self._compile(args[0]), self._literal(args[1], float))
+        elif name == 'fill':
+            check_args(2, 2)
+            return Fill(self._compile(args[0]), self._literal(args[1], float))
+        elif name == 'abs':
+            check_args(1, 1)
+            return Abs(self._compile(args[0]))
+
+        raise ExpressionError("unknown function %s()" % (name, ))
+
+    def evaluate(self, container, begin, end, step, stats=None):
+        """Evaluate the expression.
+
+        Paths are relative to ``container``, a TSDB or TSDBSet.  Returns a
+        tuple of numpy arrays (timestamps, values) for the slots of ``step``
+        seconds between begin and end.  Missing data is NaN.  The reads are
+        recorded in ``stats``, a tsdb.explain.QueryStats, if given and are
+        subject to its limits."""
+        step = int(step)
+        values = self.root.evaluate(container, int(begin), int(end), step,
+                stats)
+        return grid(begin, end, step), values
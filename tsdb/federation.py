@@ -0,0 +1,264 @@
+"""
+Read only queries across several TSDBs.
+
+A FederatedTSDB mounts several TSDB roots under namespaces, for example one
+per poller or region, and TSDBVars are named by namespace followed by their
+path in that TSDB.  Queries are split by namespace, run on each TSDB by a
+pool of worker threads or processes and the results are merged as they
+arrive.
+
+>>> fed = FederatedTSDB({'east': "/data/east", 'west': "/data/west"})
+>>> fed.top_n("*/ifHCInOctets", begin, end, 10)
+>>> fed.summarize("west/rtr1/*", begin, end)
+"""
+
+import fnmatch
+import heapq
+import itertools
+import multiprocessing
+import os.path
+import threading
+from multiprocessing.pool import ThreadPool
+
+import numpy
+
+from tsdb.base import TSDB
+from tsdb.error import TSDBError, TSDBVarDoesNotExistError, TSDBVarEmpty
+from tsdb.expr import Expression
+from tsdb.query import grid, select_matrix, top_n, default_field, \
+        empty_summary, merge_summaries
+
+def _fresh_var(db, path):
+    """Get a TSDBVar of a member TSDB, refreshing it and its aggregates so
+    that data written since an earlier query is seen."""
+    var = db.get_var(path)
+    var.refresh()
+    for agg in var.aggs.values():
+        agg.refresh()
+    return var
+
+def _find_vars(db, pattern):
+    return db.find_vars(pattern)
+
+def _select_matrix(db, paths, begin, end, step, field):
+    (timestamps, matrix, mask) = select_matrix([_fresh_var(db, x) for x in
+        paths], begin, end, step=step, field=field)
+    return (paths, matrix, mask)
+
+def _top_n(db, paths, begin, end, n, metric, points, field):
+    vars = (_fresh_var(db, x) for x in paths)
+    return [(value, path.lstrip('/')) for (value, path) in top_n(vars, begin,
+        end, n, metric=metric, points=points, field=field)]
+
+def _summarize(db, paths, begin, end, field):
+    summaries = []
+    for path in paths:
+        var = _fresh_var(db, path)
+        f = field or default_field(var)
+        try:
+            summaries.append((path, var.summarize(begin, end, fields=[f])[f]))
+        except TSDBVarEmpty:
+            summaries.append((path, empty_summary([f])[f]))
+    return summaries
+
+_worker_dbs = {}
+
+def _worker(args):
+    """Run a query in a worker process, TSDBs are opened once per worker."""
+    (root, func, func_args) = args
+    if not _worker_dbs.has_key(root):
+        _worker_dbs[root] = TSDB(root, mode="r")
+    return func(_worker_dbs[root], *func_args)
+
+def _worker_tagged(item):
+    (i, args) = item
+    return (i, _worker(args))
+
+class FederatedTSDB(object):
+    """Several TSDBs mounted under namespaces.
+
+    ``roots`` is a dictionary mapping namespace to the path of a TSDB.  If
+    ``processes`` is given queries are run in a pool of that many worker
+    processes, each of which opens the TSDBs itself, otherwise a thread is
+    used per namespace.  The pool is started by the first query and kept
+    until close() is called.  The member TSDBs stay open as long as the
+    FederatedTSDB and every TSDBVar is refreshed when a query uses it, so
+    data written by other processes is seen.
+
+    Only reading is supported, each TSDB is opened with mode "r".  Queries
+    don't take a tsdb.explain.QueryStats or QueryLimits as these can't be
+    shared with worker processes."""
+
+    def __init__(self, roots, processes=None):
+        self.roots = dict(roots)
+        self.processes = processes
+        self.pool = None
+        self.pool_lock = threading.Lock()
+        self.members = {}
+        for (namespace, root) in self.roots.items():
+            if '/' in namespace:
+                raise TSDBError("namespace may not contain '/': %s" %
+                        (namespace, ))
+            self.members[namespace] = TSDB(root, mode="r")
+
+    def __repr__(self):
+        return '<FederatedTSDB %s>' % (', '.join(self.namespaces()), )
+
+    def _pool(self):
+        self.pool_lock.acquire()
+        try:
+            if self.pool is None:
+                if self.processes:
+                    self.pool = multiprocessing.Pool(self.processes)
+                else:
+                    self.pool = ThreadPool(len(self.members))
+            return self.pool
+        finally:
+            self.pool_lock.release()
+
+    def close(self):
+        """Stop the worker pool."""
+        self.pool_lock.acquire()
+        try:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+                self.pool = None
+        finally:
+            self.pool_lock.release()
+
+    def namespaces(self):
+        """Sorted list of namespaces."""
+        return sorted(self.roots.keys())
+
+    def _split(self, path):
+        (namespace, _, rest) = path.partition('/')
+        if not self.members.has_key(namespace) or not rest:
+            raise TSDBVarDoesNotExistError("no such TSDBVar: %s" % (path, ))
+        return namespace, rest
+
+    def get_var(self, path):
+        """Get the TSDBVar at namespace/path, refreshed to see the data
+        written since it was loaded."""
+        (namespace, rest) = self._split(path)
+        return _fresh_var(self.members[namespace], rest)
+
+    def release_var(self, path):
+        """See TSDBBase.release_var()."""
+        (namespace, rest) = self._split(path)
+        self.members[namespace].release_var(rest)
+
+    def _fan_out(self, func, work):
+        """Run func(db, *args) for each (namespace, args) in work.
+
+        Generates (namespace, result) tuples in the order they complete."""
+        if not work:
+            return
+
+        namespaces = [x[0] for x in work]
+        pool = self._pool()
+        if self.processes:
+            tasks = [(self.roots[ns], func, args) for (ns, args) in work]
+            results = pool.imap_unordered(_worker_tagged, enumerate(tasks))
+        else:
+            def run(item):
+                (i, (ns, args)) = item
+                return (i, func(self.members[ns], *args))
+            results = pool.imap_unordered(run, enumerate(work))
+
+        for (i, result) in results:
+            yield (namespaces[i], result)
+
+    def _group(self, paths):
+        """Group paths by namespace, returns a list of (namespace, [path])
+        with the paths relative to the namespace."""
+        groups = {}
+        for path in paths:
+            (namespace, rest) = self._split(path)
+            groups.setdefault(namespace, []).append(rest)
+        return sorted(groups.items())
+
+    def find_vars(self, pattern="*"):
+        """Find TSDBVars in all namespaces matching pattern.
+
+        Returns a sorted list of paths including the namespace, see
+        TSDBBase.find_vars()."""
+        work = []
+        for namespace in self.namespaces():
+            # only a literal namespace can be passed on, since * matches /
+            if pattern.startswith(namespace + '/'):
+                work.append((namespace, (pattern[len(namespace)+1:], )))
+            else:
+                work.append((namespace, ("*", )))
+
+        found = []
+        for (namespace, paths) in self._fan_out(_find_vars, work):
+            found.append([os.path.join(namespace, x) for x in paths if
+                fnmatch.fnmatchcase(os.path.join(namespace, x), pattern)])
+        return list(heapq.merge(*found))
+
+    def _paths(self, vars):
+        if isinstance(vars, basestring):
+            return self.find_vars(vars)
+        return list(vars)
+
+    def select_matrix(self, vars, begin, end, step=None, field=None):
+        """Like TSDBBase.select_matrix() for TSDBVars in any namespace.
+
+        Each namespace is read in parallel.  Returns a tuple of (paths,
+        timestamps, matrix, mask)."""
+        paths = self._paths(vars)
+        if step is None:
+            step = max([self.get_var(x).metadata['STEP'] for x in paths]
+                    or [1])
+
+        rows = {}
+        work = [(ns, (sub, begin, end, step, field)) for (ns, sub) in
+                self._group(paths)]
+        for (namespace, (sub, matrix, mask)) in self._fan_out(
+                _select_matrix, work):
+            for (i, path) in enumerate(sub):
+                rows[os.path.join(namespace, path)] = (matrix[i], mask[i])
+
+        timestamps = grid(begin, end, step)
+        matrix = numpy.empty((len(paths), len(timestamps)))
+        mask = numpy.zeros(matrix.shape, dtype=bool)
+        for (i, path) in enumerate(paths):
+            (matrix[i], mask[i]) = rows[path]
+        return (paths, timestamps, matrix, mask)
+
+    def top_n(self, var_pattern, begin, end, n, metric='average', points=12,
+            field=None):
+        """Like TSDBBase.top_n() across all namespaces."""
+        work = [(ns, (sub, begin, end, n, metric, points, field)) for
+                (ns, sub) in self._group(self.find_vars(var_pattern))]
+        best = []
+        for (namespace, results) in self._fan_out(_top_n, work):
+            best = heapq.nlargest(n, itertools.chain(best,
+                [(value, os.path.join(namespace, path)) for (value, path) in
+                    results]))
+        return best
+
+    def summarize(self, vars, begin=None, end=None, field=None):
+        """Summarize each TSDBVar and all of them together.
+
+        ``vars`` is a list of paths or a pattern for find_vars().  ``field``
+        defaults to value for raw data and average for aggregates.  Returns a
+        tuple of a dictionary mapping path to the summary of that TSDBVar,
+        see TSDBVar.summarize(), and the summary of all of them."""
+        work = [(ns, (sub, begin, end, field)) for (ns, sub) in
+                self._group(self._paths(vars))]
+        summaries = {}
+        total = empty_summary(['total'])
+        for (namespace, results) in self._fan_out(_summarize, work):
+            for (path, summary) in results:
+                summaries[os.path.join(namespace, path)] = summary
+                total = merge_summaries(total, {'total': summary})
+        return summaries, total['total']
+
+    def evaluate(self, expression, begin, end, step):
+        """Evaluate an expression, see TSDBBase.evaluate().  Paths in the
+        expression include the namespace."""
+        if isinstance(expression, basestring):
+            expression = Expression(expression)
+        return expression.evaluate(self, begin, end, step)
@@ -31,6 +31,22 @@ class OSFS(object):
     def getsize(self, path):
         return os.path.getsize(self.resolve_path(path))
 
+    def getmtime(self, path):
+        return os.path.getmtime(self.resolve_path(path))
+
+    def layer(self, path):
+        """Index of the layer holding path, always 0, or None if it doesn't
+        exist."""
+        if self.exists(path):
+            return 0
+        return None
+
+    def remove(self, path):
+        return os.remove(self.resolve_path(path))
+
+    def rename(self, src, dst):
+        return os.rename(self.resolve_path(src), self.resolve_path(dst))
+
     def makedir(self, path):
         return os.mkdir(self.resolve_path(path))
 
@@ -100,6 +116,14 @@ class UnionFS(object):
     def addfs(self, fs):
         self.fs_sequence.append(fs)
 
+    def layer(self, path):
+        """Index of the first subfilesystem holding path or None if it
+        doesn't exist."""
+        for (i, fs) in enumerate(self.fs_sequence):
+            if fs.exists(path):
+                return i
+        return None
+
     def exists(self, path):
         return self._search(path) is not None
 
@@ -122,6 +146,19 @@ class UnionFS(object):
     def getsize(self, path):
         return os.path.getsize(self.resolve_path(path))
 
+    def getmtime(self, path):
+        return os.path.getmtime(self.resolve_path(path))
+
+    def remove(self, path):
+        return os.remove(self.resolve_path(path))
+
+    def rename(self, src, dst):
+        """Rename src within the subfilesystem holding it."""
+        fs = self._search(src)
+        if not fs:
+            raise self._not_found(src)
+        return fs.rename(src, dst)
+
     def listdir(self, path):
         files = []
         notfound_cnt = 0
@@ -0,0 +1,123 @@
+"""
+Publish new rows to subscribers.
+
+A Broker delivers the rows written to a TSDB to the Subscriptions whose
+patterns match the path of the TSDBVar, instead of clients polling with
+select().  Raw rows are delivered as insert() writes them and aggregate rows
+once they are final, see TSDBVar.final_timestamp().
+
+Each Subscription has a bounded queue.  When it is full either the oldest
+message is dropped (overflow='drop') or the writer waits for up to
+``timeout`` seconds for room (overflow='block'), slowing the writer down
+to the pace of the subscriber.  Messages that could not be delivered are
+counted in the dropped attribute.
+
+>>> sub = db.subscribe(["rtr/*/ifHCInOctets"])
+>>> for (path, row) in sub:
+...     print path, row
+"""
+
+import copy
+import fnmatch
+import threading
+import Queue
+
+OVERFLOW_POLICIES = ('drop', 'block')
+
+class Subscription(object):
+    """A queue of (path, row) messages for the TSDBVars matching patterns."""
+
+    def __init__(self, broker, patterns, maxsize=1000, overflow='drop',
+            timeout=None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("unknown overflow policy: %s" % (overflow, ))
+        self.broker = broker
+        self.patterns = list(patterns)
+        self.queue = Queue.Queue(maxsize)
+        self.overflow = overflow
+        self.timeout = timeout
+        self.dropped = 0
+
+    def matches(self, path):
+        for pattern in self.patterns:
+            if fnmatch.fnmatchcase(path, pattern):
+                return True
+        return False
+
+    def put(self, message):
+        """Queue a message following the overflow policy."""
+        if self.overflow == 'block':
+            try:
+                self.queue.put(message, True, self.timeout)
+            except Queue.Full:
+                self.dropped += 1
+            return
+
+        while True:
+            try:
+                self.queue.put_nowait(message)
+                return
+            except Queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                except Queue.Empty:
+                    pass
+
+    def get(self, timeout=None):
+        """The next (path, row) message, or None if there is none within
+        timeout seconds."""
+        try:
+            return self.queue.get(True, timeout)
+        except Queue.Empty:
+            return None
+
+    def __iter__(self):
+        while True:
+            yield self.queue.get()
+
+    def close(self):
+        """Stop receiving messages."""
+        self.broker.unsubscribe(self)
+
+class Broker(object):
+    """Deliver published rows to matching Subscriptions."""
+
+    def __init__(self):
+        self.subscriptions = []
+        self.lock = threading.Lock()
+
+    def subscribe(self, patterns, maxsize=1000, overflow='drop',
+            timeout=None):
+        """Subscribe to the TSDBVars with paths matching any of patterns,
+        see Subscription."""
+        if isinstance(patterns, basestring):
+            patterns = [patterns]
+        return self.attach(Subscription(self, patterns, maxsize=maxsize,
+                overflow=overflow, timeout=timeout))
+
+    def attach(self, sub):
+        """Add a subscriber, anything with matches(path) and put(message)
+        methods such as a Subscription or a tsdb.rules.RuleSet."""
+        self.lock.acquire()
+        try:
+            self.subscriptions = self.subscriptions + [sub]
+        finally:
+            self.lock.release()
+        return sub
+
+    def unsubscribe(self, sub):
+        self.lock.acquire()
+        try:
+            self.subscriptions = [x for x in self.subscriptions if x is not sub]
+        finally:
+            self.lock.release()
+
+    def publish(self, path, row):
+        """Deliver a copy of row to every subscriber of path."""
+        message = None
+        for sub in self.subscriptions:
+            if sub.matches(path):
+                if message is None:
+                    message = (path, copy.copy(row))
+                sub.put(message)
@@ -0,0 +1,464 @@
+"""
+Vectorized queries over one or more TSDBVars.
+
+The functions in this module work on the numpy arrays returned by
+TSDBVar.select_array() rather than on individual TSDBRows.
+"""
+
+import heapq
+import itertools
+from multiprocessing.pool import ThreadPool
+
+import numpy
+
+from tsdb.error import TSDBVarEmpty, TSDBVarIsNotCounter
+from tsdb.row import Aggregate, ROW_VALID
+from tsdb.util import calculate_slot
+
+def default_field(var):
+    """The field holding the data of interest for a TSDBVar."""
+    if var.type == Aggregate:
+        return 'average'
+    return 'value'
+
+def grid(begin, end, step):
+    """Timestamps of the slots of size step covering begin to end."""
+    return numpy.arange(calculate_slot(begin, step), int(end) + 1, step)
+
+def valid_points(rows, field):
+    """Return (timestamps, values) for the rows with ROW_VALID set whose value
+    for field is not NaN."""
+    values = rows[field].astype(float)
+    ok = (rows['flags'] & ROW_VALID != 0) & ~numpy.isnan(values)
+    return rows['timestamp'][ok].astype(numpy.int64), values[ok]
+
+def resample(rows, field, begin, end, step):
+    """Resample rows onto the grid of slots of size step from begin to end.
+
+    Only rows with ROW_VALID set and a value which is not NaN are used.  When
+    several rows fall in the same slot their mean is used.
+
+    Returns a tuple of (values, mask) where mask is True where the slot has
+    data.  Slots without data contain NaN."""
+    (timestamps, values) = valid_points(rows, field)
+    return resample_points(timestamps, values, begin, end, step)
+
+def resample_points(timestamps, values, begin, end, step):
+    """Resample points given as arrays of timestamps and values, see
+    resample()."""
+    slots = grid(begin, end, step)
+    n = len(slots)
+    if n == 0:
+        return numpy.zeros(0), numpy.zeros(0, dtype=bool)
+
+    idx = (timestamps.astype(numpy.int64) - slots[0]) // step
+    ok = (idx >= 0) & (idx < n) & ~numpy.isnan(values)
+
+    counts = numpy.bincount(idx[ok], minlength=n)[:n]
+    sums = numpy.bincount(idx[ok], weights=values[ok], minlength=n)[:n]
+
+    mask = counts > 0
+    out = numpy.empty(n)
+    out.fill(numpy.nan)
+    out[mask] = sums[mask] / counts[mask]
+
+    return out, mask
+
+def load_resampled(var, begin, end, step, field=None, stats=None):
+    """Read and resample a single TSDBVar, see resample()."""
+    if field is None:
+        field = default_field(var)
+
+    try:
+        rows = var.select_array(begin, end, stats=stats)
+    except TSDBVarEmpty:
+        rows = numpy.zeros(0, dtype=var.dtype.newbyteorder('='))
+
+    return resample(rows, field, begin, end, step)
+
+def select_matrix(vars, begin, end, step=None, field=None, threads=None,
+        stats=None):
+    """Read the same time range from a list of TSDBVars.
+
+    Each TSDBVar is resampled onto a common grid with ``step`` seconds
+    between slots.  If ``step`` is None the largest step of the TSDBVars is
+    used.  ``field`` selects the row field to use, by default this is
+    ``value`` for raw data and ``average`` for Aggregates.
+
+    The TSDBVars are read in order of their path so that related data is
+    read together, each TSDBVar is read one chunk at a time from oldest to
+    newest.  If ``threads`` is given the TSDBVars are read by a pool of that
+    many threads.  The reads are recorded in ``stats``, a
+    tsdb.explain.QueryStats, if given and are subject to its limits.  The
+    chunks of each TSDBVar are closed once it has been read, see
+    TSDBVar.close_chunks().
+
+    Returns a tuple of (timestamps, matrix, mask) where matrix has one row
+    per TSDBVar and one column per timestamp and mask is True for the
+    entries that have valid data."""
+    if step is None:
+        step = max([v.metadata['STEP'] for v in vars] or [1])
+
+    timestamps = grid(begin, end, step)
+    matrix = numpy.empty((len(vars), len(timestamps)))
+    matrix.fill(numpy.nan)
+    mask = numpy.zeros(matrix.shape, dtype=bool)
+
+    order = sorted(range(len(vars)), key=lambda i: vars[i].path)
+
+    def load(i):
+        try:
+            return load_resampled(vars[i], begin, end, step, field, stats)
+        finally:
+            vars[i].close_chunks()
+
+    if threads:
+        pool = ThreadPool(threads)
+        try:
+            results = pool.imap(load, order)
+            for i in order:
+                matrix[i], mask[i] = results.next()
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for i in order:
+            matrix[i], mask[i] = load(i)
+
+    return timestamps, matrix, mask
+
+def minmax_envelope(timestamps, values, n):
+    """Downsample to at most n points keeping the extremes.
+
+    The points are divided into n/2 buckets of consecutive points and the
+    minimum and maximum point of each bucket are kept, so that short spikes
+    remain visible.  The points are returned in time order as a tuple of
+    (timestamps, values)."""
+    length = len(values)
+    buckets = n // 2
+    if length <= n or buckets < 1:
+        return timestamps, values
+
+    bucket = numpy.arange(length) * buckets // length
+    order = numpy.lexsort((values, bucket))
+    starts = numpy.searchsorted(bucket, numpy.arange(buckets))
+    ends = numpy.append(starts[1:], length)
+
+    keep = numpy.union1d(order[starts], order[ends - 1])
+    return timestamps[keep], values[keep]
+
+def lttb(timestamps, values, n):
+    """Downsample to at most n points using Largest-Triangle-Three-Buckets.
+
+    The first and last points are always kept.  The remaining points are
+    divided into n-2 buckets and from each bucket the point forming the
+    largest triangle with the previously kept point and the average of the
+    next bucket is kept.  Returns a tuple of (timestamps, values)."""
+    length = len(values)
+    if length <= n or n < 3:
+        return timestamps, values
+
+    x = timestamps.astype(float)
+    y = values
+    edges = (numpy.arange(n - 1) * (length - 2) / float(n - 2)).astype(int) + 1
+    edges[-1] = length - 1
+
+    keep = numpy.zeros(n, dtype=int)
+    a = 0
+    for i in range(n - 2):
+        lo, hi = edges[i], edges[i + 1]
+        if i + 2 < len(edges):
+            next_lo, next_hi = hi, edges[i + 2]
+        else:
+            next_lo, next_hi = length - 1, length
+        avg_x = x[next_lo:next_hi].mean()
+        avg_y = y[next_lo:next_hi].mean()
+
+        area = numpy.abs((x[a] - avg_x) * (y[lo:hi] - y[a]) -
+                (x[a] - x[lo:hi]) * (avg_y - y[a]))
+        a = lo + int(area.argmax())
+        keep[i + 1] = a
+
+    keep[-1] = length - 1
+    return timestamps[keep], values[keep]
+
+DOWNSAMPLE_METHODS = {'lttb': lttb, 'minmax': minmax_envelope}
+
+def downsample(rows, field, n, method='lttb'):
+    """Downsample the valid points in rows to at most n points.
+
+    ``method`` is one of the keys of DOWNSAMPLE_METHODS.  Returns a tuple of
+    (timestamps, values)."""
+    if not DOWNSAMPLE_METHODS.has_key(method):
+        raise ValueError("unknown downsample method: %s, must be one of %s" %
+                (method, ", ".join(sorted(DOWNSAMPLE_METHODS))))
+    (timestamps, values) = valid_points(rows, field)
+    return DOWNSAMPLE_METHODS[method](timestamps, values, n)
+
+DELTA_NORMAL = 0
+DELTA_ROLLOVER = 1
+DELTA_RESET = 2
+
+def uptime_lookup(uptime_var, timestamps):
+    """Find the value of uptime_var in the slot of each timestamp.
+
+    Returns a tuple of (values, found) where found is False for timestamps
+    outside of the data in uptime_var."""
+    values = numpy.zeros(len(timestamps), dtype=numpy.int64)
+    found = numpy.zeros(len(timestamps), dtype=bool)
+    if not len(timestamps):
+        return values, found
+
+    try:
+        rows = uptime_var.select_array(timestamps.min(), timestamps.max())
+    except TSDBVarEmpty:
+        return values, found
+
+    step = uptime_var.metadata['STEP']
+    slots = rows['timestamp'].astype(numpy.int64) // step * step
+    wanted = timestamps // step * step
+    idx = numpy.searchsorted(slots, wanted).clip(0, max(len(slots) - 1, 0))
+    if len(slots):
+        found = slots[idx] == wanted
+        values[found] = rows['value'][idx[found]]
+
+    return values, found
+
+def counter_deltas(vartype, rows, uptime_var=None):
+    """Compute the change between consecutive rows of a counter.
+
+    rows must contain only valid rows.  Negative deltas are handled the same
+    way as Aggregator.update_from_raw_data(): if ``uptime_var`` shows that
+    the system was restarted, or there is no ``uptime_var`` or it has no
+    data for the interval, the counter is assumed to have been reset and the
+    delta is the current value.  Otherwise the counter is assumed to have
+    rolled over.
+
+    Returns a tuple of (timestamps, deltas, delta_t, kinds) with one entry
+    per pair of rows, timestamps is the time of the later row and kinds is
+    one of DELTA_NORMAL, DELTA_ROLLOVER or DELTA_RESET."""
+    try:
+        modulus = vartype.rollover(0)
+    except NotImplementedError:
+        raise TSDBVarIsNotCounter("%s is not a counter" % vartype.__name__)
+
+    timestamps = rows['timestamp'].astype(numpy.int64)
+    values = rows['value'].astype(numpy.uint64)
+    prev, curr = values[:-1], values[1:]
+
+    deltas = curr - prev
+    if modulus < 2**64:
+        deltas &= numpy.uint64(modulus - 1)
+
+    kinds = numpy.zeros(len(deltas), dtype=numpy.int8)
+    negative = curr < prev
+    if uptime_var is not None:
+        (before, found_before) = uptime_lookup(uptime_var, timestamps[:-1])
+        (after, found_after) = uptime_lookup(uptime_var, timestamps[1:])
+        reset = negative & ~(found_before & found_after & (after >= before))
+    else:
+        reset = negative
+
+    kinds[negative] = DELTA_ROLLOVER
+    kinds[reset] = DELTA_RESET
+    deltas[reset] = curr[reset]
+
+    return (timestamps[1:], deltas, numpy.diff(timestamps), kinds)
+
+def counter_rates(var, begin=None, end=None, uptime_var=None, max_rate=None,
+        heartbeat=None, stats=None):
+    """Compute per interval rates for a counter TSDBVar, see TSDBVar.rate()."""
+    if begin is not None:
+        begin = int(begin) - var.metadata['STEP']
+
+    rows = var.select_array(begin, end, flags=ROW_VALID, stats=stats)
+    (timestamps, deltas, delta_t, kinds) = counter_deltas(var.type, rows,
+            uptime_var=uptime_var)
+
+    rates = deltas.astype(float) / delta_t
+    keep = numpy.ones(len(rates), dtype=bool)
+    if max_rate:
+        keep &= rates <= max_rate
+    if heartbeat:
+        keep &= delta_t <= heartbeat
+
+    return timestamps[keep], rates[keep]
+
+METRICS = {
+    'average': numpy.mean,
+    'max': numpy.max,
+    'min': numpy.min,
+    'sum': numpy.sum,
+}
+
+def load_points(var, begin, end, max_points=None, step=None, field=None,
+        stats=None):
+    """Read the valid points of a TSDBVar at a chosen resolution.
+
+    The data is read from the TSDBVar returned by
+    TSDBVar.choose_resolution().  If that is the raw data of a counter the
+    rates are computed with TSDBVar.rate().  The read is recorded in
+    ``stats``, a tsdb.explain.QueryStats, if given and is subject to its
+    limits.  Returns a tuple of (timestamps, values), both empty if the
+    TSDBVar has no data."""
+    source = var.choose_resolution(begin, end, max_points=max_points,
+            step=step)
+    try:
+        if source is var and var.type.can_rollover:
+            return var.rate(begin, end, stats=stats)
+
+        if field is None:
+            field = default_field(source)
+        return valid_points(source.select_array(begin, end, stats=stats),
+                field)
+    except TSDBVarEmpty:
+        return (numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0))
+
+def window_metric(var, begin, end, metric='average', points=12, field=None,
+        stats=None):
+    """Summarize a TSDBVar between begin and end as a single number.
+
+    The data is read by load_points() with ``points`` as max_points.
+    ``metric`` is one of the keys of METRICS.  Returns None if there is no
+    valid data."""
+    (timestamps, values) = load_points(var, begin, end, max_points=points,
+            field=field, stats=stats)
+
+    if not len(values):
+        return None
+
+    return float(METRICS[metric](values))
+
+def top_n(vars, begin, end, n, metric='average', points=12, field=None,
+        threads=None, stats=None):
+    """Find the n TSDBVars with the largest window_metric().
+
+    ``vars`` is an iterable of TSDBVars.  If ``threads`` is given the
+    TSDBVars are summarized by a pool of that many threads.  Only the n
+    best results are kept while the TSDBVars are processed and the chunks of
+    each are closed once it has been summarized.  The reads are recorded in
+    ``stats``, a tsdb.explain.QueryStats, if given and are subject to its
+    limits.
+
+    Returns a list of (value, path) tuples sorted from largest to smallest
+    value."""
+    if metric not in METRICS:
+        raise ValueError("unknown metric: %s" % (metric, ))
+
+    def summarize(var):
+        try:
+            return (window_metric(var, begin, end, metric=metric,
+                points=points, field=field, stats=stats), var.path)
+        finally:
+            var.close_chunks()
+
+    if threads:
+        pool = ThreadPool(threads)
+        results = pool.imap_unordered(summarize, vars)
+    else:
+        pool = None
+        results = itertools.imap(summarize, vars)
+
+    heap = []
+    try:
+        for (value, path) in results:
+            if value is None:
+                continue
+            if len(heap) < n:
+                heapq.heappush(heap, (value, path))
+            elif value > heap[0][0]:
+                heapq.heapreplace(heap, (value, path))
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    heap.sort(reverse=True)
+    return heap
+
+def heatmap(vars, begin, end, step, bins, range=None, field=None,
+        transform=None, stats=None):
+    """Build a histogram of the values of many TSDBVars for each time slot.
+
+    ``vars`` is an iterable of TSDBVars which are read one at a time by
+    load_points() at the resolution given by ``step`` and resampled onto the
+    grid of slots of ``step`` seconds.  Each slot of each TSDBVar with data
+    is counted in one bucket.  Memory use depends only on the number of
+    slots and buckets, not on the number of TSDBVars, and the chunks of each
+    TSDBVar are closed once it has been read.
+
+    ``bins`` is either the number of equally sized buckets between the two
+    values of ``range`` or a sequence of bucket edges.  Values outside the
+    edges are counted in the first or last bucket.  ``transform`` is an
+    optional function taking a TSDBVar and an array of values and returning
+    new values, for example to turn rates into utilization.  The reads are
+    recorded in ``stats``, a tsdb.explain.QueryStats, if given and are
+    subject to its limits.
+
+    Returns a tuple of (timestamps, edges, histogram) where histogram has
+    one row per timestamp and one column per bucket."""
+    if numpy.isscalar(bins):
+        if range is None:
+            raise ValueError("range is required when bins is a number")
+        edges = numpy.linspace(range[0], range[1], int(bins) + 1)
+    else:
+        edges = numpy.asarray(bins, dtype=float)
+
+    timestamps = grid(begin, end, step)
+    nbins = len(edges) - 1
+    histogram = numpy.zeros((len(timestamps), nbins), dtype=numpy.int64)
+
+    for var in vars:
+        try:
+            (ts, values) = load_points(var, begin, end, step=step,
+                    field=field, stats=stats)
+        finally:
+            var.close_chunks()
+        if transform is not None:
+            values = transform(var, values)
+        (values, mask) = resample_points(ts, values, begin, end, step)
+
+        slots = numpy.flatnonzero(mask)
+        buckets = numpy.searchsorted(edges, values[slots], 'right') - 1
+        numpy.add.at(histogram, (slots, buckets.clip(0, nbins - 1)), 1)
+
+    return timestamps, edges, histogram
+
+def data_fields(dtype):
+    """The names of the fields of a row dtype which hold data."""
+    return [x for x in dtype.names if x not in ('timestamp', 'flags')
+            and not dtype[x].shape]
+
+def empty_summary(fields):
+    """A summary of no rows, see summarize_rows()."""
+    summary = {}
+    for field in fields:
+        summary[field] = dict(count=0, sum=0.0, min=numpy.nan, max=numpy.nan)
+    return summary
+
+def summarize_rows(rows, fields):
+    """Summarize the valid rows of an array.
+
+    Returns a dictionary with an entry for each field in fields which is a
+    dictionary with the count, sum, min and max of the values of that field
+    in rows with ROW_VALID set.  NaN values are not counted."""
+    summary = empty_summary(fields)
+    valid = rows['flags'] & ROW_VALID != 0
+    for field in fields:
+        values = rows[field][valid].astype(float)
+        values = values[~numpy.isnan(values)]
+        if len(values):
+            summary[field] = dict(count=len(values), sum=float(values.sum()),
+                    min=float(values.min()), max=float(values.max()))
+    return summary
+
+def merge_summaries(a, b):
+    """Combine two summaries returned by summarize_rows()."""
+    merged = {}
+    for field in a:
+        (x, y) = (a[field], b[field])
+        merged[field] = dict(count=x['count'] + y['count'],
+                sum=x['sum'] + y['sum'],
+                min=float(numpy.fmin(x['min'], y['min'])),
+                max=float(numpy.fmax(x['max'], y['max'])))
+    return merged
@@ -0,0 +1,363 @@
+"""
+Non-blocking reads for event driven applications.
+
+An AsyncReader runs chunk reads on a small pool of threads and returns
+Futures, so a web server handling many concurrent graph requests doesn't
+block on disk.  The Futures have the same methods as those of
+concurrent.futures so they can be adapted to the event loop in use, for
+example by waiting for them in a callback registered with
+add_done_callback().
+
+Reads of the same chunk that are in progress at the same time are coalesced:
+the chunk is read once and every request is answered from the result.
+
+>>> reader = AsyncReader(db, threads=4)
+>>> future = reader.select_array("rtr/ifHCInOctets", begin, end)
+>>> future.add_done_callback(lambda f: send_graph(f.result()))
+
+The reader opens the chunk files itself and so only sees data that has been
+flushed.
+"""
+
+import collections
+import os.path
+import threading
+from multiprocessing.pool import ThreadPool
+
+import numpy
+
+from tsdb.error import TSDBError, TSDBTimeoutError, TSDBVarEmpty, \
+        TSDBVarNoValidData
+from tsdb.row import ROW_VALID
+from tsdb.util import calculate_slot
+
+class Future(object):
+    """The result of a read that may not have finished."""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._result = None
+        self._exception = None
+
+    def _finish(self, result, exception):
+        self._lock.acquire()
+        try:
+            self._result = result
+            self._exception = exception
+            self._event.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+        finally:
+            self._lock.release()
+        for callback in callbacks:
+            callback(self)
+
+    def set_result(self, result):
+        self._finish(result, None)
+
+    def set_exception(self, exception):
+        self._finish(None, exception)
+
+    def done(self):
+        return self._event.is_set()
+
+    def exception(self, timeout=None):
+        """The exception raised by the read, or None."""
+        if not self._event.wait(timeout):
+            raise TSDBTimeoutError("read did not finish in %s seconds" %
+                    (timeout, ))
+        return self._exception
+
+    def result(self, timeout=None):
+        """Wait for the read to finish and return its result."""
+        exception = self.exception(timeout)
+        if exception is not None:
+            raise exception
+        return self._result
+
+    def add_done_callback(self, fn):
+        """Call fn with this Future when it is done, it is called in the
+        thread that finished the read or immediately if it already has."""
+        self._lock.acquire()
+        try:
+            if not self._event.is_set():
+                self._callbacks.append(fn)
+                return
+        finally:
+            self._lock.release()
+        fn(self)
+
+def gather(futures):
+    """A Future for the list of the results of futures."""
+    combined = Future()
+    # futures not yet done and whether combined has been finished, the
+    # callbacks run in several threads and only the first failure is kept
+    state = [len(futures), False]
+    lock = threading.Lock()
+
+    if not futures:
+        combined.set_result([])
+        return combined
+
+    def done(f):
+        exception = f.exception()
+        lock.acquire()
+        try:
+            if state[1]:
+                return
+            state[0] -= 1
+            if exception is None and state[0] > 0:
+                return
+            state[1] = True
+        finally:
+            lock.release()
+        if exception is not None:
+            combined.set_exception(exception)
+        else:
+            combined.set_result([x.result() for x in futures])
+
+    for f in futures:
+        f.add_done_callback(done)
+    return combined
+
+def _then(future, fn):
+    """A Future for fn(future.result())."""
+    result = Future()
+    def done(f):
+        try:
+            result.set_result(fn(f.result()))
+        except Exception, e:
+            result.set_exception(e)
+    future.add_done_callback(done)
+    return result
+
+class AsyncReader(object):
+    """Read TSDBVars of a TSDB using a pool of ``threads`` threads."""
+
+    def __init__(self, db, threads=4):
+        self.db = db
+        self.pool = ThreadPool(threads)
+        self.lock = threading.Lock()
+        self.pending = {}   # chunk path -> Future of the chunk's rows
+        self.waiting = {}   # chunk path -> QueryStats of queries waiting
+        self.reads = 0      # number of chunk reads
+
+    def close(self):
+        """Wait for all reads to finish and stop the threads."""
+        self.pool.close()
+        self.pool.join()
+
+    def _var(self, var):
+        if isinstance(var, basestring):
+            return self.db.get_var(var)
+        return var
+
+    def submit(self, fn, *args):
+        """Run fn(*args) in the pool, returns a Future."""
+        future = Future()
+        def run():
+            try:
+                result = fn(*args)
+            except Exception, e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+        self.pool.apply_async(run)
+        return future
+
+    def _abandoned(self, path):
+        """Whether every query waiting for the chunk at path has been
+        cancelled or passed its deadline, call with the lock held."""
+        for stats in self.waiting.get(path, [None]):
+            if stats is None:
+                return False
+            try:
+                stats.check()
+            except TSDBError:
+                continue
+            return False
+        return True
+
+    def _read_chunk(self, var, name, stats=None):
+        """A Future of all rows of the named chunk or None if it doesn't
+        exist.
+
+        The chunk isn't read, and the Future gives None, if by the time a
+        thread is free to read it every query waiting for it, as given by
+        their tsdb.explain.QueryStats ``stats``, has been cancelled."""
+        path = os.path.join(var.path, name)
+
+        def read():
+            self.lock.acquire()
+            try:
+                abandoned = self._abandoned(path)
+                if abandoned:
+                    self.pending.pop(path, None)
+                    self.waiting.pop(path, None)
+            finally:
+                self.lock.release()
+            if abandoned:
+                return None
+
+            try:
+                try:
+                    f = var.fs.open(path, "rb")
+                except IOError:
+                    return None
+                try:
+                    s = f.read()
+                finally:
+                    f.close()
+                return numpy.frombuffer(s[:len(s) - len(s) % var.rowsize()],
+                        dtype=var.dtype)
+            finally:
+                self.lock.acquire()
+                self.reads += 1
+                self.pending.pop(path, None)
+                self.waiting.pop(path, None)
+                self.lock.release()
+
+        # read() can't remove itself from pending until it is added
+        self.lock.acquire()
+        try:
+            self.waiting.setdefault(path, []).append(stats)
+            if not self.pending.has_key(path):
+                self.pending[path] = self.submit(read)
+            return self.pending[path]
+        finally:
+            self.lock.release()
+
+    def _plan(self, var, begin, end, stats):
+        """The chunk spans of a select as (begin, end, spans), reserving them
+        against the limits of ``stats``."""
+        try:
+            (begin, end) = var._clip_range(begin, end)
+        except TSDBVarEmpty:
+            return (begin, end, [])
+
+        step = var.metadata['STEP']
+        first = calculate_slot(begin, step)
+        last = calculate_slot(end, step)
+
+        spans = list(var._chunk_spans(first, last))
+        if stats is not None:
+            rows = (last - first) / step + 1
+            stats.reserve(len(spans), rows, rows * var.rowsize())
+        return (begin, end, spans)
+
+    def _select_span(self, var, span_begin, span_end, end, flags, stats):
+        """A Future of the rows of select_array() in one chunk span."""
+        step = var.metadata['STEP']
+        name = var.chunk_mapper.name(span_begin)
+        offset = (span_begin - var.chunk_mapper.begin(name)) / step
+        n = (span_end - span_begin) / step + 1
+
+        def finish(rows):
+            if stats is not None:
+                stats.check()
+            if rows is None or len(rows) < offset + n:
+                rows = numpy.zeros(n, dtype=var.dtype)
+            else:
+                rows = rows[offset:offset+n]
+            return var._filter_rows(rows, span_begin, end, flags)
+
+        return _then(self._read_chunk(var, name, stats), finish)
+
+    def iter_select_array(self, var, begin=None, end=None, flags=None,
+            stats=None):
+        """Select rows one chunk at a time.
+
+        All of the chunks are requested at once.  Returns a list of Futures,
+        one per chunk from oldest to newest, each giving the rows from that
+        chunk as returned by TSDBVar.select_array().
+
+        If ``stats``, a tsdb.explain.QueryStats, has limits the whole read
+        is checked against them before anything is read.  A Future raises
+        if the query has been cancelled or passed its deadline by the time
+        its chunk has been read, chunks not yet being read when that happens
+        aren't read at all."""
+        var = self._var(var)
+        (begin, end, spans) = self._plan(var, begin, end, stats)
+        return [self._select_span(var, span_begin, span_end, end, flags,
+            stats) for (span_begin, span_end) in spans]
+
+    def stream_select_array(self, var, begin=None, end=None, flags=None,
+            stats=None, window=2, timeout=None):
+        """Generate the rows of select_array() one chunk at a time, oldest
+        first.
+
+        Unlike iter_select_array() at most ``window`` chunks are requested
+        ahead of the one being consumed, so a long range is never held in
+        memory at once and closing the generator stops further reads.  The
+        limits of ``stats`` are checked again before each chunk is
+        generated.  Raises TSDBTimeoutError if a chunk isn't read within ``timeout``
+        seconds; ``stats`` is as for iter_select_array()."""
+        var = self._var(var)
+        (begin, end, spans) = self._plan(var, begin, end, stats)
+        futures = collections.deque()
+        for (span_begin, span_end) in spans:
+            futures.append(self._select_span(var, span_begin, span_end, end,
+                flags, stats))
+            if len(futures) >= window:
+                yield self._next_chunk(futures, stats, timeout)
+        while futures:
+            yield self._next_chunk(futures, stats, timeout)
+
+    def _next_chunk(self, futures, stats, timeout):
+        rows = futures.popleft().result(timeout)
+        if stats is not None:
+            stats.check()
+        return rows
+
+    def select_array(self, var, begin=None, end=None, flags=None):
+        """A Future of the result of TSDBVar.select_array()."""
+        var = self._var(var)
+        dtype = var.dtype.newbyteorder('=')
+        def concatenate(parts):
+            if not parts:
+                return numpy.zeros(0, dtype=dtype)
+            return numpy.concatenate(parts)
+        return _then(gather(self.iter_select_array(var, begin, end, flags)),
+                concatenate)
+
+    def get_many(self, vars, begin=None, end=None, flags=None):
+        """A Future of a dictionary mapping each of vars, a list of paths,
+        to the result of select_array()."""
+        vars = list(vars)
+        return _then(gather([self.select_array(x, begin, end, flags) for
+            x in vars]), lambda results: dict(zip(vars, results)))
+
+    def latest(self, var):
+        """A Future of the newest valid row as a one row array, the Future
+        raises TSDBVarNoValidData if there is none."""
+        var = self._var(var)
+        result = Future()
+
+        def search(end):
+            step = var.metadata['STEP']
+            name = var.chunk_mapper.name(end)
+            begin = max(var.chunk_mapper.begin(name), var.min_timestamp())
+            future = gather(self.iter_select_array(var, begin, end,
+                flags=ROW_VALID))
+
+            def done(f):
+                try:
+                    rows = f.result()
+                    if rows and len(rows[0]):
+                        result.set_result(rows[0][-1:])
+                    elif begin <= var.min_timestamp():
+                        raise TSDBVarNoValidData("no valid data found in %s" %
+                                (var.path, ))
+                    else:
+                        search(begin - step)
+                except Exception, e:
+                    result.set_exception(e)
+            future.add_done_callback(done)
+
+        try:
+            search(var._clip_range(None, None)[1])
+        except TSDBVarEmpty, e:
+            result.set_exception(e)
+        return result
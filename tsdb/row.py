@@ -6,10 +6,22 @@ specific uses.
 
 import struct
 
+import numpy
+
+from tsdb.sketch import SKETCH_BUCKETS, empty_sketch, sketch_pairs, \
+        sketch_from_pairs
+
 ROW_VALID   = 0x0001  # does this row have valid data?
 ROW_WRAP    = 0x0002  # was there a wrap between this entry and the previous
 ROW_UNWRAP  = 0x0004  # the wrap for this entry was corrected
 
+# numpy equivalents of the struct format characters used in pack_format
+DTYPE_MAP = {'L': '>u4', 'l': '>i4', 'Q': '>u8', 'd': '>f8'}
+
+def _format_dtype(pack_format, names):
+    """Build a numpy dtype matching a network byte order struct format."""
+    return numpy.dtype(zip(names, [DTYPE_MAP[c] for c in pack_format[1:]]))
+
 class TSDBRow(object):
     """A TSDBRow represents a datapoint inside a TSDBVar.
 
@@ -51,6 +63,17 @@ class TSDBRow(object):
         """Unpack binary string into an instance."""
         return klass(*struct.unpack(klass.pack_format, s))
 
+    @classmethod
+    def unpack_from(klass, buf, offset, metadata):
+        """Unpack the row at offset in buf, such as an mmap, without copying
+        it first."""
+        return klass(*struct.unpack_from(klass.pack_format, buf, offset))
+
+    @classmethod
+    def dtype(klass, metadata):
+        """Return a numpy dtype with the same layout as a packed row."""
+        return _format_dtype(klass.pack_format, ('timestamp', 'flags', 'value'))
+
     def __str__(self):
         return "%s: [%d/%#x: %d]" % (self.__class__.__name__, self.timestamp,
                 self.flags, self.value)
@@ -178,6 +201,22 @@ class Aggregate(TSDBRow):
         min     - minimum value
         max     - maximum value
         delta   - total change for time interval
+        sketch  - a quantile sketch of the averages of the first
+                  aggregate, see tsdb.sketch
+        count   - number of averages of the finer aggregate summarized
+        sumsq   - sum of the squares of those averages
+
+    count and sumsq are merged like sketch, together with delta they give the
+    variance of the finer averages, see TSDBVar.moments().
+
+    A sketch is stored as SKETCH_SIZE (from the metadata) pairs of a 2 byte
+    bucket and a 4 byte count, in the sketch_buckets and sketch_counts
+    fields of the dtype.  TSDBVar.add_aggregate() sets SKETCH_SIZE to the
+    number of averages of the first aggregate in a row, at most
+    SKETCH_MAX_PAIRS, so a 1d aggregate over 1h averages adds 144 bytes to
+    each 40 byte row.  Aggregates without SKETCH_SIZE store all
+    SKETCH_BUCKETS counts, 2768 bytes, in the sketch field.  The first
+    aggregate doesn't store sketches, its own averages are used instead.
 
     This list of which aggregates should be stored is kept in the AGGREGATES
     metadata entry for each Aggregate.  The Aggregate TSDBRow has a variable
@@ -188,62 +227,143 @@ class Aggregate(TSDBRow):
     What is stored is determined by the metadata passed in to the pack
     method."""
 
-    aggregate_order = ('average', 'delta', 'min', 'max')
+    aggregate_order = ('average', 'delta', 'min', 'max', 'sketch', 'count',
+            'sumsq')
+    scalar_aggregates = tuple([x for x in aggregate_order if x != 'sketch'])
     type_id = 5
     version = 1
 
+    # (AGGREGATES, SKETCH_SIZE) -> (pack format, [(agg, offset, size)])
+    _layouts = {}
+
+    # aggregates which aren't set are NaN
+    average = delta = min = max = count = sumsq = float('NaN')
+
     def __init__(self, timestamp, flags, **kwargs):
         self.timestamp = int(timestamp)
         self.flags = flags
-        
-        for agg in self.aggregate_order:
-            if kwargs.has_key(agg):
-                if kwargs[agg] is None:
-                    val = float('NaN')
-                else:
-                    val = float(kwargs[agg])
 
-                setattr(self, agg, val)
-            else:
-                # XXX not i sure like this
-                setattr(self, agg, float('NaN'))
+        val = kwargs.get('sketch')
+        if val is None or numpy.isscalar(val):
+            self._sketch = None
+        else:
+            self._sketch = numpy.array(val, dtype=numpy.uint32)
+
+        for agg in self.scalar_aggregates:
+            val = kwargs.get(agg)
+            if val is not None:
+                setattr(self, agg, float(val))
+
+    def _get_sketch(self):
+        # most Aggregates don't store a sketch, it is only allocated when used
+        if self._sketch is None:
+            self._sketch = empty_sketch()
+        return self._sketch
+
+    def _set_sketch(self, value):
+        self._sketch = value
+
+    sketch = property(_get_sketch, _set_sketch)
 
     def pack(self, metadata):
         l = []
         for agg in self.aggregate_order:
             if agg in metadata['AGGREGATES']:
-                l.append(getattr(self, agg))
+                if agg == 'sketch' and metadata.has_key('SKETCH_SIZE'):
+                    for x in sketch_pairs(self.sketch,
+                            metadata['SKETCH_SIZE']):
+                        l.extend(x.tolist())
+                elif agg == 'sketch':
+                    l.extend(self.sketch.tolist())
+                else:
+                    l.append(getattr(self, agg))
 
         return struct.pack(Aggregate.get_pack_format(metadata), self.timestamp, self.flags, *l)
 
+    @classmethod
+    def aggregate_format(klass, agg, metadata):
+        """The struct format of an aggregate."""
+        if agg != 'sketch':
+            return 'd'
+        if metadata.has_key('SKETCH_SIZE'):
+            return 'H' * metadata['SKETCH_SIZE'] + \
+                    'L' * metadata['SKETCH_SIZE']
+        return 'L' * SKETCH_BUCKETS
+
+    @classmethod
+    def _layout(klass, metadata):
+        """The pack format of the rows described by metadata and the offset
+        and number of values of each aggregate stored in the unpacked
+        values, computed once for each kind of row."""
+        key = (tuple(metadata['AGGREGATES']), metadata.get('SKETCH_SIZE'))
+        layout = klass._layouts.get(key)
+        if layout is None:
+            pack_format = TSDBRow.pack_format
+            fields = []
+            i = 2
+            for agg in klass.aggregate_order:
+                if agg in metadata['AGGREGATES']:
+                    f = klass.aggregate_format(agg, metadata)
+                    fields.append((agg, i, len(f)))
+                    pack_format += f
+                    i += len(f)
+            layout = klass._layouts[key] = (pack_format, fields)
+        return layout
+
     @classmethod
     def get_pack_format(klass, metadata):
-        pack_format = TSDBRow.pack_format
-        for agg in klass.aggregate_order:
-            if agg in metadata['AGGREGATES']:
-                pack_format += 'd'
-        return pack_format
+        return klass._layout(metadata)[0]
 
     @classmethod
     def size(klass, metadata):
         return struct.calcsize(klass.get_pack_format(metadata))
 
     @classmethod
-    def unpack(klass, s, metadata):
-        args = struct.unpack(klass.get_pack_format(metadata), s)
-        kwargs = {}
-        i = 0
+    def dtype(klass, metadata):
+        fields = [('timestamp', '>u4'), ('flags', '>u4')]
         for agg in klass.aggregate_order:
             if agg in metadata['AGGREGATES']:
-                kwargs[agg] = args[2+i]
-                i += 1
+                if agg == 'sketch' and metadata.has_key('SKETCH_SIZE'):
+                    n = metadata['SKETCH_SIZE']
+                    fields.append(('sketch_buckets', '>u2', (n, )))
+                    fields.append(('sketch_counts', '>u4', (n, )))
+                elif agg == 'sketch':
+                    fields.append((agg, '>u4', (SKETCH_BUCKETS, )))
+                else:
+                    fields.append((agg, '>f8'))
+        return numpy.dtype(fields)
+
+    @classmethod
+    def unpack(klass, s, metadata):
+        return klass._from_values(struct.unpack(
+            klass.get_pack_format(metadata), s), metadata)
+
+    @classmethod
+    def unpack_from(klass, buf, offset, metadata):
+        return klass._from_values(struct.unpack_from(
+            klass.get_pack_format(metadata), buf, offset), metadata)
+
+    @classmethod
+    def _from_values(klass, args, metadata):
+        kwargs = {}
+        for (agg, i, n) in klass._layout(metadata)[1]:
+            if n == 1:
+                kwargs[agg] = args[i]
+            elif metadata.has_key('SKETCH_SIZE'):
+                kwargs[agg] = sketch_from_pairs(args[i:i+n/2],
+                        args[i+n/2:i+n])
+            else:
+                kwargs[agg] = args[i:i+n]
 
         return klass(*args[:2], **kwargs)
 
     def __str__(self):
         l = []
         for agg in self.aggregate_order:
-            if hasattr(self, agg):
+            if agg == 'sketch':
+                if self._sketch is not None and self._sketch.any():
+                    l.append("sketch=<%d values>" % (self._sketch.sum(), ))
+            elif hasattr(self, agg):
                 l.append("%s=%g" % (agg, getattr(self, agg)))
 
         return "%s: [%d/%#x: %s]" % (self.__class__.__name__, self.timestamp,
@@ -257,11 +377,16 @@ class Aggregate(TSDBRow):
             if self.timestamp == other.timestamp \
                and self.flags == other.flags \
                and self.type_id == other.type_id:
-                for agg in self.aggregate_order:
-                    if not (hasattr(self, agg) and hasattr(other, agg) \
-                       and getattr(self, agg) == getattr(other, agg)):
+                for agg in self.scalar_aggregates:
+                    a = getattr(self, agg)
+                    b = getattr(other, agg)
+                    # aggregates which aren't set are NaN
+                    if not (a == b or (a != a and b != b)):
                         return False
-                return True
+                # unused sketches are equal without allocating them
+                if self._sketch is None and other._sketch is None:
+                    return True
+                return numpy.array_equal(self.sketch, other.sketch)
             else:
                 return False
         else:
@@ -274,7 +399,10 @@ class Aggregate(TSDBRow):
     def invalidate(self):
         TSDBRow.invalidate(self)
         for agg in self.aggregate_order:
-            setattr(self, agg, float('NaN'))
+            if agg == 'sketch':
+                self._sketch = None
+            else:
+                setattr(self, agg, float('NaN'))
 
 class Integer32(TSDBRow):
     """Represent a SNMP INTEGER variable.
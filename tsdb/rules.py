@@ -0,0 +1,170 @@
+"""
+Threshold rules evaluated as data is written.
+
+A Rule compares a field of the rows of the TSDBVars matching a pattern with
+a threshold.  Once the condition has held for ``duration`` seconds the rule
+fires and a RuleEvent is emitted, and another is emitted when the condition
+stops holding.  Rules are registered with TSDB.add_rules() and see rows as
+they are published, see tsdb.pubsub, so checking them costs a few
+operations per new row instead of re-reading the newest data of every
+TSDBVar.
+
+The field is any field of the rows, such as value for raw data or average
+for aggregates, or 'rate' for the rate of a raw counter computed from
+consecutive rows as TSDBVar.rate() does without an uptime_var.
+
+>>> rules = [Rule("busy", "rtr/*/ifHCInOctets", "rate", ">", 0.9e9, 300)]
+>>> db.add_rules(rules, alerts)     # a Queue.Queue or a callable
+"""
+
+import collections
+import fnmatch
+import math
+import operator
+import threading
+
+from tsdb.row import ROW_VALID
+
+OPERATORS = {
+    '>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le,
+    '==': operator.eq,
+    '!=': operator.ne,
+}
+
+RULE_FIRING = 'firing'
+RULE_RESOLVED = 'resolved'
+
+RuleEvent = collections.namedtuple('RuleEvent', [
+    'rule',         # name of the Rule
+    'path',         # path of the TSDBVar
+    'state',        # RULE_FIRING or RULE_RESOLVED
+    'timestamp',    # timestamp of the row which changed the state
+    'value',        # value of the field in that row
+])
+
+# indexes into the per TSDBVar state of a Rule
+_LAST_TIMESTAMP, _LAST_VALUE, _SINCE, _FIRING = range(4)
+
+class Rule(object):
+    """Fire when ``field op threshold`` holds for ``duration`` seconds for a
+    TSDBVar with a path matching ``pattern``.  ``op`` is one of the keys of
+    OPERATORS."""
+
+    def __init__(self, name, pattern, field, op, threshold, duration=0):
+        if not OPERATORS.has_key(op):
+            raise ValueError("unknown operator: %s" % (op, ))
+        self.name = name
+        self.pattern = pattern
+        self.field = field
+        self.op = op
+        self.compare = OPERATORS[op]
+        self.threshold = threshold
+        self.duration = duration
+        # path -> [last timestamp, last value, since, firing]
+        self.state = {}
+
+    def __repr__(self):
+        return '<Rule %s: %s %s %s %s for %ds>' % (self.name, self.pattern,
+                self.field, self.op, self.threshold, self.duration)
+
+    def matches(self, path):
+        return fnmatch.fnmatchcase(path, self.pattern)
+
+    def _value(self, state, row):
+        if self.field != 'rate':
+            return getattr(row, self.field)
+
+        (last_timestamp, last_value) = state[_LAST_TIMESTAMP:_SINCE]
+        state[_LAST_TIMESTAMP] = row.timestamp
+        state[_LAST_VALUE] = row.value
+        if last_timestamp is None:
+            return None
+        if row.value < last_value:
+            delta = row.value   # reset, see counter_deltas()
+        else:
+            delta = row.value - last_value
+        return float(delta) / (row.timestamp - last_timestamp)
+
+    def update(self, path, row):
+        """Evaluate the rule for a new row of path.
+
+        Returns a RuleEvent if the state of the rule for path changed,
+        otherwise None."""
+        state = self.state.get(path)
+        if state is None:
+            state = self.state[path] = [None, None, None, False]
+        elif row.timestamp <= state[_LAST_TIMESTAMP]:
+            return None     # rewritten or out of order
+
+        if not row.flags & ROW_VALID:
+            return None
+        value = self._value(state, row)
+        state[_LAST_TIMESTAMP] = row.timestamp
+        if value is None or (isinstance(value, float) and math.isnan(value)):
+            return None
+
+        if not self.compare(value, self.threshold):
+            state[_SINCE] = None
+            if state[_FIRING]:
+                state[_FIRING] = False
+                return RuleEvent(self.name, path, RULE_RESOLVED,
+                        row.timestamp, value)
+            return None
+
+        if state[_SINCE] is None:
+            state[_SINCE] = row.timestamp
+        if not state[_FIRING] and \
+                row.timestamp - state[_SINCE] >= self.duration:
+            state[_FIRING] = True
+            return RuleEvent(self.name, path, RULE_FIRING, row.timestamp,
+                    value)
+        return None
+
+    def firing(self):
+        """Sorted list of the paths the rule is firing for."""
+        return sorted([path for (path, state) in self.state.items() if
+            state[_FIRING]])
+
+class RuleSet(object):
+    """Rules registered with a Broker, RuleEvents are given to ``target``
+    which is a callable or has a put() method like Queue.Queue."""
+
+    def __init__(self, broker, rules, target):
+        self.broker = broker
+        self.rules = list(rules)
+        if hasattr(target, 'put'):
+            self.emit = target.put
+        else:
+            self.emit = target
+        self.lock = threading.Lock()
+        self.events = 0
+
+    def matches(self, path):
+        for rule in self.rules:
+            if rule.matches(path):
+                return True
+        return False
+
+    def put(self, message):
+        """Evaluate the rules for a (path, row) message."""
+        (path, row) = message
+        events = []
+        self.lock.acquire()
+        try:
+            for rule in self.rules:
+                if rule.matches(path):
+                    event = rule.update(path, row)
+                    if event is not None:
+                        events.append(event)
+            self.events += len(events)
+        finally:
+            self.lock.release()
+        for event in events:
+            self.emit(event)
+
+    def close(self):
+        """Stop evaluating the rules."""
+        self.broker.unsubscribe(self)
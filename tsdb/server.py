@@ -0,0 +1,436 @@
+"""
+An HTTP/JSON query server for a TSDB.
+
+The server keeps a single TSDB open so that every client shares its
+metadata, chunk reads and query cache.  Each connection is handled in its
+own thread and data is read by an AsyncReader, so slow disks don't hold up
+other clients.  It is started with::
+
+    tsdb serve [--host HOST] [--port PORT] [--cache-size BYTES] DATABASE
+
+Requests are GETs with the arguments in the query string, times are seconds
+since the epoch:
+
+    /list?pattern=rtr/*         paths of the TSDBVars matching pattern
+    /select?var=PATH&begin=&end=[&points=N|&step=S][&flags=F]
+                                rows at the resolution chosen as for
+                                TSDBVar.query_array(), streamed as they are
+                                read
+    /resolution?var=PATH&begin=&end=[&points=N|&step=S]
+                                the aggregate /select would use
+    /latest?var=PATH            the newest valid row
+    /summary?var=PATH[&begin=&end=][&field=F]
+                                see TSDBVar.summarize()
+    /tail?pattern=P[&pattern=P...]
+                                new rows of the matching TSDBVars, one JSON
+                                object per line, as they are written
+
+Every response is a JSON object, errors have an "error" member.  Missing
+data (NaN) is null.
+
+Reads for /select and /summary are limited by the server's QueryLimits, see
+tsdb.explain, and must finish within its timeout.  A read which would break
+the limits fails before anything is read and the read is cancelled if the
+client goes away.  If a /select fails once its rows have started to be
+sent, for example by passing its deadline, the status has already gone out
+as 200: the rows end early, the object gets an "error" member and the
+connection is closed.
+
+For /tail a single thread checks the metadata of the TSDBVars being tailed
+every watch_interval seconds and publishes their new rows to the subscribers,
+see tsdb.pubsub.  A TSDBVar is only checked while someone is tailing it.
+Aggregates are included when given by their full path.  Empty lines are sent
+while there is no new data to detect clients that have gone away.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import itertools
+import json
+import math
+import socket
+import sys
+import threading
+import time
+import urlparse
+from optparse import OptionParser
+
+import numpy
+
+from tsdb.base import TSDB
+from tsdb.cache import QueryCache, LRUCache
+from tsdb.error import TSDBError, TSDBVarDoesNotExistError, \
+        TSDBAggregateDoesNotExistError, TSDBVarEmpty, TSDBVarNoValidData
+from tsdb.explain import QueryLimits, QueryStats, CancelToken
+from tsdb.query import data_fields
+from tsdb.reader import AsyncReader
+from tsdb.row import ROW_VALID
+
+# rows per piece of a streamed response
+STREAM_ROWS = 1000
+# chunks read ahead of the one being sent by a streamed response
+READ_AHEAD = 2
+# most rows of a streamed response kept to be cached, larger results aren't
+CACHE_ROWS = 100000
+# messages queued per /tail client before the oldest are dropped
+TAIL_QUEUE = 10000
+
+class BadRequest(TSDBError):
+    """The request is missing or has invalid arguments."""
+    pass
+
+def _json_value(x):
+    if isinstance(x, float) and math.isnan(x):
+        return None
+    return x
+
+def _row_lists(rows, fields):
+    """The rows of a structured array as lists of JSON values."""
+    columns = [rows[f].tolist() for f in fields]
+    return [[_json_value(x) for x in row] for row in zip(*columns)]
+
+class TSDBServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Serve queries on ``db``, ``refresh`` is how often in seconds the
+    metadata of a TSDBVar is reloaded to see new data written by other
+    processes.  ``limits`` is a tsdb.explain.QueryLimits giving the most
+    rows, bytes and chunks a single request may read, its deadline and
+    cancel are ignored."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, address, db, threads=8, refresh=60, timeout=60,
+            watch_interval=5, limits=None):
+        BaseHTTPServer.HTTPServer.__init__(self, address, TSDBRequestHandler)
+        self.db = db
+        self.reader = AsyncReader(db, threads=threads)
+        self.refresh = refresh
+        self.timeout = timeout
+        self.limits = limits or QueryLimits()
+        self.loaded = {}
+        # TSDBVar methods which read chunks directly aren't thread safe
+        self.lock = threading.Lock()
+
+        self.watch_interval = watch_interval
+        self.watched = {}   # path -> final timestamp published
+        self.watcher = None
+        self.stopping = threading.Event()
+
+    def server_close(self):
+        self.stopping.set()
+        BaseHTTPServer.HTTPServer.server_close(self)
+        self.reader.close()
+
+    def watch(self, paths):
+        """Start publishing new rows of the TSDBVars at paths."""
+        self.lock.acquire()
+        try:
+            for path in paths:
+                if not self.watched.has_key(path):
+                    var = self.db.get_var(path)
+                    var.load_metadata()
+                    self.watched[path] = var.final_timestamp()
+            if self.watcher is None:
+                self.watcher = threading.Thread(target=self._watch)
+                self.watcher.setDaemon(True)
+                self.watcher.start()
+        finally:
+            self.lock.release()
+
+    def _watch(self):
+        while not self.stopping.wait(self.watch_interval):
+            self.poll()
+
+    def poll(self):
+        """Publish the rows written since the last poll."""
+        broker = self.db.broker
+        self.lock.acquire()
+        try:
+            for (path, final) in self.watched.items():
+                if broker is None or not [x for x in broker.subscriptions
+                        if x.matches(path)]:
+                    del self.watched[path]
+                    continue
+
+                var = self.db.get_var(path)
+                var.load_metadata()
+                self.loaded[path] = time.time()
+                if var.final_timestamp() <= final:
+                    continue
+                for row in var.select(final + var.metadata['STEP'],
+                        var.final_timestamp(), flags=ROW_VALID):
+                    broker.publish(path, row)
+                self.watched[path] = var.final_timestamp()
+        finally:
+            self.lock.release()
+
+    def get_var(self, path):
+        """Get a TSDBVar, reloading its metadata if it is old."""
+        var = self.db.get_var(path)
+        now = time.time()
+        if now - self.loaded.setdefault(path, now) > self.refresh:
+            self.lock.acquire()
+            try:
+                var.load_metadata()
+                for agg in var.aggs.values():
+                    agg.load_metadata()
+                var.agg_list = []
+                self.loaded[path] = now
+            finally:
+                self.lock.release()
+        return var
+
+    def query_limits(self, cancel=None):
+        """The QueryLimits for a request starting now."""
+        return QueryLimits(max_rows=self.limits.max_rows,
+                max_bytes=self.limits.max_bytes,
+                max_chunks=self.limits.max_chunks,
+                deadline=time.time() + self.timeout, cancel=cancel)
+
+    def select_parts(self, var, begin, end, flags, limits=None):
+        """Generate the rows of var.select_array() in pieces.
+
+        Only READ_AHEAD chunks are read ahead of the piece being sent.
+        Results of up to CACHE_ROWS rows are cached in the TSDB's cache, if
+        it has one."""
+        try:
+            (begin, end) = var._clip_range(begin, end)
+        except TSDBVarEmpty:
+            return
+
+        cache = self.db.cache
+        key = var._select_cache_key(begin, end, flags)
+        if cache is not None:
+            rows = cache.get(var.path, key)
+            if rows is not None:
+                for i in range(0, len(rows), STREAM_ROWS):
+                    yield rows[i:i+STREAM_ROWS]
+                return
+
+        parts = []
+        kept = 0
+        stats = QueryStats(limits or self.query_limits())
+        chunks = self.reader.stream_select_array(var, begin, end, flags,
+                stats=stats, window=READ_AHEAD, timeout=self.timeout)
+        try:
+            for rows in chunks:
+                if parts is not None:
+                    kept += len(rows)
+                    if kept <= CACHE_ROWS:
+                        parts.append(rows)
+                    else:
+                        parts = None
+                for i in range(0, len(rows), STREAM_ROWS):
+                    yield rows[i:i+STREAM_ROWS]
+        finally:
+            chunks.close()
+
+        if cache is not None and parts and not var.dirty_summaries:
+            cache.set(var.path, key, numpy.concatenate(parts))
+
+class TSDBRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.0"
+
+    def log_message(self, format, *args):
+        if self.server.db.metadata.get('SERVER_LOG'):
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format,
+                    *args)
+
+    def _arg(self, name, kind=str, default=None):
+        if not self.args.has_key(name):
+            if default is None:
+                raise BadRequest("missing argument: %s" % (name, ))
+            return default
+        try:
+            return kind(self.args[name][-1])
+        except ValueError:
+            raise BadRequest("invalid value for %s" % (name, ))
+
+    def _optional(self, name, kind=int):
+        if self.args.has_key(name):
+            return self._arg(name, kind)
+        return None
+
+    def _start(self, status=200):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+
+    def _send(self, obj, status=200):
+        self._start(status)
+        self.wfile.write(json.dumps(obj))
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        self.args = urlparse.parse_qs(url.query)
+        handler = getattr(self, "get_" + url.path.strip('/'), None)
+        if handler is None:
+            self._send({'error': "unknown request: %s" % (url.path, )}, 404)
+            return
+
+        try:
+            handler()
+        except (TSDBVarDoesNotExistError, TSDBAggregateDoesNotExistError,
+                TSDBVarNoValidData), e:
+            self._send({'error': str(e)}, 404)
+        except TSDBError, e:
+            self._send({'error': str(e)}, 400)
+
+    def _resolution(self):
+        var = self.server.get_var(self._arg('var'))
+        begin = self._optional('begin')
+        end = self._optional('end')
+        if begin is None or end is None:
+            return (var, var, begin, end)
+        return (var, var.choose_resolution(begin, end,
+            max_points=self._optional('points'),
+            step=self._optional('step', str)), begin, end)
+
+    def _var_path(self, var):
+        return var.path.lstrip('/')
+
+    def get_list(self):
+        self._send({'vars': self.server.db.find_vars(self._arg('pattern',
+            default="*"))})
+
+    def get_resolution(self):
+        (var, chosen, begin, end) = self._resolution()
+        self._send({'var': self._var_path(chosen),
+            'step': chosen.metadata['STEP']})
+
+    def get_select(self):
+        (var, chosen, begin, end) = self._resolution()
+        fields = ['timestamp', 'flags'] + data_fields(chosen.dtype)
+        cancel = CancelToken()
+        parts = self.server.select_parts(chosen, begin, end,
+                self._optional('flags'), self.server.query_limits(cancel))
+
+        # the first piece is read before sending the headers so that errors
+        # can still be reported
+        try:
+            first = parts.next()
+        except StopIteration:
+            first = None
+
+        self._start()
+        self.wfile.write('{"var": %s, "step": %d, "fields": %s, "rows": [' %
+                (json.dumps(self._var_path(chosen)), chosen.metadata['STEP'],
+                    json.dumps(fields)))
+        sep = ""
+        try:
+            try:
+                if first is not None:
+                    for rows in itertools.chain([first], parts):
+                        for row in _row_lists(rows, fields):
+                            self.wfile.write(sep + json.dumps(row))
+                            sep = ", "
+            except TSDBError, e:
+                # too late for an error status, end the rows with the error
+                parts.close()
+                self.close_connection = 1
+                self.wfile.write('], "error": %s}' % (json.dumps(str(e)), ))
+                return
+            self.wfile.write("]}")
+        except socket.error:
+            cancel.cancel() # the client went away, stop reading
+            parts.close()
+
+    def get_latest(self):
+        var = self.server.get_var(self._arg('var'))
+        rows = self.server.reader.latest(var).result(self.server.timeout)
+        fields = ['timestamp', 'flags'] + data_fields(var.dtype)
+        self._send({'var': self._var_path(var),
+            'row': dict(zip(fields, _row_lists(rows, fields)[0]))})
+
+    def get_summary(self):
+        var = self.server.get_var(self._arg('var'))
+        field = self._optional('field', str)
+        if field is not None and field not in data_fields(var.dtype):
+            raise BadRequest("unknown field: %s" % (field, ))
+        self.server.lock.acquire()
+        try:
+            summary = var.summarize(self._optional('begin'),
+                    self._optional('end'),
+                    fields=field and [field] or None,
+                    limits=self.server.query_limits())
+        finally:
+            self.server.lock.release()
+        for f in summary:
+            summary[f] = dict([(k, _json_value(v)) for (k, v) in
+                summary[f].items()])
+        self._send({'var': self._var_path(var), 'summary': summary})
+
+    def get_tail(self):
+        patterns = self.args.get('pattern')
+        if not patterns:
+            raise BadRequest("missing argument: pattern")
+
+        paths = set()
+        for pattern in patterns:
+            if [x for x in "*?[" if x in pattern]:
+                paths.update(self.server.db.find_vars(pattern))
+            else:
+                self.server.get_var(pattern)
+                paths.add(pattern)
+
+        sub = self.server.db.subscribe(patterns, maxsize=TAIL_QUEUE)
+        try:
+            self.server.watch(paths)
+            self._start()
+            heartbeat = max(self.server.watch_interval, 1)
+            while not self.server.stopping.is_set():
+                message = sub.get(heartbeat)
+                if message is None:
+                    self.wfile.write("\n")
+                else:
+                    (path, row) = message
+                    var = self.server.db.get_var(path)
+                    fields = ['timestamp', 'flags'] + data_fields(var.dtype)
+                    self.wfile.write(json.dumps({'var': path,
+                        'row': dict([(f, _json_value(getattr(row, f))) for
+                            f in fields]),
+                        'dropped': sub.dropped}) + "\n")
+                self.wfile.flush()
+        except socket.error:
+            pass # the client went away
+        finally:
+            sub.close()
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog serve [options] DATABASE")
+    parser.add_option("--host", default="127.0.0.1",
+            help="address to listen on [%default]")
+    parser.add_option("--port", type="int", default=8088,
+            help="port to listen on [%default]")
+    parser.add_option("--cache-size", type="int", default=256 * 1024 * 1024,
+            help="bytes of query results to cache [%default]")
+    parser.add_option("--threads", type="int", default=8,
+            help="number of I/O threads [%default]")
+    parser.add_option("--timeout", type="int", default=60,
+            help="seconds a request may take [%default]")
+    parser.add_option("--max-rows", type="int",
+            help="most rows a request may read")
+    parser.add_option("--max-bytes", type="int",
+            help="most bytes a request may read")
+    parser.add_option("--max-chunks", type="int",
+            help="most chunks a request may read")
+
+    (options, args) = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error("must specify database")
+
+    db = TSDB(args[0], mode="r")
+    if db.cache is None and options.cache_size:
+        db.cache = QueryCache([LRUCache(options.cache_size)])
+
+    server = TSDBServer((options.host, options.port), db,
+            threads=options.threads, timeout=options.timeout,
+            limits=QueryLimits(max_rows=options.max_rows,
+                max_bytes=options.max_bytes, max_chunks=options.max_chunks))
+    print >>sys.stderr, "serving %s on %s:%d" % (args[0], options.host,
+            server.server_address[1])
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
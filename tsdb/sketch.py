@@ -0,0 +1,133 @@
+"""
+Mergeable quantile sketches.
+
+A sketch is a fixed size histogram with logarithmically sized buckets, so
+every value of at least 1 is stored with a relative error of at most
+SKETCH_ACCURACY.  The
+sketch of a set of values is an array of SKETCH_BUCKETS counts and the sketch
+of the union of two sets is the sum of their sketches.  This makes it
+possible to store a sketch in each row of an Aggregate and to compute
+quantiles over long periods from a few coarse rows.
+
+Bucket 0 holds values less than 1 (including 0 and negative values), bucket
+i > 0 holds values in [SKETCH_GAMMA**(i-1), SKETCH_GAMMA**i).  Values of
+SKETCH_MAX or more are counted in the last bucket.  Values in bucket 0 are
+only ordered below the rest and are estimated as 0, so a quantile in bucket
+0 is not accurate, see sketch_rank_bucket().
+
+A sketch of a few values has few non-empty buckets, so sketches are stored as
+a fixed number of (bucket, count) pairs, see sketch_pairs().
+
+>>> s = sketch([10, 20, 30]) + sketch([40])
+>>> round(sketch_quantile(s, 50), 1)
+19.7
+"""
+
+import math
+
+import numpy
+
+SKETCH_ACCURACY = 0.02
+SKETCH_GAMMA = (1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY)
+SKETCH_MAX = 1e12
+SKETCH_BUCKETS = int(math.ceil(math.log(SKETCH_MAX) / math.log(SKETCH_GAMMA))) + 1
+# the most (bucket, count) pairs stored for a sketch, 6 bytes each
+SKETCH_MAX_PAIRS = 256
+
+def sketch_index(values):
+    """The bucket of each value in values."""
+    values = numpy.asarray(values, dtype=float)
+    idx = numpy.zeros(len(values), dtype=int)
+    big = values >= 1
+    idx[big] = numpy.floor(numpy.log(values[big]) / math.log(SKETCH_GAMMA)) + 1
+    return idx.clip(0, SKETCH_BUCKETS - 1)
+
+def sketch(values):
+    """Build the sketch of values, NaN values are ignored."""
+    values = numpy.asarray(values, dtype=float)
+    values = values[~numpy.isnan(values)]
+    return numpy.bincount(sketch_index(values),
+            minlength=SKETCH_BUCKETS).astype(numpy.uint32)
+
+def empty_sketch():
+    """The sketch of no values."""
+    return numpy.zeros(SKETCH_BUCKETS, dtype=numpy.uint32)
+
+def sketch_pairs(counts, size):
+    """Encode a sketch as ``size`` (bucket, count) pairs.
+
+    Returns a tuple of arrays (buckets, counts), unused pairs have a count of
+    0.  If the sketch has more than ``size`` non-empty buckets the smallest
+    are merged into their nearest non-empty neighbour, which loses accuracy,
+    so size should be at least the number of values sketched."""
+    counts = numpy.array(counts, dtype=numpy.uint32)
+    idx = numpy.flatnonzero(counts)
+    while len(idx) > size:
+        i = int(numpy.argmin(counts[idx]))
+        if i == len(idx) - 1 or \
+                (i > 0 and idx[i] - idx[i-1] <= idx[i+1] - idx[i]):
+            j = i - 1
+        else:
+            j = i + 1
+        counts[idx[j]] += counts[idx[i]]
+        counts[idx[i]] = 0
+        idx = numpy.delete(idx, i)
+
+    buckets = numpy.zeros(size, dtype=numpy.uint16)
+    pairs = numpy.zeros(size, dtype=numpy.uint32)
+    buckets[:len(idx)] = idx
+    pairs[:len(idx)] = counts[idx]
+    return (buckets, pairs)
+
+def sketch_from_pairs(buckets, counts):
+    """Decode (bucket, count) pairs into a sketch.  The pairs may be 2d
+    arrays holding the pairs of several sketches, which are merged."""
+    return numpy.bincount(numpy.ravel(buckets).astype(int),
+            weights=numpy.ravel(counts),
+            minlength=SKETCH_BUCKETS).astype(numpy.uint32)
+
+def merge_sketch_rows(rows):
+    """The merged sketch of an array of Aggregate rows, stored either as
+    pairs or, by older aggregates, as all of the buckets."""
+    if 'sketch' in rows.dtype.names:
+        return empty_sketch() + rows['sketch'].sum(axis=0,
+                dtype=numpy.uint32)
+    return sketch_from_pairs(rows['sketch_buckets'], rows['sketch_counts'])
+
+def sketch_value(idx):
+    """The value used to represent bucket idx."""
+    if idx == 0:
+        return 0.0
+    return 2 * SKETCH_GAMMA ** idx / (SKETCH_GAMMA + 1)
+
+def sketch_rank_bucket(counts, q):
+    """The bucket holding the q-th percentile (0 <= q <= 100) of a sketch,
+    or None for an empty sketch."""
+    counts = numpy.asarray(counts, dtype=numpy.int64)
+    n = counts.sum()
+    if n == 0:
+        return None
+    rank = max(int(math.ceil(q / 100.0 * n)), 1)
+    return int(numpy.searchsorted(counts.cumsum(), rank))
+
+def sketch_quantile(counts, q):
+    """Estimate the q-th percentile (0 <= q <= 100) from a sketch.
+
+    The nearest rank method is used: the result is the value of rank
+    ceil(q/100 * n), the same as exact_percentile().  Returns NaN for an empty
+    sketch."""
+    idx = sketch_rank_bucket(counts, q)
+    if idx is None:
+        return float('NaN')
+    return sketch_value(idx)
+
+def exact_percentile(values, q):
+    """The q-th percentile (0 <= q <= 100) of values by the nearest rank
+    method, as commonly used for 95th percentile billing.  NaN values are
+    ignored and NaN is returned if there are no values."""
+    values = numpy.asarray(values, dtype=float)
+    values = values[~numpy.isnan(values)]
+    if not len(values):
+        return float('NaN')
+    k = max(int(math.ceil(q / 100.0 * len(values))), 1) - 1
+    return float(numpy.partition(values, k)[k])
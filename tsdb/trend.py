@@ -0,0 +1,179 @@
+"""
+Bulk trend fitting for capacity planning.
+
+The trends of many TSDBVars are fitted at once: the data is loaded as a
+matrix with one row per TSDBVar using tsdb.query.select_matrix and a least
+squares line is fitted to every row with numpy, ignoring missing data.  An
+optional seasonal component, such as the day of the week for daily data, is
+removed before fitting.
+
+>>> (paths, fits) = fit_var_trends(db, "*/ifHCInOctets", begin, end,
+...         threshold=1.25e9)
+>>> save_trends("trends.npz", paths, fits)
+"""
+
+import numpy
+
+from tsdb.error import TSDBAggregateDoesNotExistError
+from tsdb.query import select_matrix
+
+TREND_DTYPE = numpy.dtype([
+    ('slope', 'f8'),        # change in value per second
+    ('intercept', 'f8'),    # fitted value at the first timestamp
+    ('r2', 'f8'),           # coefficient of determination
+    ('points', 'i8'),       # number of points used in the fit
+    ('projected', 'f8'),    # timestamp when threshold is reached or NaN
+])
+
+SEASONAL_ITERATIONS = 20
+
+def _linear_fit(t, y, mask):
+    """Fit y = intercept + slope * t for every row of y using only the
+    entries where mask is True."""
+    w = mask.astype(float)
+    y = numpy.where(mask, y, 0.0)
+
+    n = w.sum(axis=1)
+    st = (w * t).sum(axis=1)
+    sy = y.sum(axis=1)
+    stt = (w * t * t).sum(axis=1)
+    sty = (y * t).sum(axis=1)
+
+    old = numpy.seterr(divide='ignore', invalid='ignore')
+    try:
+        slope = (n * sty - st * sy) / (n * stt - st * st)
+        intercept = (sy - slope * st) / n
+    finally:
+        numpy.seterr(**old)
+
+    return slope, intercept, n
+
+def _seasonal(t, y, mask, slope, intercept, season):
+    """Mean residual of each phase of a season of ``season`` columns."""
+    residual = numpy.where(mask, y - (intercept[:, None] + slope[:, None] * t),
+            0.0)
+    phase = numpy.arange(y.shape[1]) % season
+    seasonal = numpy.zeros((y.shape[0], season))
+    old = numpy.seterr(divide='ignore', invalid='ignore')
+    try:
+        for p in range(season):
+            cols = phase == p
+            seasonal[:, p] = residual[:, cols].sum(axis=1) / \
+                    mask[:, cols].sum(axis=1)
+    finally:
+        numpy.seterr(**old)
+    seasonal[numpy.isnan(seasonal)] = 0.0
+    seasonal -= seasonal.mean(axis=1)[:, None]
+    return seasonal[:, phase]
+
+def fit_trends(timestamps, matrix, mask, season=None, threshold=None):
+    """Fit a linear trend to each row of matrix.
+
+    ``timestamps`` holds the time of each column and ``mask`` is True for the
+    entries of matrix holding valid data, as returned by select_matrix.  If
+    ``season`` is given it is the length of a season in columns, the mean
+    deviation of each phase of the season from the trend is estimated and
+    removed, alternating with fitting the trend.
+    If ``threshold`` is given the timestamp at which each trend reaches it is
+    computed, this may be in the past.  Rows with a trend that does not
+    increase have no projection.
+
+    Returns a numpy array of TREND_DTYPE with one entry per row."""
+    t = (timestamps - timestamps[0]).astype(float)
+    (slope, intercept, n) = _linear_fit(t, matrix, mask)
+
+    y = matrix
+    if season and season > 1:
+        # alternate between estimating the season and the trend
+        for i in range(SEASONAL_ITERATIONS):
+            y = matrix - _seasonal(t, matrix, mask, slope, intercept, season)
+            (slope, intercept, n) = _linear_fit(t, y, mask)
+
+    fitted = intercept[:, None] + slope[:, None] * t
+    y = numpy.where(mask, y, 0.0)
+    old = numpy.seterr(divide='ignore', invalid='ignore')
+    try:
+        mean = y.sum(axis=1) / n
+        ss_res = numpy.where(mask, (y - fitted) ** 2, 0.0).sum(axis=1)
+        ss_tot = numpy.where(mask, (y - mean[:, None]) ** 2, 0.0).sum(axis=1)
+        r2 = 1.0 - ss_res / ss_tot
+    finally:
+        numpy.seterr(**old)
+
+    fits = numpy.zeros(len(matrix), dtype=TREND_DTYPE)
+    fits['slope'] = slope
+    fits['intercept'] = intercept
+    fits['r2'] = r2
+    fits['points'] = n
+    fits['projected'] = numpy.nan
+
+    if threshold is not None:
+        rising = slope > 0
+        threshold = numpy.resize(numpy.asarray(threshold, dtype=float),
+                len(matrix))
+        fits['projected'][rising] = timestamps[0] + \
+                (threshold[rising] - intercept[rising]) / slope[rising]
+
+    return fits
+
+def fit_var_trends(container, pattern, begin, end, aggregate='1d',
+        field='average', season=None, threshold=None, batch=500,
+        threads=None):
+    """Fit trends to the aggregates of all TSDBVars matching pattern.
+
+    The TSDBVars are found with container.find_vars(pattern) and ``field``
+    of ``aggregate`` is loaded between begin and end in batches of ``batch``
+    TSDBVars, so memory use is bounded by the batch size.  Each batch of
+    TSDBVars is released from the container once it has been read, see
+    TSDBBase.release_var().  TSDBVars without the aggregate are skipped.  See fit_trends() for ``season`` and
+    ``threshold``, a threshold given as a dictionary is looked up by path.
+
+    Returns a tuple of (paths, fits)."""
+    paths = []
+    aggs = []
+    for path in container.find_vars(pattern):
+        try:
+            aggs.append(container.get_var(path).get_aggregate(aggregate))
+        except TSDBAggregateDoesNotExistError:
+            container.release_var(path)
+            continue
+        paths.append(path)
+
+    if isinstance(threshold, dict):
+        threshold = [threshold.get(x, numpy.nan) for x in paths]
+
+    results = []
+    for i in range(0, len(aggs), batch):
+        try:
+            (timestamps, matrix, mask) = select_matrix(aggs[i:i+batch], begin,
+                    end, field=field, threads=threads)
+        finally:
+            for path in paths[i:i+batch]:
+                container.release_var(path)
+        if threshold is None or numpy.isscalar(threshold):
+            batch_threshold = threshold
+        else:
+            batch_threshold = threshold[i:i+batch]
+        results.append(fit_trends(timestamps, matrix, mask, season=season,
+            threshold=batch_threshold))
+
+    if results:
+        fits = numpy.concatenate(results)
+    else:
+        fits = numpy.zeros(0, dtype=TREND_DTYPE)
+
+    return paths, fits
+
+def save_trends(filename, paths, fits):
+    """Save the result of fit_var_trends() as a compressed .npz table."""
+    columns = dict([(name, fits[name]) for name in TREND_DTYPE.names])
+    numpy.savez_compressed(filename, paths=numpy.array(paths), **columns)
+
+def load_trends(filename):
+    """Load a table written by save_trends().  Returns (paths, fits)."""
+    table = numpy.load(filename)
+    paths = list(table['paths'])
+    fits = numpy.zeros(len(paths), dtype=TREND_DTYPE)
+    for name in TREND_DTYPE.names:
+        fits[name] = table[name]
+    return paths, fits
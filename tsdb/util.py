@@ -5,13 +5,33 @@ from tsdb.row import Counter32, Counter64
 from tsdb.error import InvalidInterval
 
 def write_dict(fs, path, d):
-    """Write a dictionary in NAME: VALUE format."""
-    f = fs.open(path, "w")
+    """Write a dictionary in NAME: VALUE format.
+
+    The dictionary is written to a temporary file which is then renamed over
+    path, so readers see either the old or the new contents."""
+    tmp = "%s.tmp.%d" % (path, os.getpid())
+    f = fs.open(tmp, "w")
 
     for key in d:
         f.write(key + ": " + str(d[key]) + "\n")
 
     f.close()
+    fs.rename(tmp, path)
+
+def read_dict(fs, path):
+    """Read a dictionary written by write_dict.  Values are strings."""
+    d = {}
+    f = fs.open(path, "r")
+
+    for line in f:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        (key, val) = line.split(':', 1)
+        d[key] = val.strip()
+
+    f.close()
+    return d
 
 INTERVAL_SCALARS = {
     's': 1,
@@ -75,7 +95,7 @@ def rrd_from_tsdb_var(var, begin, rrd_path, heartbeat=None, ds_name=None,
     for aggname in var.list_aggregates():
         agg = var.get_aggregate(aggname)
         for agg_func in agg.metadata['AGGREGATES']:
-            if agg_func != 'delta':
+            if agg_func in ('average', 'min', 'max'):
                 rrd_args.append("RRA:%s:0.5:%d:%d" % (agg_func.upper(),
                     agg.metadata['STEP'] / step, rows))
 
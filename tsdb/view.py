@@ -0,0 +1,125 @@
+"""
+A memory mapped view of all of the rows of a TSDBVar.
+
+A VarView presents every slot from the beginning of the first chunk of a
+TSDBVar to the end of its last as one array indexed by slot.  Each chunk is
+mapped read only with numpy.memmap the first time it is needed, so nothing
+is read until it is used and indexing a range only touches the pages of the
+chunks holding it.  A slice within a single chunk is a view of the mapped
+file, slices across chunks are copied into a new array.  Slots in chunks
+which don't exist are zero, so their flags don't have ROW_VALID set.
+
+The rows are as stored on disk: the dtype is that of the TSDBVar, in network
+byte order, and invalid rows are not given the slot timestamp as they are by
+select_array().  Writes made after a chunk is mapped are seen once they are
+flushed.
+
+>>> view = var.view()
+>>> rows = view.select(begin, end)
+>>> rows = view[-24:]
+"""
+
+import numpy
+
+from tsdb.util import calculate_slot
+
+class VarView(object):
+    """The rows of a TSDBVar as a read only array of slots, see the module
+    documentation.  Raises TSDBVarEmpty if the TSDBVar has no chunks."""
+
+    def __init__(self, var):
+        self.var = var
+        self.dtype = var.dtype
+        self.step = var.metadata['STEP']
+        self.names = set(var.all_chunks())
+        names = sorted(self.names)
+        self.begin = var.chunk_mapper.begin(names[0])
+        self.end = calculate_slot(var.chunk_mapper.end(names[-1]), self.step)
+        self.maps = {}  # chunk name -> memmap, or None if it is empty
+
+    def __repr__(self):
+        return '<VarView %s %d slots>' % (self.var.path, len(self))
+
+    def __len__(self):
+        return (self.end - self.begin) / self.step + 1
+
+    def timestamp(self, i):
+        """The timestamp of slot i."""
+        return self.begin + i * self.step
+
+    def index(self, timestamp):
+        """The index of the slot holding timestamp."""
+        return (calculate_slot(timestamp, self.step) - self.begin) / self.step
+
+    def _map(self, name):
+        if not self.maps.has_key(name):
+            path = self.var.fs.resolve_path("%s/%s" % (self.var.path, name))
+            n = self.var.fs.getsize("%s/%s" % (self.var.path, name)) / \
+                    self.dtype.itemsize
+            if n:
+                self.maps[name] = numpy.memmap(path, dtype=self.dtype,
+                        mode='r', shape=(n, ))
+            else:
+                self.maps[name] = None
+        return self.maps[name]
+
+    def _rows(self, first, last):
+        """The rows from slot index first to last inclusive."""
+        if last < first:
+            return numpy.zeros(0, dtype=self.dtype)
+
+        parts = []
+        for (span_begin, span_end) in self.var._chunk_spans(
+                self.timestamp(first), self.timestamp(last)):
+            name = self.var.chunk_mapper.name(span_begin)
+            n = (span_end - span_begin) / self.step + 1
+            rows = None
+            if name in self.names:
+                rows = self._map(name)
+            if rows is None:
+                parts.append(numpy.zeros(n, dtype=self.dtype))
+                continue
+
+            offset = (span_begin - self.var.chunk_mapper.begin(name)) / \
+                    self.step
+            part = rows[offset:offset+n]
+            if len(part) < n:
+                # a short chunk file
+                part = numpy.concatenate([part,
+                    numpy.zeros(n - len(part), dtype=self.dtype)])
+            parts.append(part)
+
+        if len(parts) == 1:
+            return parts[0]
+        return numpy.concatenate(parts)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            (start, stop, stride) = key.indices(len(self))
+            slots = xrange(start, stop, stride)
+            if not slots:
+                return numpy.zeros(0, dtype=self.dtype)
+            if stride > 0:
+                return self._rows(slots[0], slots[-1])[::stride]
+            return self._rows(slots[-1], slots[0])[::stride]
+
+        i = int(key)
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError("slot index out of range")
+        return self._rows(i, i)[0]
+
+    def select(self, begin, end):
+        """The rows of the slots from begin to end inclusive, clipped to the
+        view."""
+        first = max(self.index(max(begin, self.begin)), 0)
+        last = min(self.index(min(end, self.end)), len(self) - 1)
+        return self._rows(first, last)
+
+    def close(self):
+        """Unmap the chunks, arrays returned earlier must not be used."""
+        for rows in self.maps.values():
+            if rows is not None:
+                rows._mmap.close()
+        self.maps = {}